@@ -32,30 +32,106 @@ import pickle
 import fnmatch
 import logging
 import logging.handlers
-import sqlite3
 import base64
-import requests
-import tempfile
 import time
 import datetime
-import dateutil
-import dateutil.tz
-import subprocess
+import email.utils
 import http.client
-import asyncio
+import threading
+import concurrent.futures
+import http.server
+import socketserver
+import urllib.parse
+import contextlib
+import io
+import textwrap
+import socket
+import weakref
+import operator
+import hashlib
+import uuid
+import collections
+import cProfile
+import tracemalloc
+import importlib
 from enum import Enum
-import lxml.etree
-import xmltodict
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+
+class LazyModule(object):
+
+    """Stand-in for a module that is imported on its first use, so that
+    commands do not pay for the imports they do not need. Submodules
+    are imported on access, too (e.g. lxml.etree). An optional module
+    that cannot be imported is false, a missing required module raises
+    the ImportError on first use."""
+
+    def __init__(self, name, optional=False):
+
+        self.__dict__.update(lazyName=name, lazyOptional=optional, lazyModule=None, lazyMissing=False)
+
+
+
+    def load(self):
+
+        if (self.lazyModule is None) and not self.lazyMissing:
+            try:
+                self.__dict__["lazyModule"] = importlib.import_module(self.lazyName)
+            except ImportError:
+                if not self.lazyOptional:
+                    raise
+                self.__dict__["lazyMissing"] = True
+
+        return self.lazyModule
+
+
+
+    def __getattr__(self, name):
+
+        module = self.load()
+        if module is None:
+            raise AttributeError("optional module %s is not available" % (self.lazyName))
+        try:
+            return getattr(module, name)
+        except AttributeError:
+            return importlib.import_module("%s.%s" % (self.lazyName, name))
+
+
+
+    def __bool__(self):
+
+        return self.load() is not None
+
+
+
+sqlite3 = LazyModule("sqlite3")
+requests = LazyModule("requests")
+dateutil = LazyModule("dateutil")
+lxml = LazyModule("lxml")
+xmltodict = LazyModule("xmltodict")
+numpy = LazyModule("numpy", optional=True)
+orjson = LazyModule("orjson", optional=True)
 
 
 
 DEFAULT_SOURCE		= "Frank's Grainfather Community Tool"
+DEFAULT_BASEURL		= "https://brew.grainfather.com"
+DEFAULT_OAUTHURL	= "https://oauth.grainfather.com"
 
 
 
 class Util(object):
 
-    """Some utility function."""
+    """Some utility function. The unit conversions and the smooth
+    brewing functions accept plain numbers as well as NumPy arrays, so
+    that whole columns of values can be converted in one call, as the
+    Calculator does for amounts. The smooth functions are always
+    evaluated exactly, there are no interpolation tables: they are only
+    called on single values, mostly at fixed temperatures."""
 
 
 
@@ -82,10 +158,18 @@ class Util(object):
 
 
     def yieldToPpg(y):
+        if Util.isArray(y):
+            return y * 0.46177
         return float(y) * 0.46177
 
 
 
+    def isArray(value):
+
+        return bool(numpy) and isinstance(value, numpy.ndarray)
+
+
+
     def fToC(f):
 
         return (f - 32) * 5 / 9
@@ -99,6 +183,13 @@ class Util(object):
 
 
 
+    def gravityToPlato(sg):
+
+        # formula learned from https://www.brewersfriend.com/plato-to-sg-conversion-chart/
+        return -616.868 + 1111.14 * sg - 630.272 * sg ** 2 + 135.997 * sg ** 3
+
+
+
     def ebcToLovibond(ebc):
 
         # from GF js: function lovi2ebc(value, dec) { return ((value * 1.3546 - 0.76) * 1.97).toFixed(dec || 0); }
@@ -140,854 +231,1550 @@ class Util(object):
 
 
 
+    def retryDelay(retryAfter, attempt):
 
+        """Returns the seconds to wait before repeating a throttled
+        request, as asked for by a Retry-After header (seconds or an
+        HTTP date), or by exponential backoff, at most a minute."""
 
+        if retryAfter:
+            try:
+                return min(60.0, max(0.0, float(retryAfter)))
+            except ValueError:
+                try:
+                    t = email.utils.parsedate_to_datetime(retryAfter)
+                    return min(60.0, max(0.0, (t - datetime.datetime.now(datetime.timezone.utc)).total_seconds()))
+                except (TypeError, ValueError):
+                    pass
 
-class BeerSmith3(object):
+        return min(60.0, 0.5 * pow(2, attempt))
 
-    """Representation of a BeerSmith3 database."""
 
-    dir = None
-    pattern = None
-    logger = None
 
+    def endpoint(url):
 
+        """Returns the path of a URL with numeric components replaced
+        by :id, to aggregate the requests of the same endpoint."""
 
-    def __init__(self, dir, pattern=None):
+        path = urllib.parse.urlparse(url).path
+        return re.sub(r'/[0-9]+(?=/|$)', '/:id', path) or "/"
 
-        """Initialized access to the BeerSmith3 database given by the
-        filesystem directory parameter."""
 
-        self.logger = logging.getLogger('beersmith')
-        self.dir = dir
-        self.pattern = pattern
 
+    def compactJson(obj):
 
+        """Returns a document as one line of JSON with sorted keys, by
+        orjson if it is available."""
 
-    def collectBeerSmithRecipes(self, table):
+        with PROFILER.span("serialize"):
 
-        """Retrieve a list of all recipes that match the given
-        name pattern in all folders."""
+            if orjson:
+                try:
+                    return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode("utf-8")
+                except TypeError:
+                    # e.g. integers beyond 64 bits
+                    pass
 
-        l = []
+            return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
 
-        if table.__class__.__name__ != "list":
-            table = [ table ]
 
-        for entry in table:
-            if entry["data"] != None:
-                if (self.pattern in entry["name"]) and (entry["data"] != None):
-                    recipes = entry["data"]["recipe"]
-                    if recipes.__class__.__name__ != "list":
-                        recipes = [ recipes ]
-                    for recipe in recipes:
-                        l.append(recipe)
-                if "table" in entry["data"]:
-                    l.extend(self.collectBeerSmithRecipes(entry["data"]["table"]))
 
-        return l
+    def contentHash(doc):
 
+        """Returns a hash of a JSON document, not considering the fields
+        that the server maintains (see JsonDiff.IGNORED)."""
 
+        def strip(value):
+            if isinstance(value, dict):
+                return { k: strip(v) for k, v in value.items() if k not in JsonDiff.IGNORED }
+            if isinstance(value, list):
+                return [ strip(v) for v in value ]
+            return value
 
-    def dictToRecipe(self, bs):
+        return hashlib.sha1(Util.compactJson(strip(doc)).encode("utf-8")).hexdigest()
 
-        """Converts a BeerSmith3 recipe dict into a Recipe object."""
 
-        data = {}
-        brew_data = {}
 
-        data["name"] = bs["f_r_name"]
+    def printRecords(records, format):
 
-        data["og"] = float("%.3f" % float(bs["f_r_desired_og"]))
-        data["ibu"] = round(float(bs["f_r_desired_ibu"]))
-        data["srm"] = float("%.1f" % float(bs["f_r_desired_color"]))
+        """Prints an iterable of documents either as a pretty JSON
+        array, or as NDJSON, one line per document. Either way, each
+        document is printed as soon as it is produced."""
 
-        data["is_active"] = True # what is this?
-        data["is_public"] = True # could we allow adjustment in BeerSmith3 somehow?
-        data["notes"] = bs["f_r_notes"]
-        data["description"] = bs["f_r_description"]
-        data["efficiency"] = float(bs["f_r_equipment"]["f_e_efficiency"]) / 100 # percent -> fraction
-        data["created_at"] = bs["agedata"]["_mod_"] + "T00:00:00.000000Z"
-        data["updated_at"] = bs["_mod_"] + "T00:00:00.000000Z"
-        data["batch_size"] = float("%.2f" % (float(bs["f_r_equipment"]["f_e_batch_vol"]) * 0.0295735)) # fl oz -> l
-        data["boil_size"] = float("%.2f" % (float(bs["f_r_equipment"]["f_e_boil_vol"]) * 0.0295735)) # TBD: at start or end of boil?
-        data["boil_time"] = round(float(bs["f_r_equipment"]["f_e_boil_time"]))
-        data["losses"] = float("%.02f" % (float(bs["f_r_equipment"]["f_e_trub_loss"]) * 0.0295735))
-        data["unit_type_id"] = UnitType.METRIC.value; # TBD: we could derive the unit type from BeerSmith options
-        if bs["f_r_style"]["f_s_guide"] == "BJCP 2015":
-            data["bjcp_style_id"] = "%s%s" % (bs["f_r_style"]["f_s_number"], chr(64+int(bs["f_r_style"]["f_s_letter"])))
+        if format == "ndjson":
+            for record in records:
+                sys.stdout.write(Util.compactJson(record) + "\n")
+                sys.stdout.flush()
+        else:
+            # the same text as json.dumps() of the whole list
+            separator = "[\n"
+            for record in records:
+                with PROFILER.span("serialize"):
+                    text = textwrap.indent(json.dumps(record, sort_keys=True, indent=4), "    ")
+                sys.stdout.write(separator + text)
+                sys.stdout.flush()
+                separator = ",\n"
+            print("[]" if separator == "[\n" else "\n]")
 
-        # ingredients
-        if ("ingredients" in bs) and ("data" in bs["ingredients"]):
-            # fermentables
-            data["fermentables"] = []
-            grain_weight = 0.0
-            if ("grain" in bs["ingredients"]["data"]):
-                grains = bs["ingredients"]["data"]["grain"]
-                if grains.__class__.__name__ != "list":
-                    grains = [ grains ]
-                for grain in grains:
-                    if int(grain["f_g_use"]) == 0: # mash
-                        usageType = FermentableUsageType.MASH.value
-                    elif int(grain["f_g_use"]) == 1: # steep
-                        usageType = FermentableUsageType.STEEP.value
-                    elif int(grain["f_g_use"]) == 2: # boil
-                        usageType = FermentableUsageType.EXTRACT.value
-                    elif int(grain["f_g_use"]) >= 3: # whirlpool, or later
-                        usageType = FermentableUsageType.LATEADDITION.value
-                    else:
-                        usageType = FermentableUsageType.MASH.value # default
-                    data["fermentables"].append({
-                            "name": grain["f_g_name"],
-                            "ppg": float("%.1f" % (Util.yieldToPpg(float(grain["f_g_yield"])))),
-                            "lovibond": float("%.02f" % (float(grain["f_g_color"]))), # lovibond
-                            "fermentable_usage_type_id": usageType,
-                            "fermentable_id": None,
-                            "amount": float("%.03f" % (float(grain["f_g_amount"]) * 0.0283495))  # oz -> kg
-                            })
-                    grain_weight += (float(grain["f_g_amount"]) * 0.0283495) # in kg
 
-            # hops
-            data["hops"] = []
-            if ("hops" in bs["ingredients"]["data"]):
-                hops = bs["ingredients"]["data"]["hops"]
-                if hops.__class__.__name__ != "list":
-                    hops = [ hops ]
-                for hop in hops:
-                    if int(hop["f_h_form"]) == 0: # pellet
-                        typeid = HopType.PELLET.value
-                    elif int(hop["f_h_form"]) == 1: # plug
-                        typeid = HopType.PLUG.value
-                    elif int(hop["f_h_form"]) == 2: # leaf
-                        typeid = HopType.LEAF.value
-                    elif int(hop["f_h_form"]) >= 3: # extract, other form of extract
-                        typeid = HopType.EXTRACT.value
-                    else:
-                        typeid = HopType.PELLET.value # default
-                    time = round(float(hop["f_h_boil_time"]))
-                    if int(hop["f_h_use"]) == 0: # boil
-                        usageType = HopUsageType.BOIL.value
-                    elif int(hop["f_h_use"]) == 1: # dry hop
-                        usageType = HopUsageType.DRYHOP.value
-                        time = round(float(hop["f_h_dry_hop_time"]))
-                    elif int(hop["f_h_use"]) == 2: # mash
-                        usageType = HopUsageType.MASH.value
-                    elif int(hop["f_h_use"]) == 3: # first wort
-                        usageType = HopUsageType.FIRSTWORT.value
-                    elif int(hop["f_h_use"]) == 4: # steep / whirlpool
-                        usageType = HopUsageType.HOPSTAND.value
-                    else:
-                        usageType = HopUsageType.BOIL.value # default
-                    data["hops"].append({
-                            "name": hop["f_h_name"],
-                            "aa": float("%.01f" % (float(hop["f_h_alpha"]))),
-                            "hop_type_id": typeid,
-                            "hop_usage_type_id": usageType,
-                            "time": time,
-                            "amount": float("%.1f" % (float(hop["f_h_amount"]) * 28.3495)) # oz -> g
-                            })
 
-            # yeasts
-            data["yeasts"] = []
-            if ("yeast" in bs["ingredients"]["data"]):
-                yeasts = bs["ingredients"]["data"]["yeast"]
-                if yeasts.__class__.__name__ != "list":
-                    yeasts = [ yeasts ]
-                for yeast in yeasts:
-                    name = yeast["f_y_name"]
-                    if yeast["f_y_product_id"] and len(yeast["f_y_product_id"]) > 0:
-                        name = name + " " + yeast["f_y_product_id"]
-                    if yeast["f_y_lab"] and len(yeast["f_y_lab"]) > 0:
-                        name = yeast["f_y_lab"] + " " + name
-                    data["yeasts"].append({
-                            "name": name,
-                            "unit": "packets",
-                            "attenuation": float("%.02f" % (float(yeast["f_y_max_attenuation"]) / 100)),
-                            "amount": float("%.1f" % (float(yeast["f_y_amount"])))
-                            })
-                
-            # adjuncts
-            data["adjuncts"] = []
-            if ("misc" in bs["ingredients"]["data"]):
-                miscs = bs["ingredients"]["data"]["misc"]
-                if miscs.__class__.__name__ != "list":
-                    miscs = [ miscs ]
-                for misc in miscs:
-                    if int(misc["f_m_units"]) == 0:
-                        unit = "mg"
-                    elif int(misc["f_m_units"]) == 1:
-                        unit = "g"
-                    elif int(misc["f_m_units"]) == 2:
-                        unit = "oz"
-                    elif int(misc["f_m_units"]) == 3:
-                        unit = "lb"
-                    elif int(misc["f_m_units"]) == 4:
-                        unit = "kg"
-                    elif int(misc["f_m_units"]) == 5:
-                        unit = "ml"
-                    elif int(misc["f_m_units"]) == 6:
-                        unit = "tsp"
-                    elif int(misc["f_m_units"]) == 7:
-                        unit = "tbsp"
-                    elif int(misc["f_m_units"]) == 8:
-                        unit = "cup"
-                    elif int(misc["f_m_units"]) == 9:
-                        unit = "pt"
-                    elif int(misc["f_m_units"]) == 10:
-                        unit = "qt"
-                    elif int(misc["f_m_units"]) == 11:
-                        unit = "l"
-                    elif int(misc["f_m_units"]) == 12:
-                        unit = "gal"
-                    elif int(misc["f_m_units"]) == 13:
-                        unit = "items"
-                    else:
-                        unit = "units"
-                    time = float(misc["f_m_time"])
-                    if int(misc["f_m_use"]) == 0: # boil
-                        if time == 0:
-                            usageType = AdjunctUsageType.FLAMEOUT.value
-                        else:
-                            usageType = AdjunctUsageType.BOIL.value
-                    elif int(misc["f_m_use"]) == 1: # mash
-                        usageType = AdjunctUsageType.MASH.value
-                        time = round(float(hop["f_h_dry_hop_time"]))
-                    elif int(misc["f_m_use"]) == 2: # primary
-                        usageType = AdjunctUsageType.PRIMARY.value
-                    elif int(misc["f_m_use"]) == 3: # secondary
-                        usageType = AdjunctUsageType.SECONDARY.value
-                    elif int(misc["f_m_use"]) == 4: # bottling
-                        usageType = AdjunctUsageType.BOTTLE.value
-                    elif int(misc["f_m_use"]) == 5: # sparge
-                        usageType = AdjunctUsageType.SPARGE.vlue
-                    else:
-                        usageType = AdjunctUsageType.BOIL.value
-                    data["adjuncts"].append({
-                            "name": misc["f_m_name"],
-                            "adjunct_usage_type_id": usageType,
-                            "unit": unit,
-                            "amount": float("%.2f" % (float(misc["f_m_amount"]))),
-                            "time": time
-                            })
+    def chunks(iterable, n):
 
-        # mash
-        if ("f_r_mash" in bs) and ("steps" in bs["f_r_mash"]) and ("data" in bs["f_r_mash"]["steps"]) and ("mashstep" in bs["f_r_mash"]["steps"]["data"]):
-            # mash steps
-            data["mash_steps"] = []
-            steps = bs["f_r_mash"]["steps"]["data"]["mashstep"]
-            if steps.__class__.__name__ != "list":
-                steps = [ steps ]
-            i = 0
-            for step in steps:
-                data["mash_steps"].append({
-                        "order": i,
-                        "name": step["f_ms_name"],
-                        "temperature": round(Util.fToC(float(step["f_ms_step_temp"]))),
-                        "time": round(float(step["f_ms_step_time"]))
-                        })
-                i += 1
+        """Yields lists of up to n items of an iterable."""
 
-        # fermentation steps
-        data["fermentation_steps"] = []
-        if "f_r_age" in bs:
-            i = 0
-            a = bs["f_r_age"]
-            n = a["f_a_name"]
-            if int(a["f_a_type"]) >= 0:
-                data["fermentation_steps"].append({
-                        "order": i,
-                        "name": n + ", Primary",
-                        "temperature": round(Util.fToC(float(a["f_a_prim_temp"]))),
-                        "time": round(float(a["f_a_prim_days"]))
-                        })
-                i += 1
-            if int(a["f_a_type"]) >= 1:
-                data["fermentation_steps"].append({
-                        "order": i,
-                        "name": n + ", Secondary",
-                        "temperature": round(Util.fToC(float(a["f_a_sec_temp"]))),
-                        "time": round(float(a["f_a_sec_days"]))
-                        })
-                i += 1
-            if int(a["f_a_type"]) >= 2:
-                data["fermentation_steps"].append({
-                        "order": i,
-                        "name": n + ", Tertiary",
-                        "temperature": round(Util.fToC(float(a["f_a_tert_temp"]))),
-                        "time": round(float(a["f_a_tert_days"]))
-                        })
-                i += 1
-            if float(a["f_a_age"]) > 0:
-                ageSuffix = ""
-                if a["f_a_age_temp"] != a["f_a_end_age_temp"]:
-                    ageSuffix = " (end temp %s°C)" % (round(Util.fToC(float(a["f_a_end_age_temp"]))))
-                data["fermentation_steps"].append({
-                        "order": i,
-                          "name": n + ", Age" + ageSuffix,
-                          "temperature": round(Util.fToC(float(a["f_a_age_temp"]))),
-                          "time": round(float(a["f_a_age"]))
-                          })
-            
-        # finally create the Recipe and Brew objects from the dicts
-        r = Recipe(data=data, brew_data=brew_data)
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= n:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
-        r.recalculate(force=True)
 
-        return r
 
+    def roundRobin(iterators):
 
+        """Yields tuples of tag and item, taking one item of each of the
+        given (tag, iterator) tuples in turn, until all are exhausted."""
 
-    def getRecipes(self, namepattern="*"):
+        iterators = collections.deque(iterators)
+        while iterators:
+            tag, iterator = iterators.popleft()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                continue
+            yield (tag, item)
+            iterators.append((tag, iterator))
 
-        """Retrieves an array of Recipe objects from the BeerSmith3
-        database based on an optional name pattern."""
 
-        recipes = []
 
-        # BeerSmith XML is no real XML :-( - use HTML parser to allow HTML entities
-        parser = lxml.etree.HTMLParser(recover=True)
+class RateLimiter(object):
 
-        tree = lxml.etree.parse("%s/Recipe.bsmx" % (self.dir), parser=parser)
-        b = lxml.etree.tostring(tree.getroot(), method="xml")
-        doc = xmltodict.parse(b.decode("utf-8"))
-        bs_recipes = self.collectBeerSmithRecipes(doc["html"]["body"]["recipe"]["data"]["table"])
+    """Token bucket shared by all threads sending requests through a
+    session. On average, at most rate requests per second pass,
+    bursts of up to burst requests are let through without delay."""
 
-        bs_recipes = list(filter(lambda r: fnmatch.fnmatch(r["f_r_name"], namepattern), bs_recipes))
+    def __init__(self, rate, burst=None):
 
-        print(json.dumps(bs_recipes, sort_keys=True, indent=4))
+        self.rate = float(rate)
+        self.burst = float(burst if burst else max(1.0, rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
 
-        for bs_recipe in bs_recipes:
-            recipe = self.dictToRecipe(bs_recipe)
-            recipes.append(recipe)
-        
-        return recipes
 
 
+    def acquire(self):
 
-    def getRecipe(self, namepattern):
+        """Blocks until the next request may be sent."""
 
-        """Retrieves one Recipe object from the BeerSmith3 database
-        based on a name pattern."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # take the token in advance, so that waiting threads queue up
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
 
-        recipes = self.getRecipes(namepattern)
+        if delay > 0:
+            time.sleep(delay)
 
-        if len(recipes) == 0:
-            self.logger.warn("pattern did not result in any entry")
-            return None
 
-        if len(recipes) > 1:
-            self.logger.warn("pattern did not result in a unique entry")
-            return None
 
-        return recipes[0]
+class Metrics(object):
 
+    """Counters, gauges and timing summaries of a process, e.g. of the
+    daemon, identified by a name and a set of labels. They are
+    rendered in the Prometheus text format or as a JSON document, see
+    MetricsServer."""
 
+    HELP = {
+        "grainfather_requests_total": ("counter", "Requests sent to the GF site"),
+        "grainfather_request_seconds": ("summary", "Duration of requests to the GF site"),
+        "grainfather_relogins_total": ("counter", "Logins after a missing or expired session"),
+        "grainfather_conversion_seconds": ("summary", "Duration of converting one recipe"),
+        "grainfather_syncs_total": ("counter", "Syncs run, by result"),
+        "grainfather_sync_seconds": ("summary", "Duration of a sync"),
+        "grainfather_sync_lag_seconds": ("gauge", "Time from the KBH change to the completion of its sync"),
+        "grainfather_sync_queue_depth": ("gauge", "Operations of the running sync not yet executed"),
+        "grainfather_last_sync_timestamp_seconds": ("gauge", "Completion time of the last successful sync"),
+        "grainfather_last_sync_failed": ("gauge", "Whether the last sync failed"),
+        }
 
-class KleinerBrauhelfer(object):
+    def __init__(self):
 
-    """Representation of a "Kleiner Brauhelfer" database."""
+        self.lock = threading.Lock()
+        self.values = {}	# (name, labels) -> value
+        self.summaries = {}	# (name, labels) -> [count, sum]
+        self.started = time.time()
 
-    path = None
-    conn = None
-    logger = None
 
 
+    def key(name, labels):
 
-    def __init__(self, path):
+        return (name, tuple(sorted(labels.items())))
 
-        """Opens the KBH SQlite3 database given by the filesystem path parameter."""
 
-        self.logger = logging.getLogger('kbh')
-        self.path = path
 
-        self.reopen()
+    def inc(self, name, value=1, **labels):
 
+        with self.lock:
+            k = Metrics.key(name, labels)
+            self.values[k] = self.values.get(k, 0) + value
 
 
-    def reopen(self):
 
-        if self.conn:
-            self.conn.close()
+    def set(self, name, value, **labels):
 
-        fd = os.open(self.path, os.O_RDONLY)
-        os.close(fd)
-        self.conn = sqlite3.connect(self.path, uri=True)
-        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.values[Metrics.key(name, labels)] = value
 
 
 
-    def extractFromArray(self, array, tag, default=None):
+    def observe(self, name, seconds, **labels):
 
-        """Extracts a value from a given array of texts addressed by a given tag.
-        This is used to encode some special attributes in KBH comment fields
-        that are not otherwise represented in the KBH database. E.g.
-        some equipment profile attributes stored in separate rows of "Geraete"."""
+        with self.lock:
+            summary = self.summaries.setdefault(Metrics.key(name, labels), [0, 0.0])
+            summary[0] += 1
+            summary[1] += seconds
 
-        value = default
-        
-        for line in array:
-            if ("[[%s:" % (tag)) in line:
-                pattern = r'^.*\[\[' + re.escape(tag) + r' *: *([^\]]*)\]\].*$'
-                value = re.sub(pattern, r'\1', line, re.IGNORECASE)
 
-        if default != None:
 
-            if default.__class__.__name__ == "bool":
-                if str(value).lower() in [ "1", "true", "y", "yes", "ja" ]:
-                    value = True
-                #if str(value).lower() in [ "0", "false", "n", "no", "nein" ]:
-                else:
-                    value = False
+    def get(self, name, default=None, **labels):
 
-            if (default.__class__.__name__ == "int") or (default.__class__.__name__ == "float"):
-                value = float(str(value).replace(",","."))
-                    
-        return value
+        with self.lock:
+            return self.values.get(Metrics.key(name, labels), default)
 
 
 
-    def extractFromText(self, text, tag, default=None):
+    def toPrometheus(self):
 
-        """Extracts a value from a given text addressed by a given tag.
-        This is used to encode some special attributes in KBH comment fields
-        that are not otherwise represented in the KBH database. E.g.
-        the substring "[[BJCP-Style: 7B]]" in a recipe comment may be
-        converted to an according Grainfather recipe attribute."""
+        """Returns all metrics in the Prometheus text exposition format."""
 
-        value = default
-        
-        for line in text.splitlines():
-            if ("[[%s:" % (tag)) in line:
-                pattern = r'^.*\[\[' + re.escape(tag) + r' *: *([^\]]*)\]\].*$'
-                value = re.sub(pattern, r'\1', line, re.IGNORECASE)
+        def labelString(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ""
+            return "{%s}" % (",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels))
 
-        if default != None:
+        lines = []
+        with self.lock:
+            names = sorted(set([ name for name, labels in self.values ] + [ name for name, labels in self.summaries ]))
+            for name in names:
+                type, help = Metrics.HELP.get(name, ("untyped", None))
+                if help:
+                    lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, type))
+                for (n, labels), value in sorted(self.values.items()):
+                    if n == name:
+                        lines.append("%s%s %s" % (name, labelString(labels), repr(float(value))))
+                for (n, labels), (count, total) in sorted(self.summaries.items()):
+                    if n == name:
+                        lines.append("%s_count%s %d" % (name, labelString(labels), count))
+                        lines.append("%s_sum%s %s" % (name, labelString(labels), repr(total)))
 
-            if default.__class__.__name__ == "bool":
-                if str(value).lower() in [ "1", "true", "y", "yes", "ja" ]:
-                    value = True
-                #if str(value).lower() in [ "0", "false", "n", "no", "nein" ]:
-                else:
-                    value = False
+        return "\n".join(lines) + "\n"
 
-            if (default.__class__.__name__ == "int") or (default.__class__.__name__ == "float"):
-                value = float(str(value).replace(",","."))
-                    
-        return value
 
 
+    def toDict(self):
 
-    def sudToRecipe(self, sud):
+        """Returns all metrics as a JSON document, summaries with their
+        count, sum and mean."""
 
-        """Converts a "sud" read from the KBH database into a Recipe object.
-        Subsequent readings from the database will be issued to fill the
-        Recipe object with as much useful information as passible."""
+        def entry(name, labels):
+            return dict(name=name, **dict(labels))
 
-        c = self.conn.cursor()
+        with self.lock:
+            values = [ dict(entry(name, labels), value=value) for (name, labels), value in sorted(self.values.items()) ]
+            summaries = [ dict(entry(name, labels), count=count, sum=total, mean=total / count if count else None)
+                          for (name, labels), (count, total) in sorted(self.summaries.items()) ]
 
-        c.execute("SELECT * FROM Ausruestung WHERE Name = ?", (sud["AuswahlBrauanlageName"],))
-        a = c.fetchall()
-        if len(a) > 0:
-            anlage = a[0]
-            anlagensudhausausbeute = anlage["Sudhausausbeute"]
-            anlagenid = anlage["AnlagenID"]
-        else:
-            anlage = {}
-            anlagensudhausausbeute = 62 # TBD estimate
-            anlagenid = None
+        return { "values": values, "summaries": summaries }
 
-        geraete = []
-        if anlagenid:
-            c.execute("SELECT * FROM Geraete WHERE AusruestungAnlagenID = ?", (anlagenid,))
-            a = c.fetchall()
-            for item in a:
-                geraete.append(item["Bezeichnung"])
 
-        restextrakt = 0
 
-        c.execute("SELECT * FROM Hauptgaerverlauf WHERE SudID = ? ORDER BY Zeitstempel", (sud["ID"],))
-        a = c.fetchall()
-        fermentation_days_hg = None
-        fermentation_temp_hg = None
-        if len(a) > 0:
-            # get FG (in Plato) from last entry of "Hauptgaerverlauf"
-            restextrakt = float(a[-1]["SW"])
-            if sud["BierWurdeAbgefuellt"]:
-                # get fermentation days from first and last entry of "Hauptgaerverlauf"
-                start = datetime.datetime.strptime(a[0]["Zeitstempel"][:10], '%Y-%m-%d')
-                end = datetime.datetime.strptime(a[-1]["Zeitstempel"][:10], '%Y-%m-%d')
-                fermentation_days_hg = (end - start).days
-            fermentation_temp_hg = round(sum(i["Temp"] for i in a) / len(a))
+    def health(self, maxAge=None):
 
-        c.execute("SELECT * FROM Nachgaerverlauf WHERE SudID = ? ORDER BY Zeitstempel", (sud["ID"],))
-        a = c.fetchall()
-        fermentation_days_ng = None
-        fermentation_temp_ng = None
-        if len(a) > 0:
-            if sud["BierWurdeAbgefuellt"]:
-                # get fermentation days from first and last entry of "Nachgaerverlauf"
-                start = datetime.datetime.strptime(a[0]["Zeitstempel"][:10], '%Y-%m-%d')
-                end = datetime.datetime.strptime(a[-1]["Zeitstempel"][:10], '%Y-%m-%d')
-                fermentation_days_ng = (end - start).days
-            fermentation_temp_ng = round(sum(i["Temp"] for i in a) / len(a))
+        """Returns a health document of the sync. The status is "ok"
+        after a successful sync, "failing" if the last sync failed and
+        "stale" if there was no successful sync for maxAge seconds."""
 
-        fermentation_days_sud = None
-        if sud["BierWurdeAbgefuellt"]:
-            # get fermentation days from brew day and bottling/kegging day
-            start = datetime.datetime.strptime(sud["Anstelldatum"], '%Y-%m-%d')
-            end = datetime.datetime.strptime(sud["Abfuelldatum"], '%Y-%m-%d')
-            fermentation_days_sud = (end - start).days
+        now = time.time()
+        last = self.get("grainfather_last_sync_timestamp_seconds")
+        failed = self.get("grainfather_last_sync_failed", 0)
 
-        data = {}
-        brew_data = {}
+        if failed:
+            status = "failing"
+        elif (last is None) or (maxAge and (now - last > maxAge)):
+            status = "stale"
+        else:
+            status = "ok"
 
-        data["name"] = sud["Sudname"].strip()
-        if sud["erg_Alkohol"] > 0:
-            brew_data["source_abv"] = sud["erg_Alkohol"]
-        data["batch_size"] = sud["Menge"]
-        brew_data["ferment_volume_actual"] = sud["WuerzemengeAnstellen"]
+        with self.lock:
+            requests = sum(count for (name, labels), (count, total) in self.summaries.items() if name == "grainfather_request_seconds")
 
-        data["boil_time"] = sud["KochdauerNachBitterhopfung"]
-        brew_data["boil_time"] = data["boil_time"]
-        brew_data["boil_time_actual"] = brew_data["boil_time"]
-        data["planned_og"] = float("%.03f" % Util.platoToGravity(sud["SW"]))
-        #data["og"] = float("%.03f" % Util.platoToGravity(sud["SW"]))
-        brew_data["original_gravity"] = float("%.03f" % Util.platoToGravity(sud["SWAnstellen"]))
-        #data["fg"] = float("%.03f" % Util.platoToGravity(restextrakt)) # TBD
-        brew_data["final_gravity"] = float("%.03f" % Util.platoToGravity(restextrakt))
+        return {
+            "status": status,
+            "uptime": now - self.started,
+            "last_sync": datetime.datetime.fromtimestamp(last).isoformat(timespec="seconds") if last else None,
+            "sync_lag": self.get("grainfather_sync_lag_seconds"),
+            "queue_depth": self.get("grainfather_sync_queue_depth", 0),
+            "requests": requests,
+            "relogins": self.get("grainfather_relogins_total", 0),
+            }
 
-        # I asked Mel at GF chat:
-        # "boil_volume_actual" is meant at the beginning of the boil at 99 °C
-        # "post_boil_volume" is meant at the end of the boil at 99 °C
-        brew_data["post_boil_volume"] = sud["WuerzemengeKochende"]
-        # We calculate expected values based on the KBH formulas:
-        factor = float(sud["highGravityFaktor"])
-        if factor == 0:
-            factor = 1.0
-        vol = float(sud["Menge"]) / factor
-        vol20 = vol + vol * ((float(anlage["Verdampfungsziffer"]) * float(sud["KochdauerNachBitterhopfung"])) / (60 * 100))
-        vol99start = Util.volAtTemp(vol20, 20, 99)
-        brew_data["boil_volume_est"] = float("%.1f" % vol99start)
-        brew_data["boil_volume_actual"] = brew_data["boil_volume_est"]
-        vol99end = Util.volAtTemp(float(sud["Menge"]), 20, 99)
-        brew_data["post_boil_volume"] = float("%.1f" % vol99end)
-        if sud["BierWurdeGebraut"]:
-            extrakt = sud["SWAnstellen"]
-        else:
-            extrakt = sud["SW"]
-        brew_data["pre_boil_gravity"] = float("%.03f" % Util.platoToGravity(extrakt * factor / vol99start * vol99end))
 
-        # formula from https://brauerei.mueggelland.de/vergaerungsgrad.html
-        stammwuerze = float(sud["SWAnstellen"])
-        wfg = 0.1808 * stammwuerze + 0.1892 * restextrakt;
-        d = 261.1 / (261.53 - restextrakt);
-        abw = (stammwuerze - wfg) / (2.0665 - 0.010665 * stammwuerze);
-        kcal = round((6.9 * abw + 4 * ( wfg - 0.1 )) * 10 * 0.1 * d);
-        # we reverse engineered this calories factor
-        #brew_data["calories"] = round(kcal * 3.55) # TBD write to notes?!
-        # dates seem to be overwritten by the GF server
-        data["created_at"] = Util.localToUtc(sud["Erstellt"])
-        #brew_data["created_at"] = data["created_at"] # no, this is actually the brew day
-        brew_data["created_at"] = "%sT00:00:00.000000Z" % sud["Braudatum"][:10]
-        data["updated_at"] = Util.localToUtc(sud["Gespeichert"])
-        brew_data["updated_at"] = data["updated_at"]
-        # pick description from first paragraph of "Kommentar"
-        data["description"] = sud["Kommentar"].splitlines()[0].strip()
-        data["efficiency"] = float("%.2f" % (anlagensudhausausbeute / 100.0)) / 0.8 # TBD recalc factor
-        #brew_data["efficiency"] = float("%.2f" % (sud["erg_Sudhausausbeute"] / 100.0)) / 0.8 # TBD recalc factor --> TBD write to notes
-        data["planned_ibu"] = sud["IBU"] # TBD write to recipe notes?!
 
-        value = float(self.extractFromArray(geraete, "Grainfather Trub and Chiller Loss", "-1").replace(",","."))
-        if value and value >= 0:
-            brew_data["brew_kettle_loss"] = value
-            data["losses"] = brew_data["brew_kettle_loss"]
-        else:
-            if sud["WuerzemengeAnstellen"] > 0 and sud["WuerzemengeVorHopfenseihen"] > 0:
-                brew_data["brew_kettle_loss"] = float("%.1f" % (sud["WuerzemengeVorHopfenseihen"] - sud["WuerzemengeAnstellen"]))
-                if brew_data["brew_kettle_loss"] < 0.0:
-                    brew_data["brew_kettle_loss"] = 2.0 # default losses by trub and chiller
-            else:
-                brew_data["brew_kettle_loss"] = 2.0 # default losses by trub and chiller
-            data["losses"] = brew_data["brew_kettle_loss"] # TBD really identical?!
+METRICS = Metrics()
 
-        value = float(self.extractFromArray(geraete, "Grainfather Wort Shrinkage", "-1").replace(",","."))
-        if value >= 0:
-            brew_data["wort_shrinkage"] = value / 100
 
-        value = float(self.extractFromArray(geraete, "Grainfather Mash Tun Loss", "-1").replace(",","."))
-        if value >= 0:
-            brew_data["mash_tun_loss"] = value
 
-        value = float(self.extractFromArray(geraete, "Grainfather Boil Loss", "-1").replace(",","."))
-        if value >= 0:
-            brew_data["boil_loss"] = value
+class MetricsServer(object):
 
-        value = float(self.extractFromArray(geraete, "Grainfather Grain Absorption", "-1").replace(",","."))
-        if value >= 0:
-            brew_data["mash_grain_absorption"] = value
+    """Serves the METRICS on /metrics in the Prometheus text format and
+    /health as JSON, e.g. for the daemon. The address is host:port
+    (localhost:port if only a port is given) or the path of a Unix
+    socket. The server runs in a background thread."""
 
-        value = float(self.extractFromArray(geraete, "Grainfather Sparge Grain Absorption", "-1").replace(",","."))
-        if value >= 0:
-            brew_data["sparge_grain_absorption"] = value
+    class Handler(http.server.BaseHTTPRequestHandler):
 
-        value = float(self.extractFromText(sud["Kommentar"], "Maische-pH", "-1").replace(",","."))
-        if value >= 0:
-            brew_data["mash_ph"] = value
-        else:
-            value = float(self.extractFromArray(geraete, "Maische-pH", "-1").replace(",","."))
-            if value >= 0:
-                brew_data["mash_ph"] = value
-                
-        brew_data["mash_start_temp"] = sud["EinmaischenTemp"]
-        brew_data["target_mash_temp"] = sud["EinmaischenTemp"]
+        def do_GET(self):
 
-        value = float(self.extractFromArray(geraete, "Grainfather Mash Thickness", "-1").replace(",","."))
-        if value >= 0:
-            brew_data["mash_thickness"] = value
+            path = urllib.parse.urlparse(self.path).path
+            if path == "/metrics":
+                body = self.server.metrics.toPrometheus()
+                self.reply(200, "text/plain; version=0.0.4", body)
+            elif path == "/health":
+                health = self.server.metrics.health(self.server.maxAge)
+                self.reply(200 if health["status"] == "ok" else 503, "application/json", json.dumps(health, indent=4))
+            elif path == "/metrics.json":
+                self.reply(200, "application/json", json.dumps(self.server.metrics.toDict(), indent=4))
+            else:
+                self.reply(404, "text/plain", "not found\n")
 
-        brew_data["grain_temp"] = 20.0 # TBD
+        def reply(self, status, type, body):
 
-        data["notes"] = re.sub(r'\[\[[^\]]*\]\]\n?', r'', sud["Kommentar"]).strip()
-        brew_data["notes"] = "This brew session record has been created by Grainfather.py based on data from Kleiner Brauhelfer."
-        data["source_srm"] = float("%.1f" % (float(sud["erg_Farbe"]) * 0.508))
-        data["bjcp_style_id"] = self.extractFromText(sud["Kommentar"], "BJCP-Style")
-        data["is_active"] = True # what is this?
-        brew_data["is_active"] = True # what is this?
-        data["is_public"] = self.extractFromText(sud["Kommentar"], "Public", default=False)
-        brew_data["is_public"] = data["is_public"]
-        data["unit_type_id"] = UnitType.METRIC.value;
-        brew_data["unit_type_id"] = data["unit_type_id"]
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
-        data["author"] = self.extractFromText(sud["Kommentar"], "Brauer")
-        
-        # fermentables
-        data["fermentables"] = []
-        grain_weight = 0.0
-        c.execute("SELECT * FROM Malzschuettung WHERE SudID = ? ORDER BY Prozent DESC", (sud["ID"],))
-        malze = c.fetchall()
-        for malz in malze:
-            c.execute("SELECT * FROM Malz WHERE Beschreibung = ?", (malz["Name"],))
-            malz0 = c.fetchone()
-            if malz0:
-                ausbeute = self.extractFromText(malz0["Bemerkung"], "Ausbeute", default=80)
-            else:
-                ausbeute = 80
-            ppg = float("%.1f" % (Util.yieldToPpg(ausbeute)))
-            data["fermentables"].append({
-                    "name": malz["Name"],
-                    "ppg": ppg,
-                    "lovibond": float("%.3f" % Util.ebcToLovibond(float(malz["Farbe"]))),
-                    "fermentable_usage_type_id": FermentableUsageType.MASH.value, # kbh supports just mash for "Malz"
-                    "fermentable_id": None,
-                    "amount": float("%.3f" % (malz["erg_Menge"])) })
-            grain_weight += malz["erg_Menge"]
-        # we assume "Weitere Zutaten" with "Ausbeute > 0" are other fermentables
-        c.execute("SELECT * FROM WeitereZutatenGaben WHERE SudID = ? AND Typ != 100 AND Ausbeute > 0 ORDER BY erg_Menge DESC", (sud["ID"],))
-        zutaten = c.fetchall()
-        for zutat in zutaten:
-            if zutat["Zeitpunkt"] == 2:
-                usage = FermentableUsageType.MASH.value
-            elif zutat["Zeitpunkt"] == 1:
-                usage = FermentableUsageType.EXTRACT.value
-            elif zutat["Zeitpunkt"] == 0:
-                usage = FermentableUsageType.LATEADDITION.value
-            ppg = float("%.1f" % (Util.yieldToPpg(float(zutat["Ausbeute"]))))
-            data["fermentables"].append({
-                    "name": zutat["Name"],
-                    "ppg": ppg,
-                    "lovibond": float("%.3f" % Util.ebcToLovibond(float(zutat["Farbe"]))),
-                    "fermentable_usage_type_id": usage,
-                    "fermentable_id": None,
-                    "amount": float("%.3f" % (zutat["erg_Menge"] / 1000)) })
-            grain_weight += zutat["erg_Menge"] / 1000
+        def address_string(self):
 
-        # hops
-        data["hops"] = []
-        # first wort
-        c.execute("SELECT * FROM HopfenGaben WHERE SudID = ? AND Vorderwuerze = 1 ORDER BY erg_Menge DESC", (sud["ID"],))
-        diehopfen = c.fetchall()
-        for hopfen in diehopfen:
-            if hopfen["Pellets"] == 1:
-                typeid = HopType.PELLET.value
-            else:
-                typeid = HopType.LEAF.value
-            data["hops"].append({
-                    "name": hopfen["Name"],
-                    "aa": hopfen["Alpha"],
-                    "hop_type_id": typeid,
-                    "hop_usage_type_id": HopUsageType.FIRSTWORT.value,
-                    "time": data["boil_time"],
-                    "amount": float("%.3f" % (hopfen["erg_Menge"])) })
-        # boil and hopstand
-        c.execute("SELECT * FROM HopfenGaben WHERE SudID = ? AND Vorderwuerze = 0 ORDER BY Zeit DESC", (sud["ID"],))
-        diehopfen = c.fetchall()
-        for hopfen in diehopfen:
-            if hopfen["Pellets"] == 1:
-                typeid = HopType.PELLET.value
-            else:
-                typeid = HopType.LEAF.value
-            if hopfen["Zeit"] == 0:
-                usage = HopUsageType.HOPSTAND.value
-                time = 0
-            elif hopfen["Zeit"] < 0:
-                usage = HopUsageType.HOPSTAND.value
-                time = 0
-            else:
-                usage = HopUsageType.BOIL.value
-                time = hopfen["Zeit"]
-            data["hops"].append({
-                    "name": hopfen["Name"],
-                    "aa": hopfen["Alpha"],
-                    "time": time,
-                    "hop_type_id": typeid,
-                    "hop_usage_type_id": usage,
-                    "amount": float("%.3f" % (hopfen["erg_Menge"])) })
-        # dry hop
-        c.execute("SELECT * FROM WeitereZutatenGaben WHERE SudID = ? AND ( Typ = 100 OR Typ = -1 ) AND Zeitpunkt = 0 ORDER BY erg_Menge DESC", (sud["ID"],))
-        zutaten = c.fetchall()
-        for zutat in zutaten:
-            c.execute("SELECT * FROM Hopfen WHERE Beschreibung = ?", (zutat["Name"],))
-            hopfen = c.fetchone()
-            if hopfen:
-                aa = hopfen["Alpha"]
-                if hopfen["Pellets"] == 1:
-                    typeid = HopType.PELLET.value
-                else:
-                    typeid = HopType.LEAF.value
-            else:
-                aa = 0
-                typeid = HopType.PELLET.value
-            data["hops"].append({
-                    "name": zutat["Name"],
-                    "hop_usage_type_id": HopUsageType.DRYHOP.value,
-                    "aa": aa,
-                    "hop_type_id": typeid,
-                    "unit": "g",
-                    "amount": float("%.3f" % (zutat["erg_Menge"])) })
-            if zutat["Zugabedauer"] > 0:
-                t = zutat["Zugabedauer"]
-                if t >= 1440:
-                    t = round(t / 1440)
-                data["hops"][-1]["time"] = t
-            else:
-                data["hops"][-1]["time"] = 0
+            # Unix sockets have no client address
+            return self.client_address[0] if self.client_address else "local"
 
-        # yeast (kbh supports only one yeast in a recipe)
-        if sud["HefeAnzahlEinheiten"] == 0:
-            data["yeasts"] = []
-        else:
-            data["yeasts"] = [ { "name": sud["AuswahlHefe"], "amount": sud["HefeAnzahlEinheiten"], "unit": "packets" } ]
-            c.execute("SELECT * FROM Hefe WHERE Beschreibung = ?", (sud["AuswahlHefe"],))
-            hefe = c.fetchone()
-            if hefe:
-                data["yeasts"][0]["attenuation"] = int(re.sub(r'^([0-9]+).*$', r'\1', hefe["EVG"])) / 100
-                if hefe["TypTrFl"] == 1:
-                    data["yeasts"][0]["unit"] = "packets"
-                else:
-                    data["yeasts"][0]["unit"] = "vials"
-                try:
-                    amount = float(re.sub(r'^([0-9\.,]*).*$', r'\1', hefe["Verpackungsmenge"]).replace(",","."))
-                    unit = re.sub(r'^[0-9\., ]*(.*)$', r'\1', hefe["Verpackungsmenge"])
-                    if (amount > 0) and (unit in YeastUnitTypes):
-                        data["yeasts"][0]["amount"] = amount * data["yeasts"][0]["amount"]
-                        data["yeasts"][0]["unit"] = unit
-                except:
-                    self.logger.debug("could not convert Hefe Verpackungsmenge \"%s\" to amount and unit" % (hefe["Verpackungsmenge"]))
-                
-        # adjuncts
-        data["adjuncts"] = []
-        c.execute("SELECT * FROM WeitereZutatenGaben WHERE SudID = ? AND Typ != 100 AND Typ != -1 AND Ausbeute <= 0 ORDER BY erg_Menge DESC", (sud["ID"],))
-        zutaten = c.fetchall()
-        for zutat in zutaten:
-            if zutat["Zeitpunkt"] == 2:
-                usage = AdjunctUsageType.MASH.value
-            elif zutat["Zeitpunkt"] == 1:
-                if zutat["Zugabedauer"] == 0:
-                    usage = AdjunctUsageType.FLAMEOUT.value
-                else:
-                    usage = AdjunctUsageType.BOIL.value
-            elif zutat["Zeitpunkt"] == 0:
-                usage = AdjunctUsageType.PRIMARY.value
-            data["adjuncts"].append({
-                    "name": zutat["Name"],
-                    "adjunct_usage_type_id": usage,
-                    "unit": "g",
-                    "amount": float("%.3f" % (zutat["erg_Menge"])) })
-            if zutat["Zugabedauer"] > 0:
-                t = zutat["Zugabedauer"]
-                if t >= 1440:
-                    t = round(t / 1440)
-                data["adjuncts"][-1]["time"] = t
+        def log_message(self, format, *args):
 
-        # mash steps
-        data["mash_steps"] = []
-        i = 0
-        c.execute("SELECT * FROM Rasten WHERE SudID = ?", (sud["ID"],))
-        rasten = c.fetchall()
-        for rast in rasten:
-            data["mash_steps"].append({
-                    "order": i,
-                    "name": rast["RastName"],
-                    "temperature": rast["RastTemp"],
-                    "time": rast["RastDauer"] })
-            i += 1
+            logging.getLogger('metrics').debug(format % args)
 
-        # fermentation steps
-        data["fermentation_steps"] = []
-        i = 0
-        fermentation_string = self.extractFromText(sud["Kommentar"], "Fermentation")
-        if (not fermentation_string) or (fermentation_string[0] == ","):
-            if fermentation_days_sud and (fermentation_days_sud >= 1) and (fermentation_days_sud <= 30):
-                days = fermentation_days_sud
-            elif fermentation_days_hg and (fermentation_days_hg >= 1) and (fermentation_days_hg <= 30):
-                days = fermentation_days_hg
-            else:
-                days = 14
-            if fermentation_temp_hg:
-                temp = fermentation_temp_hg
-            # TBD: fetch temp from KBH Hefe alternatively
-            else:
-                temp = 18
-            data["fermentation_steps"].append({
-                    "order": i,
-                    "name": "Hauptgärung",
-                    "temperature": temp,
-                    "time": days })
-            i += 1
-        if fermentation_string and ":" in fermentation_string and "@" in fermentation_string:
-            steps = fermentation_string.split(",")
-            for step in steps:
-                if ":" in step and "@" in step:
-                    name = step.split(":")[0]
-                    days = step.split(":")[1].split("@")[0].replace(" ", "")
-                    temp = step.split("@")[1].replace(" ", "")
-                    data["fermentation_steps"].append({
-                            "order": i,
-                            "name": name,
-                            "temperature": temp,
-                            "time": days })
-                    i += 1
+    class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+        daemon_threads = True
+
+    def __init__(self, address, metrics=None, maxAge=None):
+
+        self.address = address
+        self.logger = logging.getLogger('metrics')
+
+        if "/" in address:
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = MetricsServer.UnixServer(address, MetricsServer.Handler)
         else:
-            if fermentation_days_ng and (fermentation_days_ng >= 1) and (fermentation_days_ng <= 30):
-                days = fermentation_days_ng
-                if fermentation_temp_ng:
-                    temp = fermentation_temp_ng
-                # TBD: fetch temp from KBH Hefe alternatively
-                else:
-                    temp = 18
-                data["fermentation_steps"].append({
-                        "order": i,
-                        "name": "Nachgärung",
-                        "temperature": temp,
-                        "time": days })
-                i += 1
+            host, sep, port = address.rpartition(":")
+            self.server = http.server.ThreadingHTTPServer((host or "localhost", int(port)), MetricsServer.Handler)
+            self.server.daemon_threads = True
+        self.server.metrics = metrics if metrics is not None else METRICS
+        self.server.maxAge = maxAge
 
-        # brew session
-        #brew_data["created_at"] = data["created_at"]
-        #brew_data["updated_at"] = data["updated_at"]
-        #brew_data["is_active"] = data["is_active"]
-        #brew_data["is_public"] = data["is_public"]
-        #brew_data["unit_type_id"] = data["unit_type_id"]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        self.logger.info("Serving metrics on %s" % (address))
+
+
+
+    def close(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+        if "/" in self.address:
+            os.remove(self.address)
+
+
+
+class Profiler(object):
+
+    """Collects the wall and CPU time of the phases of a command, e.g.
+    the conversion of KBH suds, recalculation, requests and
+    serialization, in spans around the code of each phase. Spans may
+    be nested and used by multiple threads, the self time of a span
+    does not include the time of its inner spans. When disabled, a
+    span costs just a method call. Optionally, the whole command is
+    recorded by cProfile (.pstats) or by sampling the stacks of all
+    threads into a collapsed stack file for flame graphs."""
+
+    class Span(object):
+
+        def __init__(self, profiler, name):
+
+            self.profiler = profiler
+            self.name = name
+            self.inner = [ 0.0, 0.0 ]
+
+        def __enter__(self):
+
+            self.profiler.stack().append(self)
+            self.wall = time.perf_counter()
+            self.cpu = time.thread_time()
+            return self
+
+        def __exit__(self, type, value, traceback):
+
+            wall = time.perf_counter() - self.wall
+            cpu = time.thread_time() - self.cpu
+            stack = self.profiler.stack()
+            stack.pop()
+            if stack:
+                stack[-1].inner[0] += wall
+                stack[-1].inner[1] += cpu
+            self.profiler.record(self.name, wall, cpu, wall - self.inner[0], cpu - self.inner[1])
+            return False
+
+    class NoSpan(object):
+
+        def __enter__(self):
+
+            return self
+
+        def __exit__(self, type, value, traceback):
+
+            return False
+
+    def __init__(self):
+
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.noSpan = Profiler.NoSpan()
+        self.phases = {}	# name -> [calls, wall, cpu, self wall, self cpu]
+        self.output = None
+        self.profile = None
+        self.sampler = None
+        self.samples = collections.Counter()
+
+
+
+    def span(self, name):
+
+        """Returns a context manager measuring a phase."""
+
+        return Profiler.Span(self, name) if self.enabled else self.noSpan
+
+
+
+    def stack(self):
+
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+
+        return self.local.stack
+
+
+
+    def record(self, name, wall, cpu, selfWall, selfCpu):
+
+        with self.lock:
+            phase = self.phases.setdefault(name, [ 0, 0.0, 0.0, 0.0, 0.0 ])
+            phase[0] += 1
+            phase[1] += wall
+            phase[2] += cpu
+            phase[3] += selfWall
+            phase[4] += selfCpu
+
+
+
+    def start(self, output=None, interval=0.005):
+
+        """Enables the spans. If output ends with .pstats, the main
+        thread is also recorded by cProfile, any other output name
+        gets the sampled stacks of all threads in the collapsed format
+        (one line of frames separated by ";" and a count)."""
+
+        self.enabled = True
+        self.output = output
+        self.started = (time.perf_counter(), time.process_time())
+
+        if output and output.endswith(".pstats"):
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif output:
+            self.running = True
+            self.sampler = threading.Thread(target=self.sample, args=(interval,), name="sampler", daemon=True)
+            self.sampler.start()
+
+
+
+    def sample(self, interval):
+
+        me = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append("%s (%s:%d)" % (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples[";".join(reversed(frames))] += 1
+            time.sleep(interval)
+
+
+
+    def stop(self, file=None):
+
+        """Disables the spans, writes the output file, if any, and
+        prints the summary."""
+
+        if not self.enabled:
+            return
+        self.enabled = False
+
+        wall = time.perf_counter() - self.started[0]
+        cpu = time.process_time() - self.started[1]
+
+        if self.profile:
+            self.profile.disable()
+            self.profile.dump_stats(self.output)
+        elif self.sampler:
+            self.running = False
+            self.sampler.join()
+            with open(self.output, "w") as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write("%s %d\n" % (stack, count))
+
+        self.report(wall, cpu, file=file or sys.stderr)
+
+
+
+    def report(self, wall, cpu, file):
+
+        """Prints the phases ranked by their self wall time. The wall
+        time of concurrent spans may add up to more than the total."""
+
+        with self.lock:
+            phases = sorted(self.phases.items(), key=lambda item: -item[1][3])
+
+        print("%-20s %8s %10s %10s %10s %10s %6s" % ("phase", "calls", "wall", "self", "cpu", "self cpu", "%"), file=file)
+        for name, (calls, phaseWall, phaseCpu, selfWall, selfCpu) in phases:
+            print("%-20s %8d %9.3fs %9.3fs %9.3fs %9.3fs %5.1f%%" %
+                  (name, calls, phaseWall, selfWall, phaseCpu, selfCpu, 100 * selfWall / wall if wall else 0), file=file)
+        print("%-20s %8s %9.3fs %10s %9.3fs" % ("total", "", wall, "", cpu), file=file)
+        if self.output:
+            print("Profile written to %s" % (self.output), file=file)
+
+
+
+PROFILER = Profiler()
+
+
+
+class MemoryReport(object):
+
+    """Traces memory allocations of a command by tracemalloc and takes
+    a snapshot at the phase boundaries marked by the commands, e.g.
+    after loading the KBH recipes, after the GF listing, after
+    reloading full recipes and after uploading. For each phase, the
+    report shows the traced memory at its end, its traced peak, the
+    resident set size of the process and its peak during the phase,
+    and the allocation sites that grew most during the phase. The RSS
+    peak is reset per phase on Linux only, elsewhere it is the peak of
+    the process so far, which the report then says."""
+
+    def __init__(self):
+
+        self.enabled = False
+        self.top = 10
+        self.phases = []	# (name, current, peak, rss, max rss, growth)
+        self.previous = None
+        self.perPhase = False
+        self.lock = threading.Lock()
+
+
+
+    def resetPeak(self):
+
+        """Resets the peak resident set size (VmHWM) of the process to
+        its current size, returns False where this is not possible."""
+
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return True
+        except OSError:
+            return False
+
+
+
+    def rss(self):
+
+        """Returns the current and the peak resident set size in bytes,
+        as far as the platform tells."""
+
+        current = None
+        try:
+            with open("/proc/self/statm") as f:
+                current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            pass
+
+        peak = None
+        if self.perPhase:
+            try:
+                with open("/proc/self/status") as f:
+                    for line in f:
+                        if line.startswith("VmHWM:"):
+                            peak = int(line.split()[1]) * 1024
+            except (OSError, ValueError, IndexError):
+                pass
+        elif resource:
+            # kilobytes on Linux, bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak *= 1 if sys.platform == "darwin" else 1024
+
+        return current, peak
+
+
+
+    def start(self, top=10, frames=1):
+
+        self.enabled = True
+        self.top = top
+        tracemalloc.start(frames)
+        self.previous = tracemalloc.take_snapshot()
+        self.perPhase = self.resetPeak()
+
+
+
+    def mark(self, name):
+
+        """Ends a phase with the given name."""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+                ])
+            growth = [ stat for stat in snapshot.compare_to(self.previous, "lineno") if stat.size_diff > 0 ][:self.top]
+            self.previous = snapshot
+            rss, maxRss = self.rss()
+            self.phases.append((name, current, peak, rss, maxRss, growth))
+            if self.perPhase:
+                self.resetPeak()
+
+
+
+    def stop(self, file=None):
+
+        """Ends the last phase, stops tracing and prints the report."""
+
+        if not self.enabled:
+            return
+
+        self.mark("end")
+        self.enabled = False
+        tracemalloc.stop()
+
+        file = file or sys.stderr
+
+        def mb(value):
+            return "%9.1fMB" % (value / 1e6) if value is not None else "%11s" % ("-")
+
+        print("%-20s %11s %11s %11s %11s" % ("phase", "traced", "peak", "rss", "peak rss" if self.perPhase else "rss so far"), file=file)
+        for name, current, peak, rss, maxRss, growth in self.phases:
+            print("%-20s %s %s %s %s" % (name, mb(current), mb(peak), mb(rss), mb(maxRss)), file=file)
+
+        for name, current, peak, rss, maxRss, growth in self.phases:
+            if growth:
+                print("\nLargest growth during %s:" % (name), file=file)
+                for stat in growth:
+                    frame = stat.traceback[0]
+                    print("  %+9.1fkB %8d blocks  %s:%d" % (stat.size_diff / 1e3, stat.count_diff, frame.filename, frame.lineno), file=file)
+
+
+
+MEMORY = MemoryReport()
+
+
+
+class BeerSmith3(object):
+
+    """Representation of a BeerSmith3 database."""
+
+    dir = None
+    pattern = None
+    logger = None
+
+
+
+    def __init__(self, dir, pattern=None):
+
+        """Initialized access to the BeerSmith3 database given by the
+        filesystem directory parameter."""
+
+        self.logger = logging.getLogger('beersmith')
+        self.dir = dir
+        self.pattern = pattern
+
+
+
+    def collectBeerSmithRecipes(self, table):
+
+        """Retrieve a list of all recipes that match the given
+        name pattern in all folders."""
+
+        l = []
+
+        if table.__class__.__name__ != "list":
+            table = [ table ]
+
+        for entry in table:
+            if entry["data"] != None:
+                if (self.pattern in entry["name"]) and (entry["data"] != None):
+                    recipes = entry["data"]["recipe"]
+                    if recipes.__class__.__name__ != "list":
+                        recipes = [ recipes ]
+                    for recipe in recipes:
+                        l.append(recipe)
+                if "table" in entry["data"]:
+                    l.extend(self.collectBeerSmithRecipes(entry["data"]["table"]))
+
+        return l
+
+
+
+    def dictToRecipe(self, bs):
+
+        """Converts a BeerSmith3 recipe dict into a Recipe object."""
+
+        data = {}
+        brew_data = {}
+
+        data["name"] = bs["f_r_name"]
+
+        data["og"] = float("%.3f" % float(bs["f_r_desired_og"]))
+        data["ibu"] = round(float(bs["f_r_desired_ibu"]))
+        data["srm"] = float("%.1f" % float(bs["f_r_desired_color"]))
+
+        data["is_active"] = True # what is this?
+        data["is_public"] = True # could we allow adjustment in BeerSmith3 somehow?
+        data["notes"] = bs["f_r_notes"]
+        data["description"] = bs["f_r_description"]
+        data["efficiency"] = float(bs["f_r_equipment"]["f_e_efficiency"]) / 100 # percent -> fraction
+        data["created_at"] = bs["agedata"]["_mod_"] + "T00:00:00.000000Z"
+        data["updated_at"] = bs["_mod_"] + "T00:00:00.000000Z"
+        data["batch_size"] = float("%.2f" % (float(bs["f_r_equipment"]["f_e_batch_vol"]) * 0.0295735)) # fl oz -> l
+        data["boil_size"] = float("%.2f" % (float(bs["f_r_equipment"]["f_e_boil_vol"]) * 0.0295735)) # TBD: at start or end of boil?
+        data["boil_time"] = round(float(bs["f_r_equipment"]["f_e_boil_time"]))
+        data["losses"] = float("%.02f" % (float(bs["f_r_equipment"]["f_e_trub_loss"]) * 0.0295735))
+        data["unit_type_id"] = UnitType.METRIC.value; # TBD: we could derive the unit type from BeerSmith options
+        if bs["f_r_style"]["f_s_guide"] == "BJCP 2015":
+            data["bjcp_style_id"] = "%s%s" % (bs["f_r_style"]["f_s_number"], chr(64+int(bs["f_r_style"]["f_s_letter"])))
+
+        # ingredients
+        if ("ingredients" in bs) and ("data" in bs["ingredients"]):
+            # fermentables
+            data["fermentables"] = []
+            grain_weight = 0.0
+            if ("grain" in bs["ingredients"]["data"]):
+                grains = bs["ingredients"]["data"]["grain"]
+                if grains.__class__.__name__ != "list":
+                    grains = [ grains ]
+                for grain in grains:
+                    if int(grain["f_g_use"]) == 0: # mash
+                        usageType = FermentableUsageType.MASH.value
+                    elif int(grain["f_g_use"]) == 1: # steep
+                        usageType = FermentableUsageType.STEEP.value
+                    elif int(grain["f_g_use"]) == 2: # boil
+                        usageType = FermentableUsageType.EXTRACT.value
+                    elif int(grain["f_g_use"]) >= 3: # whirlpool, or later
+                        usageType = FermentableUsageType.LATEADDITION.value
+                    else:
+                        usageType = FermentableUsageType.MASH.value # default
+                    data["fermentables"].append({
+                            "name": grain["f_g_name"],
+                            "ppg": float("%.1f" % (Util.yieldToPpg(float(grain["f_g_yield"])))),
+                            "lovibond": float("%.02f" % (float(grain["f_g_color"]))), # lovibond
+                            "fermentable_usage_type_id": usageType,
+                            "fermentable_id": None,
+                            "amount": float("%.03f" % (float(grain["f_g_amount"]) * 0.0283495))  # oz -> kg
+                            })
+                    grain_weight += (float(grain["f_g_amount"]) * 0.0283495) # in kg
+
+            # hops
+            data["hops"] = []
+            if ("hops" in bs["ingredients"]["data"]):
+                hops = bs["ingredients"]["data"]["hops"]
+                if hops.__class__.__name__ != "list":
+                    hops = [ hops ]
+                for hop in hops:
+                    if int(hop["f_h_form"]) == 0: # pellet
+                        typeid = HopType.PELLET.value
+                    elif int(hop["f_h_form"]) == 1: # plug
+                        typeid = HopType.PLUG.value
+                    elif int(hop["f_h_form"]) == 2: # leaf
+                        typeid = HopType.LEAF.value
+                    elif int(hop["f_h_form"]) >= 3: # extract, other form of extract
+                        typeid = HopType.EXTRACT.value
+                    else:
+                        typeid = HopType.PELLET.value # default
+                    time = round(float(hop["f_h_boil_time"]))
+                    if int(hop["f_h_use"]) == 0: # boil
+                        usageType = HopUsageType.BOIL.value
+                    elif int(hop["f_h_use"]) == 1: # dry hop
+                        usageType = HopUsageType.DRYHOP.value
+                        time = round(float(hop["f_h_dry_hop_time"]))
+                    elif int(hop["f_h_use"]) == 2: # mash
+                        usageType = HopUsageType.MASH.value
+                    elif int(hop["f_h_use"]) == 3: # first wort
+                        usageType = HopUsageType.FIRSTWORT.value
+                    elif int(hop["f_h_use"]) == 4: # steep / whirlpool
+                        usageType = HopUsageType.HOPSTAND.value
+                    else:
+                        usageType = HopUsageType.BOIL.value # default
+                    data["hops"].append({
+                            "name": hop["f_h_name"],
+                            "aa": float("%.01f" % (float(hop["f_h_alpha"]))),
+                            "hop_type_id": typeid,
+                            "hop_usage_type_id": usageType,
+                            "time": time,
+                            "amount": float("%.1f" % (float(hop["f_h_amount"]) * 28.3495)) # oz -> g
+                            })
+
+            # yeasts
+            data["yeasts"] = []
+            if ("yeast" in bs["ingredients"]["data"]):
+                yeasts = bs["ingredients"]["data"]["yeast"]
+                if yeasts.__class__.__name__ != "list":
+                    yeasts = [ yeasts ]
+                for yeast in yeasts:
+                    name = yeast["f_y_name"]
+                    if yeast["f_y_product_id"] and len(yeast["f_y_product_id"]) > 0:
+                        name = name + " " + yeast["f_y_product_id"]
+                    if yeast["f_y_lab"] and len(yeast["f_y_lab"]) > 0:
+                        name = yeast["f_y_lab"] + " " + name
+                    data["yeasts"].append({
+                            "name": name,
+                            "unit": "packets",
+                            "attenuation": float("%.02f" % (float(yeast["f_y_max_attenuation"]) / 100)),
+                            "amount": float("%.1f" % (float(yeast["f_y_amount"])))
+                            })
+                
+            # adjuncts
+            data["adjuncts"] = []
+            if ("misc" in bs["ingredients"]["data"]):
+                miscs = bs["ingredients"]["data"]["misc"]
+                if miscs.__class__.__name__ != "list":
+                    miscs = [ miscs ]
+                for misc in miscs:
+                    if int(misc["f_m_units"]) == 0:
+                        unit = "mg"
+                    elif int(misc["f_m_units"]) == 1:
+                        unit = "g"
+                    elif int(misc["f_m_units"]) == 2:
+                        unit = "oz"
+                    elif int(misc["f_m_units"]) == 3:
+                        unit = "lb"
+                    elif int(misc["f_m_units"]) == 4:
+                        unit = "kg"
+                    elif int(misc["f_m_units"]) == 5:
+                        unit = "ml"
+                    elif int(misc["f_m_units"]) == 6:
+                        unit = "tsp"
+                    elif int(misc["f_m_units"]) == 7:
+                        unit = "tbsp"
+                    elif int(misc["f_m_units"]) == 8:
+                        unit = "cup"
+                    elif int(misc["f_m_units"]) == 9:
+                        unit = "pt"
+                    elif int(misc["f_m_units"]) == 10:
+                        unit = "qt"
+                    elif int(misc["f_m_units"]) == 11:
+                        unit = "l"
+                    elif int(misc["f_m_units"]) == 12:
+                        unit = "gal"
+                    elif int(misc["f_m_units"]) == 13:
+                        unit = "items"
+                    else:
+                        unit = "units"
+                    time = float(misc["f_m_time"])
+                    if int(misc["f_m_use"]) == 0: # boil
+                        if time == 0:
+                            usageType = AdjunctUsageType.FLAMEOUT.value
+                        else:
+                            usageType = AdjunctUsageType.BOIL.value
+                    elif int(misc["f_m_use"]) == 1: # mash
+                        usageType = AdjunctUsageType.MASH.value
+                    elif int(misc["f_m_use"]) == 2: # primary
+                        usageType = AdjunctUsageType.PRIMARY.value
+                    elif int(misc["f_m_use"]) == 3: # secondary
+                        usageType = AdjunctUsageType.SECONDARY.value
+                    elif int(misc["f_m_use"]) == 4: # bottling
+                        usageType = AdjunctUsageType.BOTTLE.value
+                    elif int(misc["f_m_use"]) == 5: # sparge
+                        usageType = AdjunctUsageType.SPARGE.value
+                    else:
+                        usageType = AdjunctUsageType.BOIL.value
+                    data["adjuncts"].append({
+                            "name": misc["f_m_name"],
+                            "adjunct_usage_type_id": usageType,
+                            "unit": unit,
+                            "amount": float("%.2f" % (float(misc["f_m_amount"]))),
+                            "time": time
+                            })
+
+        # mash
+        if ("f_r_mash" in bs) and ("steps" in bs["f_r_mash"]) and ("data" in bs["f_r_mash"]["steps"]) and ("mashstep" in bs["f_r_mash"]["steps"]["data"]):
+            # mash steps
+            data["mash_steps"] = []
+            steps = bs["f_r_mash"]["steps"]["data"]["mashstep"]
+            if steps.__class__.__name__ != "list":
+                steps = [ steps ]
+            i = 0
+            for step in steps:
+                data["mash_steps"].append({
+                        "order": i,
+                        "name": step["f_ms_name"],
+                        "temperature": round(Util.fToC(float(step["f_ms_step_temp"]))),
+                        "time": round(float(step["f_ms_step_time"]))
+                        })
+                i += 1
+
+        # fermentation steps
+        data["fermentation_steps"] = []
+        if "f_r_age" in bs:
+            i = 0
+            a = bs["f_r_age"]
+            n = a["f_a_name"]
+            if int(a["f_a_type"]) >= 0:
+                data["fermentation_steps"].append({
+                        "order": i,
+                        "name": n + ", Primary",
+                        "temperature": round(Util.fToC(float(a["f_a_prim_temp"]))),
+                        "time": round(float(a["f_a_prim_days"]))
+                        })
+                i += 1
+            if int(a["f_a_type"]) >= 1:
+                data["fermentation_steps"].append({
+                        "order": i,
+                        "name": n + ", Secondary",
+                        "temperature": round(Util.fToC(float(a["f_a_sec_temp"]))),
+                        "time": round(float(a["f_a_sec_days"]))
+                        })
+                i += 1
+            if int(a["f_a_type"]) >= 2:
+                data["fermentation_steps"].append({
+                        "order": i,
+                        "name": n + ", Tertiary",
+                        "temperature": round(Util.fToC(float(a["f_a_tert_temp"]))),
+                        "time": round(float(a["f_a_tert_days"]))
+                        })
+                i += 1
+            if float(a["f_a_age"]) > 0:
+                ageSuffix = ""
+                if a["f_a_age_temp"] != a["f_a_end_age_temp"]:
+                    ageSuffix = " (end temp %s°C)" % (round(Util.fToC(float(a["f_a_end_age_temp"]))))
+                data["fermentation_steps"].append({
+                        "order": i,
+                          "name": n + ", Age" + ageSuffix,
+                          "temperature": round(Util.fToC(float(a["f_a_age_temp"]))),
+                          "time": round(float(a["f_a_age"]))
+                          })
+            
+        # finally create the Recipe and Brew objects from the dicts
+        r = Recipe(data=data, brew_data=brew_data)
+
+        r.recalculate(force=True)
+
+        return r
+
+
+
+    def getRecipes(self, namepattern="*"):
+
+        """Retrieves an array of Recipe objects from the BeerSmith3
+        database based on an optional name pattern."""
+
+        return list(self.iterRecipes(namepattern))
+
+
+
+    def iterRecipes(self, namepattern="*"):
+
+        """Like getRecipes(), but yields the Recipe objects one by one.
+        The XML file is still parsed as a whole."""
+
+        # BeerSmith XML is no real XML :-( - use HTML parser to allow HTML entities
+        parser = lxml.etree.HTMLParser(recover=True)
+
+        # recent libxml2 HTML parsers drop tags starting with "_", so
+        # <_MOD_> is renamed while parsing and mapped back afterwards
+        with open("%s/Recipe.bsmx" % (self.dir), "rb") as f:
+            text = re.sub(rb'<(/?)_MOD_>', rb'<\1mod_>', f.read())
+        tree = lxml.etree.fromstring(text, parser=parser).getroottree()
+        b = lxml.etree.tostring(tree.getroot(), method="xml")
+        doc = xmltodict.parse(b.decode("utf-8"), postprocessor=lambda path, key, value: ("_mod_" if key == "mod_" else key, value))
+        bs_recipes = self.collectBeerSmithRecipes(doc["html"]["body"]["recipe"]["data"]["table"])
+
+        bs_recipes = list(filter(lambda r: fnmatch.fnmatch(r["f_r_name"], namepattern), bs_recipes))
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(json.dumps(bs_recipes, sort_keys=True, indent=4))
+
+        for bs_recipe in bs_recipes:
+            t = time.perf_counter()
+            with PROFILER.span("dictToRecipe"):
+                recipe = self.dictToRecipe(bs_recipe)
+            METRICS.observe("grainfather_conversion_seconds", time.perf_counter() - t, source="beersmith")
+            yield recipe
+
+
+
+    def getRecipe(self, namepattern):
+
+        """Retrieves one Recipe object from the BeerSmith3 database
+        based on a name pattern."""
+
+        recipes = self.getRecipes(namepattern)
+
+        if len(recipes) == 0:
+            self.logger.warn("pattern did not result in any entry")
+            return None
+
+        if len(recipes) > 1:
+            self.logger.warn("pattern did not result in a unique entry")
+            return None
+
+        return recipes[0]
+
+
+
+class KleinerBrauhelfer(object):
+
+    """Representation of a "Kleiner Brauhelfer" database."""
+
+    path = None
+    conn = None
+    logger = None
+
+
+
+    def __init__(self, path):
+
+        """Opens the KBH SQlite3 database given by the filesystem path parameter."""
+
+        self.logger = logging.getLogger('kbh')
+        self.path = path
+
+        self.reopen()
+
+
+
+    def reopen(self):
+
+        if self.conn:
+            self.conn.close()
+
+        fd = os.open(self.path, os.O_RDONLY)
+        os.close(fd)
+        self.conn = sqlite3.connect(self.path, uri=True)
+        self.conn.row_factory = sqlite3.Row
+
+
+
+    def extractFromArray(self, array, tag, default=None):
+
+        """Extracts a value from a given array of texts addressed by a given tag.
+        This is used to encode some special attributes in KBH comment fields
+        that are not otherwise represented in the KBH database. E.g.
+        some equipment profile attributes stored in separate rows of "Geraete"."""
+
+        value = default
+        
+        for line in array:
+            if ("[[%s:" % (tag)) in line:
+                pattern = r'^.*\[\[' + re.escape(tag) + r' *: *([^\]]*)\]\].*$'
+                value = re.sub(pattern, r'\1', line, re.IGNORECASE)
+
+        if default != None:
+
+            if default.__class__.__name__ == "bool":
+                if str(value).lower() in [ "1", "true", "y", "yes", "ja" ]:
+                    value = True
+                #if str(value).lower() in [ "0", "false", "n", "no", "nein" ]:
+                else:
+                    value = False
+
+            if (default.__class__.__name__ == "int") or (default.__class__.__name__ == "float"):
+                value = float(str(value).replace(",","."))
+                    
+        return value
+
+
+
+    def extractFromText(self, text, tag, default=None):
+
+        """Extracts a value from a given text addressed by a given tag.
+        This is used to encode some special attributes in KBH comment fields
+        that are not otherwise represented in the KBH database. E.g.
+        the substring "[[BJCP-Style: 7B]]" in a recipe comment may be
+        converted to an according Grainfather recipe attribute."""
+
+        value = default
+        
+        for line in text.splitlines():
+            if ("[[%s:" % (tag)) in line:
+                pattern = r'^.*\[\[' + re.escape(tag) + r' *: *([^\]]*)\]\].*$'
+                value = re.sub(pattern, r'\1', line, re.IGNORECASE)
+
+        if default != None:
+
+            if default.__class__.__name__ == "bool":
+                if str(value).lower() in [ "1", "true", "y", "yes", "ja" ]:
+                    value = True
+                #if str(value).lower() in [ "0", "false", "n", "no", "nein" ]:
+                else:
+                    value = False
+
+            if (default.__class__.__name__ == "int") or (default.__class__.__name__ == "float"):
+                value = float(str(value).replace(",","."))
+                    
+        return value
+
+
+
+    def sudToRecipe(self, sud, recalculate=True):
+
+        """Converts a "sud" read from the KBH database into a Recipe object.
+        Subsequent readings from the database will be issued to fill the
+        Recipe object with as much useful information as passible."""
+
+        c = self.conn.cursor()
+
+        c.execute("SELECT * FROM Ausruestung WHERE Name = ?", (sud["AuswahlBrauanlageName"],))
+        a = c.fetchall()
+        if len(a) > 0:
+            anlage = a[0]
+            anlagensudhausausbeute = anlage["Sudhausausbeute"]
+            anlagenid = anlage["AnlagenID"]
+        else:
+            anlage = {}
+            anlagensudhausausbeute = 62 # TBD estimate
+            anlagenid = None
+
+        geraete = []
+        if anlagenid:
+            c.execute("SELECT * FROM Geraete WHERE AusruestungAnlagenID = ?", (anlagenid,))
+            a = c.fetchall()
+            for item in a:
+                geraete.append(item["Bezeichnung"])
+
+        restextrakt = 0
+
+        c.execute("SELECT * FROM Hauptgaerverlauf WHERE SudID = ? ORDER BY Zeitstempel", (sud["ID"],))
+        a = c.fetchall()
+        fermentation_days_hg = None
+        fermentation_temp_hg = None
+        if len(a) > 0:
+            # get FG (in Plato) from last entry of "Hauptgaerverlauf"
+            restextrakt = float(a[-1]["SW"])
+            if sud["BierWurdeAbgefuellt"]:
+                # get fermentation days from first and last entry of "Hauptgaerverlauf"
+                start = datetime.datetime.strptime(a[0]["Zeitstempel"][:10], '%Y-%m-%d')
+                end = datetime.datetime.strptime(a[-1]["Zeitstempel"][:10], '%Y-%m-%d')
+                fermentation_days_hg = (end - start).days
+            fermentation_temp_hg = round(sum(i["Temp"] for i in a) / len(a))
+
+        c.execute("SELECT * FROM Nachgaerverlauf WHERE SudID = ? ORDER BY Zeitstempel", (sud["ID"],))
+        a = c.fetchall()
+        fermentation_days_ng = None
+        fermentation_temp_ng = None
+        if len(a) > 0:
+            if sud["BierWurdeAbgefuellt"]:
+                # get fermentation days from first and last entry of "Nachgaerverlauf"
+                start = datetime.datetime.strptime(a[0]["Zeitstempel"][:10], '%Y-%m-%d')
+                end = datetime.datetime.strptime(a[-1]["Zeitstempel"][:10], '%Y-%m-%d')
+                fermentation_days_ng = (end - start).days
+            fermentation_temp_ng = round(sum(i["Temp"] for i in a) / len(a))
+
+        fermentation_days_sud = None
+        if sud["BierWurdeAbgefuellt"]:
+            # get fermentation days from brew day and bottling/kegging day
+            start = datetime.datetime.strptime(sud["Anstelldatum"], '%Y-%m-%d')
+            end = datetime.datetime.strptime(sud["Abfuelldatum"], '%Y-%m-%d')
+            fermentation_days_sud = (end - start).days
+
+        data = {}
+        brew_data = {}
+
+        data["name"] = sud["Sudname"].strip()
+        if sud["erg_Alkohol"] > 0:
+            brew_data["source_abv"] = sud["erg_Alkohol"]
+        data["batch_size"] = sud["Menge"]
+        brew_data["ferment_volume_actual"] = sud["WuerzemengeAnstellen"]
+
+        data["boil_time"] = sud["KochdauerNachBitterhopfung"]
+        brew_data["boil_time"] = data["boil_time"]
+        brew_data["boil_time_actual"] = brew_data["boil_time"]
+        data["planned_og"] = float("%.03f" % Util.platoToGravity(sud["SW"]))
+        #data["og"] = float("%.03f" % Util.platoToGravity(sud["SW"]))
+        brew_data["original_gravity"] = float("%.03f" % Util.platoToGravity(sud["SWAnstellen"]))
+        #data["fg"] = float("%.03f" % Util.platoToGravity(restextrakt)) # TBD
+        brew_data["final_gravity"] = float("%.03f" % Util.platoToGravity(restextrakt))
+
+        # I asked Mel at GF chat:
+        # "boil_volume_actual" is meant at the beginning of the boil at 99 °C
+        # "post_boil_volume" is meant at the end of the boil at 99 °C
+        brew_data["post_boil_volume"] = sud["WuerzemengeKochende"]
+        # We calculate expected values based on the KBH formulas:
+        factor = float(sud["highGravityFaktor"])
+        if factor == 0:
+            factor = 1.0
+        vol = float(sud["Menge"]) / factor
+        vol20 = vol + vol * ((float(anlage["Verdampfungsziffer"]) * float(sud["KochdauerNachBitterhopfung"])) / (60 * 100))
+        vol99start = Util.volAtTemp(vol20, 20, 99)
+        brew_data["boil_volume_est"] = float("%.1f" % vol99start)
+        brew_data["boil_volume_actual"] = brew_data["boil_volume_est"]
+        vol99end = Util.volAtTemp(float(sud["Menge"]), 20, 99)
+        brew_data["post_boil_volume"] = float("%.1f" % vol99end)
+        if sud["BierWurdeGebraut"]:
+            extrakt = sud["SWAnstellen"]
+        else:
+            extrakt = sud["SW"]
+        brew_data["pre_boil_gravity"] = float("%.03f" % Util.platoToGravity(extrakt * factor / vol99start * vol99end))
+
+        # formula from https://brauerei.mueggelland.de/vergaerungsgrad.html
+        stammwuerze = float(sud["SWAnstellen"])
+        wfg = 0.1808 * stammwuerze + 0.1892 * restextrakt;
+        d = 261.1 / (261.53 - restextrakt);
+        abw = (stammwuerze - wfg) / (2.0665 - 0.010665 * stammwuerze);
+        kcal = round((6.9 * abw + 4 * ( wfg - 0.1 )) * 10 * 0.1 * d);
+        # we reverse engineered this calories factor
+        #brew_data["calories"] = round(kcal * 3.55) # TBD write to notes?!
+        # dates seem to be overwritten by the GF server
+        data["created_at"] = Util.localToUtc(sud["Erstellt"])
+        #brew_data["created_at"] = data["created_at"] # no, this is actually the brew day
+        brew_data["created_at"] = "%sT00:00:00.000000Z" % sud["Braudatum"][:10]
+        data["updated_at"] = Util.localToUtc(sud["Gespeichert"])
+        brew_data["updated_at"] = data["updated_at"]
+        # pick description from first paragraph of "Kommentar"
+        data["description"] = sud["Kommentar"].splitlines()[0].strip()
+        data["efficiency"] = float("%.2f" % (anlagensudhausausbeute / 100.0)) / 0.8 # TBD recalc factor
+        #brew_data["efficiency"] = float("%.2f" % (sud["erg_Sudhausausbeute"] / 100.0)) / 0.8 # TBD recalc factor --> TBD write to notes
+        data["planned_ibu"] = sud["IBU"] # TBD write to recipe notes?!
+
+        value = float(self.extractFromArray(geraete, "Grainfather Trub and Chiller Loss", "-1").replace(",","."))
+        if value and value >= 0:
+            brew_data["brew_kettle_loss"] = value
+            data["losses"] = brew_data["brew_kettle_loss"]
+        else:
+            if sud["WuerzemengeAnstellen"] > 0 and sud["WuerzemengeVorHopfenseihen"] > 0:
+                brew_data["brew_kettle_loss"] = float("%.1f" % (sud["WuerzemengeVorHopfenseihen"] - sud["WuerzemengeAnstellen"]))
+                if brew_data["brew_kettle_loss"] < 0.0:
+                    brew_data["brew_kettle_loss"] = 2.0 # default losses by trub and chiller
+            else:
+                brew_data["brew_kettle_loss"] = 2.0 # default losses by trub and chiller
+            data["losses"] = brew_data["brew_kettle_loss"] # TBD really identical?!
+
+        value = float(self.extractFromArray(geraete, "Grainfather Wort Shrinkage", "-1").replace(",","."))
+        if value >= 0:
+            brew_data["wort_shrinkage"] = value / 100
+
+        value = float(self.extractFromArray(geraete, "Grainfather Mash Tun Loss", "-1").replace(",","."))
+        if value >= 0:
+            brew_data["mash_tun_loss"] = value
+
+        value = float(self.extractFromArray(geraete, "Grainfather Boil Loss", "-1").replace(",","."))
+        if value >= 0:
+            brew_data["boil_loss"] = value
+
+        value = float(self.extractFromArray(geraete, "Grainfather Grain Absorption", "-1").replace(",","."))
+        if value >= 0:
+            brew_data["mash_grain_absorption"] = value
+
+        value = float(self.extractFromArray(geraete, "Grainfather Sparge Grain Absorption", "-1").replace(",","."))
+        if value >= 0:
+            brew_data["sparge_grain_absorption"] = value
+
+        value = float(self.extractFromText(sud["Kommentar"], "Maische-pH", "-1").replace(",","."))
+        if value >= 0:
+            brew_data["mash_ph"] = value
+        else:
+            value = float(self.extractFromArray(geraete, "Maische-pH", "-1").replace(",","."))
+            if value >= 0:
+                brew_data["mash_ph"] = value
+                
+        brew_data["mash_start_temp"] = sud["EinmaischenTemp"]
+        brew_data["target_mash_temp"] = sud["EinmaischenTemp"]
+
+        value = float(self.extractFromArray(geraete, "Grainfather Mash Thickness", "-1").replace(",","."))
+        if value >= 0:
+            brew_data["mash_thickness"] = value
+
+        brew_data["grain_temp"] = 20.0 # TBD
+
+        data["notes"] = re.sub(r'\[\[[^\]]*\]\]\n?', r'', sud["Kommentar"]).strip()
+        brew_data["notes"] = "This brew session record has been created by Grainfather.py based on data from Kleiner Brauhelfer."
+        data["source_srm"] = float("%.1f" % (float(sud["erg_Farbe"]) * 0.508))
+        data["bjcp_style_id"] = self.extractFromText(sud["Kommentar"], "BJCP-Style")
+        data["is_active"] = True # what is this?
+        brew_data["is_active"] = True # what is this?
+        data["is_public"] = self.extractFromText(sud["Kommentar"], "Public", default=False)
+        brew_data["is_public"] = data["is_public"]
+        data["unit_type_id"] = UnitType.METRIC.value;
+        brew_data["unit_type_id"] = data["unit_type_id"]
+
+        data["author"] = self.extractFromText(sud["Kommentar"], "Brauer")
+        
+        # fermentables
+        data["fermentables"] = []
+        grain_weight = 0.0
+        c.execute("SELECT * FROM Malzschuettung WHERE SudID = ? ORDER BY Prozent DESC", (sud["ID"],))
+        malze = c.fetchall()
+        for malz in malze:
+            c.execute("SELECT * FROM Malz WHERE Beschreibung = ?", (malz["Name"],))
+            malz0 = c.fetchone()
+            if malz0:
+                ausbeute = self.extractFromText(malz0["Bemerkung"], "Ausbeute", default=80)
+            else:
+                ausbeute = 80
+            ppg = float("%.1f" % (Util.yieldToPpg(ausbeute)))
+            data["fermentables"].append({
+                    "name": malz["Name"],
+                    "ppg": ppg,
+                    "lovibond": float("%.3f" % Util.ebcToLovibond(float(malz["Farbe"]))),
+                    "fermentable_usage_type_id": FermentableUsageType.MASH.value, # kbh supports just mash for "Malz"
+                    "fermentable_id": None,
+                    "amount": float("%.3f" % (malz["erg_Menge"])) })
+            grain_weight += malz["erg_Menge"]
+        # we assume "Weitere Zutaten" with "Ausbeute > 0" are other fermentables
+        c.execute("SELECT * FROM WeitereZutatenGaben WHERE SudID = ? AND Typ != 100 AND Ausbeute > 0 ORDER BY erg_Menge DESC", (sud["ID"],))
+        zutaten = c.fetchall()
+        for zutat in zutaten:
+            if zutat["Zeitpunkt"] == 2:
+                usage = FermentableUsageType.MASH.value
+            elif zutat["Zeitpunkt"] == 1:
+                usage = FermentableUsageType.EXTRACT.value
+            elif zutat["Zeitpunkt"] == 0:
+                usage = FermentableUsageType.LATEADDITION.value
+            ppg = float("%.1f" % (Util.yieldToPpg(float(zutat["Ausbeute"]))))
+            data["fermentables"].append({
+                    "name": zutat["Name"],
+                    "ppg": ppg,
+                    "lovibond": float("%.3f" % Util.ebcToLovibond(float(zutat["Farbe"]))),
+                    "fermentable_usage_type_id": usage,
+                    "fermentable_id": None,
+                    "amount": float("%.3f" % (zutat["erg_Menge"] / 1000)) })
+            grain_weight += zutat["erg_Menge"] / 1000
+
+        # hops
+        data["hops"] = []
+        # first wort
+        c.execute("SELECT * FROM HopfenGaben WHERE SudID = ? AND Vorderwuerze = 1 ORDER BY erg_Menge DESC", (sud["ID"],))
+        diehopfen = c.fetchall()
+        for hopfen in diehopfen:
+            if hopfen["Pellets"] == 1:
+                typeid = HopType.PELLET.value
+            else:
+                typeid = HopType.LEAF.value
+            data["hops"].append({
+                    "name": hopfen["Name"],
+                    "aa": hopfen["Alpha"],
+                    "hop_type_id": typeid,
+                    "hop_usage_type_id": HopUsageType.FIRSTWORT.value,
+                    "time": data["boil_time"],
+                    "amount": float("%.3f" % (hopfen["erg_Menge"])) })
+        # boil and hopstand
+        c.execute("SELECT * FROM HopfenGaben WHERE SudID = ? AND Vorderwuerze = 0 ORDER BY Zeit DESC", (sud["ID"],))
+        diehopfen = c.fetchall()
+        for hopfen in diehopfen:
+            if hopfen["Pellets"] == 1:
+                typeid = HopType.PELLET.value
+            else:
+                typeid = HopType.LEAF.value
+            if hopfen["Zeit"] == 0:
+                usage = HopUsageType.HOPSTAND.value
+                time = 0
+            elif hopfen["Zeit"] < 0:
+                usage = HopUsageType.HOPSTAND.value
+                time = 0
+            else:
+                usage = HopUsageType.BOIL.value
+                time = hopfen["Zeit"]
+            data["hops"].append({
+                    "name": hopfen["Name"],
+                    "aa": hopfen["Alpha"],
+                    "time": time,
+                    "hop_type_id": typeid,
+                    "hop_usage_type_id": usage,
+                    "amount": float("%.3f" % (hopfen["erg_Menge"])) })
+        # dry hop
+        c.execute("SELECT * FROM WeitereZutatenGaben WHERE SudID = ? AND ( Typ = 100 OR Typ = -1 ) AND Zeitpunkt = 0 ORDER BY erg_Menge DESC", (sud["ID"],))
+        zutaten = c.fetchall()
+        for zutat in zutaten:
+            c.execute("SELECT * FROM Hopfen WHERE Beschreibung = ?", (zutat["Name"],))
+            hopfen = c.fetchone()
+            if hopfen:
+                aa = hopfen["Alpha"]
+                if hopfen["Pellets"] == 1:
+                    typeid = HopType.PELLET.value
+                else:
+                    typeid = HopType.LEAF.value
+            else:
+                aa = 0
+                typeid = HopType.PELLET.value
+            data["hops"].append({
+                    "name": zutat["Name"],
+                    "hop_usage_type_id": HopUsageType.DRYHOP.value,
+                    "aa": aa,
+                    "hop_type_id": typeid,
+                    "unit": "g",
+                    "amount": float("%.3f" % (zutat["erg_Menge"])) })
+            if zutat["Zugabedauer"] > 0:
+                t = zutat["Zugabedauer"]
+                if t >= 1440:
+                    t = round(t / 1440)
+                data["hops"][-1]["time"] = t
+            else:
+                data["hops"][-1]["time"] = 0
+
+        # yeast (kbh supports only one yeast in a recipe)
+        if sud["HefeAnzahlEinheiten"] == 0:
+            data["yeasts"] = []
+        else:
+            data["yeasts"] = [ { "name": sud["AuswahlHefe"], "amount": sud["HefeAnzahlEinheiten"], "unit": "packets" } ]
+            c.execute("SELECT * FROM Hefe WHERE Beschreibung = ?", (sud["AuswahlHefe"],))
+            hefe = c.fetchone()
+            if hefe:
+                data["yeasts"][0]["attenuation"] = int(re.sub(r'^([0-9]+).*$', r'\1', hefe["EVG"])) / 100
+                if hefe["TypTrFl"] == 1:
+                    data["yeasts"][0]["unit"] = "packets"
+                else:
+                    data["yeasts"][0]["unit"] = "vials"
+                try:
+                    amount = float(re.sub(r'^([0-9\.,]*).*$', r'\1', hefe["Verpackungsmenge"]).replace(",","."))
+                    unit = re.sub(r'^[0-9\., ]*(.*)$', r'\1', hefe["Verpackungsmenge"])
+                    if (amount > 0) and (unit in YeastUnitTypes):
+                        data["yeasts"][0]["amount"] = amount * data["yeasts"][0]["amount"]
+                        data["yeasts"][0]["unit"] = unit
+                except:
+                    self.logger.debug("could not convert Hefe Verpackungsmenge \"%s\" to amount and unit" % (hefe["Verpackungsmenge"]))
+                
+        # adjuncts
+        data["adjuncts"] = []
+        c.execute("SELECT * FROM WeitereZutatenGaben WHERE SudID = ? AND Typ != 100 AND Typ != -1 AND Ausbeute <= 0 ORDER BY erg_Menge DESC", (sud["ID"],))
+        zutaten = c.fetchall()
+        for zutat in zutaten:
+            if zutat["Zeitpunkt"] == 2:
+                usage = AdjunctUsageType.MASH.value
+            elif zutat["Zeitpunkt"] == 1:
+                if zutat["Zugabedauer"] == 0:
+                    usage = AdjunctUsageType.FLAMEOUT.value
+                else:
+                    usage = AdjunctUsageType.BOIL.value
+            elif zutat["Zeitpunkt"] == 0:
+                usage = AdjunctUsageType.PRIMARY.value
+            data["adjuncts"].append({
+                    "name": zutat["Name"],
+                    "adjunct_usage_type_id": usage,
+                    "unit": "g",
+                    "amount": float("%.3f" % (zutat["erg_Menge"])) })
+            if zutat["Zugabedauer"] > 0:
+                t = zutat["Zugabedauer"]
+                if t >= 1440:
+                    t = round(t / 1440)
+                data["adjuncts"][-1]["time"] = t
+
+        # mash steps
+        data["mash_steps"] = []
+        i = 0
+        c.execute("SELECT * FROM Rasten WHERE SudID = ?", (sud["ID"],))
+        rasten = c.fetchall()
+        for rast in rasten:
+            data["mash_steps"].append({
+                    "order": i,
+                    "name": rast["RastName"],
+                    "temperature": rast["RastTemp"],
+                    "time": rast["RastDauer"] })
+            i += 1
+
+        # fermentation steps
+        data["fermentation_steps"] = []
+        i = 0
+        fermentation_string = self.extractFromText(sud["Kommentar"], "Fermentation")
+        if (not fermentation_string) or (fermentation_string[0] == ","):
+            if fermentation_days_sud and (fermentation_days_sud >= 1) and (fermentation_days_sud <= 30):
+                days = fermentation_days_sud
+            elif fermentation_days_hg and (fermentation_days_hg >= 1) and (fermentation_days_hg <= 30):
+                days = fermentation_days_hg
+            else:
+                days = 14
+            if fermentation_temp_hg:
+                temp = fermentation_temp_hg
+            # TBD: fetch temp from KBH Hefe alternatively
+            else:
+                temp = 18
+            data["fermentation_steps"].append({
+                    "order": i,
+                    "name": "Hauptgärung",
+                    "temperature": temp,
+                    "time": days })
+            i += 1
+        if fermentation_string and ":" in fermentation_string and "@" in fermentation_string:
+            steps = fermentation_string.split(",")
+            for step in steps:
+                if ":" in step and "@" in step:
+                    name = step.split(":")[0]
+                    days = step.split(":")[1].split("@")[0].replace(" ", "")
+                    temp = step.split("@")[1].replace(" ", "")
+                    data["fermentation_steps"].append({
+                            "order": i,
+                            "name": name,
+                            "temperature": temp,
+                            "time": days })
+                    i += 1
+        else:
+            if fermentation_days_ng and (fermentation_days_ng >= 1) and (fermentation_days_ng <= 30):
+                days = fermentation_days_ng
+                if fermentation_temp_ng:
+                    temp = fermentation_temp_ng
+                # TBD: fetch temp from KBH Hefe alternatively
+                else:
+                    temp = 18
+                data["fermentation_steps"].append({
+                        "order": i,
+                        "name": "Nachgärung",
+                        "temperature": temp,
+                        "time": days })
+                i += 1
+
+        # brew session
+        #brew_data["created_at"] = data["created_at"]
+        #brew_data["updated_at"] = data["updated_at"]
+        #brew_data["is_active"] = data["is_active"]
+        #brew_data["is_public"] = data["is_public"]
+        #brew_data["unit_type_id"] = data["unit_type_id"]
         brew_data["grain_weight"] = grain_weight
         #brew_data["boil_time"] = data["boil_time"]
         brew_data["strike_water_volume"] = sud["erg_WHauptguss"]
@@ -997,1128 +1784,4023 @@ class KleinerBrauhelfer(object):
         #brew_data["boil_volume_est"] = 
         brew_data["ferment_volume_est"] = data["batch_size"]
         
-        temp = 78
-        order = -1
-        time = 0
-        for m in data["mash_steps"]:
-            if m["order"] >= 0 and m["temperature"] > 20:
-                temp = m["temperature"]
-                order = m["order"]
-                time += m["time"]
-        brew_data["mash_end_temp"] = temp
-        # add time for heating from start temp to mash out temp (approx. 30sec/degree?!)
-        time += round((brew_data["mash_end_temp"] - brew_data["mash_start_temp"]) / 2)
-        brew_data["mash_time"] = time
+        temp = 78
+        order = -1
+        time = 0
+        for m in data["mash_steps"]:
+            if m["order"] >= 0 and m["temperature"] > 20:
+                temp = m["temperature"]
+                order = m["order"]
+                time += m["time"]
+        brew_data["mash_end_temp"] = temp
+        # add time for heating from start temp to mash out temp (approx. 30sec/degree?!)
+        time += round((brew_data["mash_end_temp"] - brew_data["mash_start_temp"]) / 2)
+        brew_data["mash_time"] = time
+
+        brew_data["condition_date"] = "%sT00:00:00.000000Z" % sud["Abfuelldatum"][:10]
+        s = self.extractFromText(sud["Kommentar"], "Gebinde")
+        if s and any(x in s for x in ["Fass", "Faß", "Keg", "Cask", "Barrel", "19", "18", "17"]):
+            brew_data["condition_id"] = ConditionType.KEG.value
+        else:
+            brew_data["condition_id"] = ConditionType.BOTTLE.value
+        s = self.extractFromText(sud["Kommentar"], "Zucker")
+        
+        temperature = sud["TemperaturJungbier"]
+        #co2beer = 3.1557 * math.exp(-0.032 * temperature) # fabier
+        co2beer = 1.013 * ( math.pow(2.71828182845904, (-10.73797 + (2617.25 / (temperature + 273.15))))) * 10; # kbh
+        co2add = sud["CO2"] - co2beer
+        menge = sud["JungbiermengeAbfuellen"]
+        hz = (co2add * 1.0 / 0.468) * menge
+        tz = hz * 1.16
+        brew_data["priming_sugar_type"] = "Haushaltszucker"
+        # from KBH:
+        #        DichteRestextrakt = GetDichte(Restextrakt);
+        #        CO2Saettigung = 1.013 * ( pow(2.71828182845904, (-10.73797 + (2617.25 / (Temperatur + 273.15) ) ) ) ) * 10;
+        #        BenoetigteKarbonisierung = SollCO2 - CO2Saettigung;
+        #        ErforderlicherZuckerEndvergoren = 2 * BenoetigteKarbonisierung;
+        #        Gruenschlauchzeitpunkt = Restextrakt + (ErforderlicherZuckerEndvergoren / (8.192 * DichteRestextrakt));
+        #        ErforderlicherZucker = (Gruenschlauchzeitpunkt - Restextrakt) * 8.192 * DichteRestextrakt;
+        brew_data["priming_sugar_amount"] = round(hz)
+        # from KBH:
+        bar = sud["CO2"] / ((math.pow(2.71828182845904, (-10.73797 + (2617.25 / (temperature + 273.15))))) * 10) - 1.013
+        psi = bar * 14.5038
+        brew_data["keg_psi"] = round(psi)
+
+        if sud["BierWurdeVerbraucht"]:
+            brew_data["status"] = BrewStatusType.COMPLETE.value
+        elif sud["BierWurdeAbgefuellt"]:
+            # Note: the transition from CONDITIONING to COMPLETE is
+            # dynamic, it depends on the current date compared to the
+            # kegging date plus conditioning weeks.
+            d = datetime.datetime.strptime(sud["Abfuelldatum"][:10], '%Y-%m-%d') + datetime.timedelta(weeks = sud["Reifezeit"])
+            if  datetime.datetime.now() > d:
+                brew_data["status"] = BrewStatusType.COMPLETE.value
+            else:
+                brew_data["status"] = BrewStatusType.CONDITIONING.value
+        elif sud["BierWurdeGebraut"]:
+            brew_data["status"] = BrewStatusType.FERMENTATION.value
+        else:
+            brew_data["status"] = BrewStatusType.BREWDAY.value
+
+        # no official GF attribute, but the name is used later to search the equipment_profiles_id
+        brew_data["equipment_profiles"] = sud["AuswahlBrauanlageName"]
+
+        # these brew attributes are not set:
+        # "fermentation_device_id"
+        # "first_runnings_volume"
+        # "rating"
+        # "recipe"
+        # "runoff_volume"
+
+        # finally create the Recipe and Brew objects from the dicts
+        r = Recipe(data=data, brew_data=brew_data)
+        r.kbhId = sud["ID"]
+
+        if recalculate:
+            r.recalculate(force=False)
+            self.setBggu(r)
+
+        return r
+
+
+
+    def setBggu(self, r):
+
+        """Sets the BU:GU ratio of a recalculated recipe the way KBH
+        calculates it."""
+
+        if r.data["og"] > 1.0:
+            r.data["bggu"] = float(r.data["ibu"]) / (float(r.data["og"]) - 1.0) / 1000
+        else:
+            r.data["bggu"] = 0
+
+
+
+    def getSud(self, id):
+
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM Sud WHERE ID = ?", (id,))
+
+        return c.fetchone()
+
+
+
+    def replaceInText(self, text, tag, value):
+
+        """The reverse of extractFromText(): sets the value of a tag in
+        a given text, replacing an existing one or appending a line."""
+
+        tagged = "[[%s: %s]]" % (tag, value)
+        pattern = r'\[\[' + re.escape(tag) + r' *:[^\]]*\]\]'
+
+        if re.search(pattern, text):
+            return re.sub(pattern, lambda m: tagged, text, count=1)
+
+        return "%s\n%s" % (text, tagged) if text else tagged
+
+
+
+    def recipeToSud(self, sud, recipe, gf_recipe=None, gf_brew=None):
+
+        """The reverse of sudToRecipe() for the attributes that may be
+        edited on the GF site. Compares a GF recipe and/or brew to the
+        KBH recipe converted from the given sud and returns the changed
+        columns of the sud and new rows of "Hauptgaerverlauf". The GF
+        notes replace the untagged text of "Kommentar", fermentation
+        steps, the brew rating and the mash pH become [[]]-tags, the
+        measured OG and volume go to their columns and a measured FG
+        is added as the last "Hauptgaerverlauf" entry."""
+
+        columns = {}
+        rows = []
+        kommentar = sud["Kommentar"] or ""
+
+        if gf_recipe:
+
+            notes = re.sub(r'\s*\[\[Sync-ID:[^\]]*\]\]', r'', gf_recipe.get("notes") or "").strip()
+            if notes != recipe.get("notes"):
+                tags = re.findall(r'\[\[[^\]]*\]\]', kommentar)
+                kommentar = "\n\n".join([ x for x in (notes, "\n".join(tags)) if x ])
+
+            steps = [ (step["name"], step["time"], step["temperature"]) for step in gf_recipe.get("fermentation_steps") or [] ]
+            if steps and steps != [ (step["name"], step["time"], step["temperature"]) for step in recipe.get("fermentation_steps") or [] ]:
+                kommentar = self.replaceInText(kommentar, "Fermentation",
+                                               ",".join("%s:%g@%g" % (name, days, temp) for (name, days, temp) in steps))
+
+        if gf_brew:
+
+            kbh_brew = recipe.brews[0]
+
+            rating = gf_brew.get("rating")
+            if rating and (str(rating) != self.extractFromText(kommentar, "Bewertung")):
+                kommentar = self.replaceInText(kommentar, "Bewertung", rating)
+
+            ph = gf_brew.get("mash_ph")
+            if ph and (ph != kbh_brew.get("mash_ph")):
+                kommentar = self.replaceInText(kommentar, "Maische-pH", "%g" % (ph))
+
+            og = gf_brew.get("original_gravity")
+            if og and (abs(og - (kbh_brew.get("original_gravity") or 0)) >= 0.0005):
+                columns["SWAnstellen"] = round(Util.gravityToPlato(og), 1)
+
+            volume = gf_brew.get("ferment_volume_actual")
+            if volume and (abs(volume - (kbh_brew.get("ferment_volume_actual") or 0)) >= 0.05):
+                columns["WuerzemengeAnstellen"] = volume
+
+            fg = gf_brew.get("final_gravity")
+            if fg and (abs(fg - (kbh_brew.get("final_gravity") or 0)) >= 0.0005):
+                c = self.conn.cursor()
+                c.execute("SELECT * FROM Hauptgaerverlauf WHERE SudID = ? ORDER BY Zeitstempel DESC LIMIT 1", (sud["ID"],))
+                last = c.fetchone()
+                zeit = Util.utcToLocal(gf_brew.get("updated_at"))[:19].replace(" ", "T")
+                if last and (zeit <= last["Zeitstempel"]):
+                    # it has to be the last entry to count as FG
+                    zeit = (datetime.datetime.strptime(last["Zeitstempel"][:19], "%Y-%m-%dT%H:%M:%S") +
+                            datetime.timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%S")
+                temp = last["Temp"] if last else 18
+                rows.append((sud["ID"], zeit, round(Util.gravityToPlato(fg), 1), temp))
+
+        if kommentar != (sud["Kommentar"] or ""):
+            columns["Kommentar"] = kommentar
+
+        return columns, rows
+
+
+
+    def update(self, changes):
+
+        """Writes changes as returned by recipeToSud(), given as a list
+        of (sud, columns, rows) tuples, in a single transaction. The
+        writes are batched by executemany() per table and set of
+        columns and everything is prepared in advance, so that the
+        database is locked (BEGIN IMMEDIATE) only for the writes
+        themselves. A sud saved in KBH after it has been read is left
+        alone. Returns the IDs of the suds that have been updated."""
+
+        updates = collections.defaultdict(list)
+        inserts = []
+        saved = {}
+        for (sud, columns, rows) in changes:
+            names = tuple(sorted(columns))
+            if names:
+                updates[names].append(tuple(columns[name] for name in names) + (sud["ID"],))
+            inserts.extend(rows)
+            saved[sud["ID"]] = sud["Gespeichert"]
+
+        if not saved:
+            return []
+
+        conn = self.conn
+        isolation = conn.isolation_level
+        conn.isolation_level = None
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = {}
+                for chunk in Util.chunks(saved, 500):
+                    for row in conn.execute("SELECT ID, Gespeichert FROM Sud WHERE ID IN (%s)" % (", ".join([ "?" ] * len(chunk))), chunk):
+                        current[row["ID"]] = row["Gespeichert"]
+                ids = [ id for id in saved if current.get(id) == saved[id] ]
+                for id in saved:
+                    if id not in ids:
+                        self.logger.warning("Sud %s has been changed in KBH meanwhile, not updated" % (id))
+                ok = set(ids)
+                for names, params in updates.items():
+                    conn.executemany("UPDATE Sud SET %s WHERE ID = ?" % (", ".join("%s = ?" % (name) for name in names)),
+                                     [ p for p in params if p[-1] in ok ])
+                conn.executemany("INSERT INTO Hauptgaerverlauf (SudID, Zeitstempel, SW, Temp) VALUES (?, ?, ?, ?)",
+                                 [ row for row in inserts if row[0] in ok ])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.isolation_level = isolation
+
+        return ids
+
+
+        
+    def getRecipes(self, namepattern="*"):
+
+        """Retrieves an array of Recipe objects from the KBH database
+        based on an optional name pattern."""
+
+        namepattern = namepattern.replace("*", "%")
+
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM Sud WHERE Sudname LIKE ?", (namepattern,))
+        sude = c.fetchall()
+
+        recipes = []
+        for sud in sude:
+            t = time.perf_counter()
+            with PROFILER.span("sudToRecipe"):
+                recipe = self.sudToRecipe(sud, recalculate=False)
+            METRICS.observe("grainfather_conversion_seconds", time.perf_counter() - t, source="kbh")
+            recipes.append(recipe)
+
+        Calculator.recalculateAll(recipes, force=False)
+        for recipe in recipes:
+            self.setBggu(recipe)
+
+        return recipes
+
+
+
+    def iterRecipes(self, namepattern="*", batch=100):
+
+        """Like getRecipes(), but yields the Recipe objects one by one,
+        converting and recalculating batch suds at a time, so that
+        memory does not grow with the size of the database."""
+
+        namepattern = namepattern.replace("*", "%")
+
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM Sud WHERE Sudname LIKE ?", (namepattern,))
+
+        while True:
+            sude = c.fetchmany(batch)
+            if not sude:
+                break
+            recipes = []
+            for sud in sude:
+                t = time.perf_counter()
+                with PROFILER.span("sudToRecipe"):
+                    recipes.append(self.sudToRecipe(sud, recalculate=False))
+                METRICS.observe("grainfather_conversion_seconds", time.perf_counter() - t, source="kbh")
+            Calculator.recalculateAll(recipes, force=False)
+            for recipe in recipes:
+                self.setBggu(recipe)
+                yield recipe
+
+
+
+    def getRecipe(self, namepattern):
+
+        """Retrieves one Recipe object from the KBH database based on
+        a name pattern."""
+
+        recipes = self.getRecipes(namepattern)
+
+        if len(recipes) == 0:
+            self.logger.warn("pattern did not result in any entry")
+            return None
+
+        if len(recipes) > 1:
+            self.logger.warn("pattern did not result in a unique entry")
+            return None
+
+        return recipes[0]
+
+
+
+    def getBrew(self, recipe=None, namepattern=None):
+
+        """Retrieves a Brew objects from the KBH database based on
+        either a given Recipe object or an SQL recipe name pattern
+        (use e.g. % as a wildcard)."""
+
+        if not recipe:
+
+            recipes = self.getRecipes(namepattern)
+
+            if len(recipes) == 0:
+                self.logger.warn("pattern did not result in any entry")
+                return None
+
+            if len(recipes) > 1:
+                self.logger.warn("pattern did not result in a unique entry")
+                return None
+
+            recipe = recipes[0]
+
+
+
+class Session(object):
+
+    """Representation of a user session on the Grainfather brew community database."""
+    
+    session = None
+    username = None
+    logger = None
+    readonly = False
+    baseUrl = DEFAULT_BASEURL
+    oauthUrl = DEFAULT_OAUTHURL
+    headers = None
+    cookies = None
+    state = None
+
+
+
+    def request(self, method, url, relogin=True, redirect=False, force=False, **kwargs):
+
+        """Sends a request through the session's rate limiter. If the
+        response seems to be the login page, logs in again (once for all
+        threads that hit the expired session) and repeats the request.
+        Throttled requests are repeated after the time the server asks
+        for. Modifying requests are only logged in readonly mode."""
+
+        if (method != "GET") and self.readonly and not force:
+            self.logger.info("%s %s (dryrun)" % (method, url))
+            return None
+
+        retries = 0
+        while True:
+
+            # wait for a concurrent login, then use its tokens
+            with self.loginLock:
+                headers = dict(self.headers)
+                cookies = dict(self.cookies)
+                generation = self.logins
+
+            if self.limiter:
+                with PROFILER.span("rateLimit"):
+                    self.limiter.acquire()
+            with self.lock:
+                self.requests += 1
+
+            t = time.perf_counter()
+            with PROFILER.span("request"):
+                response = self.session.request(method, url, headers=headers, cookies=cookies, allow_redirects=redirect, **kwargs)
+            endpoint = Util.endpoint(url)
+            METRICS.observe("grainfather_request_seconds", time.perf_counter() - t, method=method, endpoint=endpoint)
+            METRICS.inc("grainfather_requests_total", method=method, endpoint=endpoint, status=response.status_code)
+            self.logger.info("%s %s -> %s" % (method, url, response.status_code))
+
+            if (response.status_code == 429) and (retries < self.retries):
+                retries += 1
+                delay = Util.retryDelay(response.headers.get("Retry-After"), retries)
+                self.logger.info("%s %s throttled, retrying in %.1fs" % (method, url, delay))
+                with PROFILER.span("throttled"):
+                    time.sleep(delay)
+                continue
+
+            if (response.status_code == 401) or ((response.status_code == 302) and ("/login" in response.headers["Location"])):
+                if relogin:
+                    with self.loginLock:
+                        if self.logins == generation:
+                            METRICS.inc("grainfather_relogins_total")
+                            self.login()
+                    relogin = False
+                    redirect = True
+                    continue
+
+            return response
+
+
+
+    def get(self, url, relogin=True, redirect=False):
+
+        return self.request("GET", url, relogin=relogin, redirect=redirect)
+
+
+
+    def post(self, url, data=None, json=None, files=None, force=False, relogin=True, redirect=False):
+
+        return self.request("POST", url, relogin=relogin, redirect=redirect, force=force, data=data, json=json, files=files)
+
+
+
+    def put(self, url, data=None, json=None, force=False, relogin=True):
+
+        return self.request("PUT", url, relogin=relogin, force=force, data=data, json=json)
+
+
+
+    def delete(self, url, force=False, relogin=True):
+
+        return self.request("DELETE", url, relogin=relogin, force=force)
+
+
+
+    def saveState(self, response):
+        
+        # save session information persistently for subsequent program calls
+        self.state["username"] = self.username
+        self.state["cookies"] = response.cookies.get_dict()
+        # explicitly passed cookies override the session's cookie jar, so
+        # stale cookies from a previously loaded state have to be replaced
+        self.cookies.update(self.state["cookies"])
+        if self.stateFile:
+            with open(os.path.expanduser(self.stateFile), "w") as f:
+                json.dump(self.state, f, sort_keys=True, indent=4)
+            self.logger.info("Saved session state to %s" % (self.stateFile))
+
+
+
+    def loadState(self):
+
+        try:
+            f = open(os.path.expanduser(self.stateFile))
+            self.state = json.load(f)
+            f.close()
+            self.username = self.state["username"]
+            self.cookies.update(self.state["cookies"])
+            self.headers.update({'X-CSRF-TOKEN': self.state["csrfToken"]})
+            self.headers.update({'X-XSRF-TOKEN': self.state["xsrfToken"]})
+            self.logger.info("Read session state from %s" % (self.stateFile))
+        except Exception as error:
+            self.logger.debug("No valid session state found at %s: %s" % (self.stateFile, error))
+
+
+
+    def removeState(self):
+
+        os.remove(os.path.expanduser(self.stateFile))
+        self.logger.info("Removed session state file %s" % (self.stateFile))
+
+
+
+    def __init__(self, username=None, password=None, readonly=False, force=False, stateFile=None,
+                 baseUrl=None, oauthUrl=None, cacheSize=1024, adapter=None, rate=None, retries=5):
+
+        self.username = username
+        self.password = password
+        self.readonly = readonly
+        self.force = force
+        self.stateFile = stateFile
+
+        # per instance, so that multiple sessions do not share any state
+        self.headers = {}
+        self.cookies = {}
+        self.state = {}
+
+        # identity map of all objects materialized from the server in
+        # this session, the most recently used ones are kept alive
+        self.objects = weakref.WeakValueDictionary()
+        self.recentObjects = collections.OrderedDict()
+        self.cacheSize = cacheSize
+        self.lock = threading.RLock()
+
+        # requests may be sent by multiple threads, they share the rate
+        # limit and a single login
+        self.limiter = RateLimiter(rate) if rate else None
+        self.retries = retries
+        self.loginLock = threading.RLock()
+        self.logins = 0
+        self.requests = 0
+
+        # allow to point the session to another backend, e.g. a local stand-in server
+        if baseUrl:
+            self.baseUrl = baseUrl.rstrip("/")
+        if oauthUrl:
+            self.oauthUrl = oauthUrl.rstrip("/")
+
+        self.logger = logging.getLogger('session')
+
+        self.session = requests.session()
+
+        # a transport adapter may serve the backend instead of the
+        # network, e.g. GrainfatherServer.Adapter for benchmarks
+        if adapter:
+            self.session.mount(self.baseUrl, adapter)
+            self.session.mount(self.oauthUrl, adapter)
+
+        # seems to be necessary:
+        self.headers.update({'User-Agent': "Mozilla/5.0 (or something else)" })
+        self.cookies.update({'_ga_ssr': "-658533274" })
+
+        if self.stateFile:
+            self.loadState()
+
+        # loaded on first use, see getBrewingEquipment()
+        self.brewingEquipment = None
+
+
+
+    def getBrewingEquipment(self):
+
+        """Returns the user's brewing equipment profiles, loaded on
+        first use."""
+
+        with self.lock:
+            if self.brewingEquipment is None:
+                self.brewingEquipment = BrewingEquipment(self)
+
+        return self.brewingEquipment
+
+
+
+    def login(self):
+        
+        # fetch start page, we expect to get redirected to oauth login page
+        response = self.get("%s/login" % (self.baseUrl), relogin=False, redirect=True)
+
+        # pick the form_key from the login form
+        form_key = None
+        oauth_token = None
+        for line in response.text.splitlines():
+            if "form_key" in line:
+                form_key = re.sub(r'^.*value="([a-zA-Z_0-9]*).*$', r'\1', line)
+            if "oauth_token" in line:
+                oauth_token = re.sub(r'^.*value="([a-zA-Z_0-9]*).*$', r'\1', line)
+        if (not form_key or not oauth_token):
+            self.logger.error("Could not fetch form_key and/or oauth_token from login page")
+            return
+
+        # post to the login form
+        payload = {'form_key': form_key, 'oauth_token': oauth_token, 'login[username]': self.username, 'login[password]': self.password}
+        response = self.post("%s/customer/account/loginPost/" % (self.oauthUrl), data=payload, relogin=False, redirect=True)
+
+        self.state["xsrfToken"] = response.cookies.get_dict()["XSRF-TOKEN"]
+
+        #response = self.get("https://brew.grainfather.com/whats-new-notifications/data?page=1", relogin=False, redirect=False)
+        
+        # fetch start page from the recipe creator
+        response = self.get(self.baseUrl, relogin=False)
+
+        # pick session metadata from response and set the CSRF token for this session
+        metadata = None
+        for line in response.text.splitlines():
+            if "window.Grainfather" in line:
+                s = re.sub(r'window.Grainfather *= *', r'', line)
+                metadata = json.loads(s)
+        if (not metadata):
+            self.logger.error("Could not fetch session metadata from login response")
+
+        self.state["csrfToken"] = metadata["csrfToken"]
+        self.state["api_token"] = metadata["user"]["api_token"]
+
+        self.headers.update({'X-CSRF-TOKEN': self.state["csrfToken"]})
+        self.headers.update({'X-XSRF-TOKEN': self.state["xsrfToken"] })
+
+        self.saveState(response)
+
+        self.logins += 1
+
+        #response = self.get("https://brew.grainfather.com/api/terms-and-conditions/data?api_token=%s" % (self.state["api_token"]), relogin=False, redirect=True)
+
+        #response = self.get("https://brew.grainfather.com/my-recipes")
+
+
+
+    def logout(self):
+
+        response = self.get("%s/logout" % (self.baseUrl), relogin=False)
+
+        self.removeState()
+
+
+
+    def register(self, obj, recipe_id=None, id=None):
+
+        """If the given object has been defined locally and is not yet registered to
+        a Grainfather session, this method will register it without actually saving
+        it to the Grainfather site. Saving can be done by a subsequent save() call
+        on the object."""
+
+        if id:
+            obj.set("id", id)
+
+        if recipe_id:
+            obj.set("recipe_id", recipe_id)
+
+        if obj.session == None:
+            obj.session = self
+        else:
+            self.logger.error("%s is already registered to a session" % obj)
+
+
+
+    def lookup(self, cls, id):
+
+        """Returns the object of the given class and id, if it has
+        already been materialized in this session."""
+
+        with self.lock:
+            if id is None:
+                return None
+
+            key = (cls.__name__, str(id))
+            obj = self.objects.get(key)
+            if obj is not None:
+                self.recentObjects[key] = obj
+                self.recentObjects.move_to_end(key)
+
+            return obj
+
+
+
+    def remember(self, obj):
+
+        """Makes the given bound object the one that represents its
+        server-side counterpart in this session."""
+
+        with self.lock:
+            key = (obj.__class__.__name__, str(obj.get("id")))
+            self.objects[key] = obj
+            self.recentObjects[key] = obj
+            self.recentObjects.move_to_end(key)
+            while len(self.recentObjects) > self.cacheSize:
+                self.recentObjects.popitem(last=False)
+
+
+
+    def forget(self, obj):
+
+        with self.lock:
+            key = (obj.__class__.__name__, str(obj.get("id")))
+            if self.objects.get(key) is obj:
+                del self.objects[key]
+                self.recentObjects.pop(key, None)
+
+
+
+    def materialize(self, cls, data):
+
+        """Returns the one object of this session that represents the
+        given server document or listing entry. An existing object is
+        updated in place, unless it holds a full document that is not
+        older than a listing entry, or it has unsaved changes."""
+
+        with self.lock:
+            obj = self.lookup(cls, data.get("id"))
+
+            if obj is None:
+                obj = cls(data=data)
+                self.register(obj)
+                self.remember(obj)
+            elif obj.isDirty():
+                self.logger.debug("%s has unsaved changes, keeping them" % obj)
+            elif (not getattr(data, "summary", False)) or (not obj.isFull()) or (obj.get("updated_at") != data.get("updated_at")):
+                obj.data = obj.record(data)
+
+            return obj
+
+
+
+    def __str__(self):
+
+        return "<Session of user %s>" % (self.username)
+
+
+
+    def getRecipe(self, id):
+
+        recipe = self.lookup(Recipe, id)
+
+        if recipe is None:
+            recipe = Recipe(self, id=id)
+            if recipe.isBound():
+                self.remember(recipe)
+        elif not recipe.isFull():
+            recipe.reload()
+
+        return recipe
+
+
+
+    def iterMyRecipes(self, namepattern=None):
+
+        """Yields the listing entries of the user's recipes page by page."""
+
+        url = "%s/my-recipes/data?page=1" % (self.baseUrl)
+
+        while url:
+
+            response = self.get(url)
+            responsedata = json.loads(response.text)
+
+            for data in responsedata["data"]:
+                recipe = self.materialize(Recipe, RecipeSummaryRecord.fromDict(data))
+                if (not namepattern) or fnmatch.fnmatch(recipe.get("name"), namepattern):
+                    yield recipe
+                    
+            if "next_page_url" in responsedata:
+                url = responsedata["next_page_url"]
+            else:
+                break
+
+
+
+    def iterBrews(self, recipe_id):
+
+        """Yields the listing entries of the brews of a recipe page by page."""
+
+        url = "{base}/recipes/{recipe_id}/brew-sessions/data?page=1".format(base=self.baseUrl, recipe_id=recipe_id)
+
+        while url:
+
+            response = self.get(url)
+            responsedata = json.loads(response.text)
+
+            for data in responsedata["data"]:
+                yield self.materialize(Brew, BrewSummaryRecord.fromDict(data))
+
+            if "next_page_url" in responsedata:
+                url = responsedata["next_page_url"]
+            else:
+                break
+
+
+
+    def getMyRecipes(self, namepattern=None, full=False, brews=False):
+
+        recipes = list(self.iterMyRecipes(namepattern))
+
+        if full:
+            for recipe in recipes:
+                if not recipe.isFull():
+                    recipe.reload()
+
+        if brews:
+            for recipe in recipes:
+                recipe.getBrews(full=full)
+                # XXX print(json.dumps(recipe.brews[0].data, sort_keys=True, indent=4))
+
+        return recipes
+
+
+
+    def getMyRecipe(self, namepattern=None, id=None, full=True, brews=False):
+
+        if id:
+
+            recipe = self.getRecipe(id)
+
+            if brews:
+                recipe.getBrews(full=full)
+
+            return recipe
+
+        else:
+
+            recipes = self.getMyRecipes(namepattern, full=full, brews=brews)
+
+            if len(recipes) == 0:
+                self.logger.warn("pattern did not result in any entry")
+                return None
+
+            if len(recipes) > 1:
+                self.logger.warn("pattern did not result in a unique entry")
+                return None
+
+            return recipes[0]
+
+
+
+    
+
+
+class AdjunctUsageType(Enum):
+
+    MASH		= 10	# min
+    SPARGE		= 15	# min
+    BOIL		= 20	# min
+    FLAMEOUT		= 25	# min
+    PRIMARY		= 30	# days
+    SECONDARY		= 40	# days
+    BOTTLE		= 50	# min
+
+
+
+class FermentableUsageType(Enum):
+
+    MASH		= 10
+    EXTRACT		= 20
+    STEEP		= 30
+    LATEADDITION	= 40	# what is this? probably after boil during fermentation or even later?
+
+
+
+class HopType(Enum):
+
+    LEAF		= 10
+    PELLET		= 20
+    PLUG		= 30
+    EXTRACT             = 40    # ???
+
+    def getBrewfather(id):
+        
+        if id == HopType.LEAF.value:
+            return "Leaf"
+        elif id == HopType.PELLET.value:
+            return "Pellet"
+        elif id == HopType.PLUG.value:
+            return "Plug"
+        elif id == HopType.EXTRACT.value:
+            return "Extract"
+        else:
+            return "Unknown"
+
+
+
+class HopUsageType(Enum):
+
+    MASH		= 10	# min
+    FIRSTWORT		= 15	# min
+    BOIL		= 20	# min
+    HOPSTAND		= 30	# min # obsolete?
+    AROMA		= 30	# min
+    DRYHOP		= 40	# days
+
+    def getBrewfather(id):
+        
+        if id == HopUsageType.MASH.value:
+            return "Mash"
+        elif id == HopUsageType.FIRSTWORT.value:
+            return "First Wort"
+        elif id == HopUsageType.BOIL.value:
+            return "Boil"
+        elif id == HopUsageType.HOPSTAND.value:
+            return "Hopstand"
+        elif id == HopUsageType.AROMA.value:
+            return "Aroma"
+        elif id == HopUsageType.DRYHOP.value:
+            return "Dry Hop"
+        else:
+            return "Unknown"
+
+
+
+class RecipeType(Enum):
+
+    ALLGRAIN		= 10
+    # TBD: others?
+
+
+
+class UnitType(Enum):
+
+    METRIC		= 10
+    # TBD: others?
+
+
+
+YeastUnitTypes = [ "packets", "vials", "g", "ml" ]
+
+
+
+AdjunctUnitTypes = [ "each", "kg", "g", "l", "ml", "tbsp", "tsp" ]
+
+
+
+class BrewStatusType(Enum):
+
+    BREWDAY		= 10
+    FERMENTATION	= 20
+    CONDITIONING	= 30
+    COMPLETE		= 40
+
+    def getName(id):
+        
+        if id == BrewStatusType.BREWDAY.value:
+            return "Brew Day"
+        elif id == BrewStatusType.FERMENTATION.value:
+            return "Fermentation"
+        elif id == BrewStatusType.CONDITIONING.value:
+            return "Conditioning"
+        elif id == BrewStatusType.COMPLETE.value:
+            return "Complete"
+        else:
+            return "Unknown"
+
+
+    def getBrewfather(id):
+
+        if id == BrewStatusType.BREWDAY.value:
+            return "Brewing"
+        elif id == BrewStatusType.FERMENTATION.value:
+            return "Fermenting"
+        elif id == BrewStatusType.CONDITIONING.value:
+            return "Conditioning"
+        elif id == BrewStatusType.COMPLETE.value:
+            return "Completed"
+        else:
+            return "Planning"
+
+
+
+class ConditionType(Enum):
+
+    BOTTLE		= 10
+    KEG          	= 20
+
+    def getName(id):
+        
+        if id == ConditionType.BOTTLE.value:
+            return "Bottle"
+        elif id == ConditionType.KEG.value:
+            return "Keg"
+        else:
+            return "Unknown"
+
+
+
+class RecordList(list):
+
+    """A list of nested Records that reports changes of its items and
+    of the list itself to the Record that holds it."""
+
+    __slots__ = ("_owner",)
+
+
+
+    def __init__(self, items=(), owner=None):
+
+        self._owner = owner
+        super(RecordList, self).__init__(self.adopt(item) for item in items)
+
+
+
+    def adopt(self, item):
+
+        if self._owner:
+            record, key = self._owner
+            if item.__class__ is dict:
+                item = record.children[key](item)
+            if isinstance(item, Record):
+                item._owner = self._owner
+
+        return item
+
+
+
+    def touch(self):
+
+        if self._owner:
+            record, key = self._owner
+            record.touch(key)
+
+
+
+    def append(self, item):
+
+        super(RecordList, self).append(self.adopt(item))
+        self.touch()
+
+
+
+    def insert(self, index, item):
+
+        super(RecordList, self).insert(index, self.adopt(item))
+        self.touch()
+
+
+
+    def extend(self, items):
+
+        super(RecordList, self).extend(self.adopt(item) for item in items)
+        self.touch()
+
+
+
+    def __iadd__(self, items):
+
+        self.extend(items)
+        return self
+
+
+
+    def __setitem__(self, index, item):
+
+        if isinstance(index, slice):
+            item = [ self.adopt(i) for i in item ]
+        else:
+            item = self.adopt(item)
+        super(RecordList, self).__setitem__(index, item)
+        self.touch()
+
+
+
+    def __delitem__(self, index):
+
+        super(RecordList, self).__delitem__(index)
+        self.touch()
+
+
+
+    def pop(self, *args):
+
+        item = super(RecordList, self).pop(*args)
+        self.touch()
+        return item
+
+
+
+    def remove(self, item):
+
+        super(RecordList, self).remove(item)
+        self.touch()
+
+
+
+    def clear(self):
+
+        super(RecordList, self).clear()
+        self.touch()
+
+
+
+    def sort(self, *args, **kwargs):
+
+        super(RecordList, self).sort(*args, **kwargs)
+        self.touch()
+
+
+
+    def reverse(self):
+
+        super(RecordList, self).reverse()
+        self.touch()
+
+
+
+class Record(object):
+
+    """Compact, dict-like representation of a JSON document of the
+    Grainfather API. Known attributes are kept in slots instead of a
+    per-instance dict, unknown ones in a separate dict that is only
+    created when needed, so that documents pass through unchanged.
+    Lists of nested documents are held as Records as well. The JSON
+    dict is only materialized by toDict(), e.g. when saving or
+    printing.
+
+    A Record keeps track of the attributes that have been changed
+    since it has been created or cleaned. Changes of nested Records
+    mark the according list attribute of their parent as changed."""
+
+    __slots__ = ("_extra", "_dirty", "_owner")
+
+    fields = ()		# names of the known attributes
+    children = {}	# list attributes -> Record subclass of their items
+    names = frozenset()
+    symbols = frozenset()	# str attributes with few distinct values, these get interned
+    summary = False	# True for records of listings, that hold only a subset of attributes
+
+
+
+    def __init__(self, data=None):
+
+        self._extra = None
+        self._dirty = None
+        self._owner = None
+
+        if data:
+            for key, value in data.items():
+                self[key] = value
+
+        # a new record starts clean, it is up to the caller to tell otherwise
+        self._dirty = None
+
+
+
+    @classmethod
+    def fromDict(cls, data):
+
+        if cls.summary:
+            # listing entries keep only the attributes we know about,
+            # the full document has to be reloaded anyhow before use
+            return cls({ key: value for (key, value) in data.items() if key in cls.names })
+
+        return cls(data)
+
+
+
+    def toDict(self):
+
+        d = {}
+        for key in self.keys():
+            value = self[key]
+            if isinstance(value, list):
+                value = [ v.toDict() if isinstance(v, Record) else v for v in value ]
+            elif isinstance(value, Record):
+                value = value.toDict()
+            d[key] = value
+
+        return d
+
+
+
+    def touch(self, key=None, inner=None):
+
+        """Marks the given attribute, or all attributes, as changed.
+        Inner tells which attribute of a nested Record in the list
+        attribute key has been changed, if any."""
+
+        if key is None:
+            self._dirty = set(self.keys())
+        elif self._dirty is None:
+            self._dirty = { key }
+        else:
+            self._dirty.add(key)
+
+        if self._owner:
+            record, field = self._owner
+            record.touch(field, key)
+
+
+
+    def clean(self):
+
+        """Forgets about all changes, e.g. after loading or saving."""
+
+        self._dirty = None
+        for key in self.children:
+            for item in self.get(key) or []:
+                if isinstance(item, Record):
+                    item.clean()
+
+
+
+    def dirty(self):
+
+        """Returns the set of attributes that have been changed."""
+
+        return set(self._dirty) if self._dirty else set()
+
+
+
+    def __getitem__(self, key):
+
+        try:
+            if key in self.names:
+                return getattr(self, key)
+            return self._extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key)
+
+
+
+    def __setitem__(self, key, value):
+
+        if (key in self.children) and isinstance(value, list):
+            value = RecordList(value, owner=(self, key))
+
+        if key in self.names:
+            if (key in self.symbols) and (value.__class__ is str):
+                value = sys.intern(value)
+            old = getattr(self, key, self)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            old = self._extra.get(key, self)
+            self._extra[key] = value
+
+        if (old is self) or (old.__class__ is not value.__class__) or (old != value):
+            self.touch(key)
+
+
+
+    def __delitem__(self, key):
+
+        try:
+            if key in self.names:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key)
+
+        self.touch(key)
+
+
+
+    def __contains__(self, key):
+
+        if key in self.names:
+            return hasattr(self, key)
+        return (self._extra is not None) and (key in self._extra)
+
+
+
+    def get(self, key, default=None):
+
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+
+    def keys(self):
+
+        keys = [ key for key in self.__slots__ if hasattr(self, key) ]
+        if self._extra:
+            keys.extend(self._extra.keys())
+
+        return keys
+
+
+
+    def items(self):
+
+        return [ (key, self[key]) for key in self.keys() ]
+
+
+
+    def __iter__(self):
+
+        return iter(self.keys())
+
+
+
+    def __len__(self):
+
+        return len(self.keys())
+
+
+
+    def copy(self):
+
+        return self.fromDict(self.toDict())
+
+
+
+    def __repr__(self):
+
+        return "%s(%r)" % (self.__class__.__name__, self.toDict())
+
+
+
+class FermentableRecord(Record):
+
+    fields = ("id", "name", "amount", "ppg", "lovibond",
+              "fermentable_usage_type_id", "fermentable_id")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    symbols = frozenset(("name",))
+
+
+
+class HopRecord(Record):
+
+    fields = ("id", "name", "amount", "unit", "aa",
+              "hop_type_id", "hop_usage_type_id", "time", "ibu")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    symbols = frozenset(("name", "unit"))
+
+
+
+class YeastRecord(Record):
+
+    fields = ("id", "name", "amount", "unit", "attenuation")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    symbols = frozenset(("name", "unit"))
+
+
+
+class AdjunctRecord(Record):
+
+    fields = ("id", "name", "amount", "unit",
+              "adjunct_usage_type_id", "time")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    symbols = frozenset(("name", "unit"))
+
+
+
+class StepRecord(Record):
+
+    """A mash or fermentation step."""
+
+    fields = ("id", "order", "name", "temperature", "time")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    symbols = frozenset(("name",))
+
+
+
+class CalculatedRecord(Record):
+
+    """A Record with attributes that are calculated from others. The
+    dependencies map each calculated node, i.e. a calculated attribute
+    or an intermediate result, to the attributes and nodes it is
+    calculated from, where "hops.amount" denotes the amount attribute
+    of the items of the hops list.
+
+    A change of an attribute marks all nodes that depend on it as
+    stale and forgets their intermediate results. A calculated
+    attribute that is set from outside of a calculation is pinned,
+    i.e. it is kept as it has been set, but the nodes depending on it
+    become stale. Setting it to None releases it again."""
+
+    __slots__ = ("_stale", "_pinned", "_values", "_calculating")
+
+    dependencies = {}
+    closures = {}	# attribute -> all nodes depending on it, filled on demand
+
+
+
+    def __init__(self, data=None):
+
+        self._stale = None
+        self._pinned = None
+        self._values = None
+        self._calculating = True
+        super(CalculatedRecord, self).__init__(data)
+        self._calculating = False
+
+
+
+    @classmethod
+    def affects(cls, path):
+
+        """Returns the set of nodes that directly or indirectly depend
+        on the given attribute path. A bare list attribute affects all
+        nodes that depend on any attribute of its items."""
+
+        try:
+            return cls.closures[path]
+        except KeyError:
+            pass
+
+        nodes = set()
+        todo = [ path ]
+        while todo:
+            p = todo.pop()
+            for node, inputs in cls.dependencies.items():
+                if (node not in nodes) and any((i == p) or i.startswith(p + ".") for i in inputs):
+                    nodes.add(node)
+                    todo.append(node)
+
+        cls.closures[path] = frozenset(nodes)
+
+        return cls.closures[path]
+
+
+
+    def touch(self, key=None, inner=None):
+
+        super(CalculatedRecord, self).touch(key, inner)
+
+        if self._calculating:
+            return
+
+        if key is None:
+            self.invalidate(self.dependencies.keys())
+            return
+
+        if (key in self.dependencies) and (key in self.names):
+            if self._pinned is None:
+                self._pinned = set()
+            if self.get(key) is None:
+                self._pinned.discard(key)
+                self.invalidate((key,))
+            else:
+                self._pinned.add(key)
+                if self._stale:
+                    self._stale.discard(key)
+
+        self.invalidate(self.affects(key if inner is None else key + "." + inner))
+
+
+
+    def invalidate(self, nodes):
+
+        """Marks the given nodes as stale."""
+
+        if not nodes:
+            return
+
+        if self._stale is None:
+            self._stale = set()
+        self._stale.update(nodes)
+
+        if self._values:
+            for node in nodes:
+                self._values.pop(node, None)
+
+
+
+    def stale(self):
+
+        """Returns the set of stale nodes."""
+
+        return set(self._stale) if self._stale else set()
+
+
+
+    def pinned(self):
+
+        """Returns the set of pinned calculated attributes."""
+
+        return set(self._pinned) if self._pinned else set()
+
+
+
+class RecipeRecord(CalculatedRecord):
+
+    fields = ("id", "user_id", "name", "description", "notes",
+              "author", "source", "created_at", "updated_at",
+              "unit_type_id", "recipe_type_id", "parent_recipe_id",
+              "bjcp_style_id", "is_public", "is_active",
+              "batch_size", "boil_size", "boil_time",
+              "efficiency", "losses",
+              "og", "fg", "abv", "ibu", "srm",
+              "bggu", "calories",
+              "planned_og", "planned_ibu", "source_srm",
+              "fermentables", "hops", "yeasts", "adjuncts",
+              "mash_steps", "fermentation_steps")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    symbols = frozenset(("author", "source", "bjcp_style_id"))
+    children = {
+        "fermentables": FermentableRecord,
+        "hops": HopRecord,
+        "yeasts": YeastRecord,
+        "adjuncts": AdjunctRecord,
+        "mash_steps": StepRecord,
+        "fermentation_steps": StepRecord }
+    dependencies = {
+        "gravity":     ("fermentables.amount", "fermentables.ppg", "fermentables.fermentable_usage_type_id",
+                        "efficiency", "batch_size", "losses", "unit_type_id"),
+        "color":       ("fermentables.amount", "fermentables.lovibond", "batch_size", "losses", "unit_type_id"),
+        "attenuation": ("yeasts.attenuation",),
+        "hopIBUs":     ("gravity", "hops.aa", "hops.amount", "hops.time", "hops.hop_usage_type_id",
+                        "boil_time", "batch_size", "losses", "unit_type_id"),
+        "og":          ("gravity",),
+        "fg":          ("gravity", "attenuation"),
+        "abv":         ("og", "fg"),
+        "srm":         ("color",),
+        "calories":    ("og", "fg"),
+        "ibu":         ("hopIBUs",),
+        "bggu":        ("ibu", "og") }
+    closures = {}
+
+
+
+class BrewRecord(Record):
+
+    fields = ("id", "recipe_id", "name", "notes",
+              "created_at", "updated_at", "condition_date",
+              "status", "unit_type_id", "is_public", "is_active",
+              "rating", "equipment_profiles", "equipment_profiles_id",
+              "original_gravity", "final_gravity", "pre_boil_gravity",
+              "source_abv", "boil_time", "boil_time_actual",
+              "ferment_volume_est", "ferment_volume_actual",
+              "boil_volume_est", "boil_volume_actual", "post_boil_volume",
+              "brew_kettle_loss", "wort_shrinkage", "mash_tun_loss",
+              "boil_loss", "mash_grain_absorption", "sparge_grain_absorption",
+              "mash_ph", "mash_thickness", "mash_start_temp",
+              "target_mash_temp", "mash_end_temp", "mash_time",
+              "grain_temp", "grain_weight", "strike_water_volume",
+              "sparge_water_volume", "total_water_needed", "strike_water_temp",
+              "condition_id", "priming_sugar_type", "priming_sugar_amount",
+              "keg_psi")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    symbols = frozenset(("name", "equipment_profiles", "priming_sugar_type"))
+
+
+
+class RecipeSummaryRecord(Record):
+
+    """An entry of the "my-recipes" listing, reduced to the attributes
+    that are needed to list and match recipes."""
+
+    fields = ("id", "name", "created_at", "updated_at",
+              "unit_type_id", "is_public", "batch_size",
+              "og", "abv", "ibu", "srm")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    summary = True
+
+
+
+class BrewSummaryRecord(Record):
+
+    """An entry of the "brew-sessions" listing of a recipe."""
+
+    fields = ("id", "recipe_id", "name", "created_at", "updated_at",
+              "status", "unit_type_id", "is_public", "is_active",
+              "ferment_volume_est", "ferment_volume_actual")
+    __slots__ = fields
+    names = frozenset(__slots__)
+    symbols = frozenset(("name",))
+    summary = True
+
+
+
+class Object(object):
+
+    session = None
+    data = None
+    recordClass = None
+
+
+
+    def __init__(self, session=None, id=None, data=None):
+
+        self.session = session
+        self.data = self.record(data if data is not None else {})
+
+        if (data.__class__ is dict) and isinstance(self.data, Record):
+            # locally defined, so all of it differs from the server
+            self.data.touch()
+
+        if self.data and not getattr(self.data, "summary", False):
+            self.tidy()
+        
+        if self.session:
+            
+            if id:
+
+                self.reload(id=id)
+
+            elif data:
+                
+                self.save()
+
+
+
+    def record(self, data):
+
+        """Converts a JSON document into the compact representation of
+        this class of objects, if there is one."""
+
+        if self.recordClass and (data.__class__ is dict):
+            return self.recordClass.fromDict(data)
+
+        return data
+
+
+
+    def toDict(self):
+
+        """Returns the JSON document of this object."""
+
+        if isinstance(self.data, Record):
+            return self.data.toDict()
+
+        return self.data
+
+
+
+    def getDirty(self):
+
+        """Returns the set of attributes that have been changed since
+        the object has been loaded or saved. Objects without change
+        tracking report all of their attributes."""
+
+        if isinstance(self.data, Record):
+            return self.data.dirty()
+
+        return set(self.data.keys()) if isinstance(self.data, dict) else set()
+
+
+
+    def isDirty(self):
+
+        return len(self.getDirty()) > 0
+
+
+
+    def tidy(self):
+
+        return
+
+
+
+    def reload(self, id=None, recipe_id=None):
+
+        if not id and ("id" in self.data):
+            id = self.data["id"]
+        if not recipe_id and "recipe_id" in self.data:
+            recipe_id = self.data["recipe_id"]
+            
+        response = self.session.get(self.urlload.format(base=self.session.baseUrl, api_token=self.session.state.get("api_token"), recipe_id=recipe_id, id=id))
+
+        if response and response.status_code == 200:
+            self.data = self.record(json.loads(response.text))
+
+
+
+    def save(self, id=None, recipe_id=None):
+
+        if id:
+            self.data["id"] = id
+
+        if recipe_id:
+            self.data["recipe_id"] = recipe_id
+
+        if not recipe_id and "recipe_id" in self.data:
+            recipe_id = self.data["recipe_id"]
+
+        if getattr(self.data, "summary", False):
+            self.session.logger.error("%s holds only a listing entry, reload it before saving" % self)
+            return False
+
+        dirty = self.getDirty()
+        if self.isBound() and not dirty:
+            self.session.logger.debug("%s is unchanged, not saving" % self)
+            return False
+        self.session.logger.debug("%s changed %s" % (self, ", ".join(sorted(dirty))))
+
+        self.tidy()
+
+        if self.isBound():
+            response = self.session.put(self.urlsave.format(base=self.session.baseUrl, api_token=self.session.state.get("api_token"), recipe_id=recipe_id, id=self.data["id"]), json=self.toDict())
+        else:
+            response = self.session.post(self.urlcreate.format(base=self.session.baseUrl, api_token=self.session.state.get("api_token"), recipe_id=recipe_id), json=self.toDict())
+
+        if response and response.status_code == 200:
+            self.data = self.record(json.loads(response.text))
+            # keep the session's representation of this object up to date
+            obj = self.session.lookup(self.__class__, self.get("id"))
+            if obj is None:
+                self.session.remember(self)
+            elif obj is not self:
+                obj.data = obj.record(json.loads(response.text))
+            return True
+
+        return False
+
+
+
+    def delete(self):
+
+        """Deletes the server-side representation of this object and
+        returns the response (None in dry run mode). An object that is
+        already gone (404) is forgotten as well."""
+
+        response = self.session.delete(self.urlsave.format(base=self.session.baseUrl, api_token=self.session.state.get("api_token"), recipe_id=self.data.get("recipe_id"), id=self.data["id"]))
+
+        if response is not None and response.status_code in (200, 404):
+            self.session.forget(self)
+
+        return response
+
+
+
+    def __str__(self):
+
+        s = "<"
+#        if "status" in self.data:
+#            s += "%s " % self.data["status"]
+#        else:
+#            if self.session:
+#                s += "registered "
+#            else:
+#                s += "unregistered "
+        if self.session:
+            s += "registered "
+        else:
+            s += "unregistered "
+        s += "%s" % (self.__class__.__name__)
+        if "id" in self.data:
+            s += " id %s" % self.data["id"]
+        if "name" in self.data:
+            s += " named \"%s\"" % self.data["name"]
+        s += ">"
+
+        return s
+
+
+
+    def __repr__(self):
+
+        return self.__str__()
+
+
+
+    def set(self, attr, value):
+
+        self.data[attr] = value
+
+
+
+    def get(self, attr):
+
+        if attr in self.data:
+            return self.data[attr]
+        else:
+            return None
+
+
+
+    def isBound(self):
+
+        """Checks whether the object has a server-side representation."""
+
+        if "id" in self.data:
+            return True
+        else:
+            return False
+
+
+
+    def isFull(self):
+
+        """Checks whether the object contains all attributes. When
+        false, some attributes may be missing, which happens for
+        search results, for example."""
+
+        return True
+
+
+
+    def print(self):
+
+        if self.isBound() and (not self.isFull()):
+            self.reload()
+
+        with PROFILER.span("serialize"):
+            print(json.dumps(self.toDict(), sort_keys=True, indent=4))
+
+
+
+class Recipe(Object):
+
+    urlload = "{base}/recipes/data/{id}"
+    urlsave = "{base}/recipes/{id}"
+    urlcreate = "{base}/recipes"
+    recordClass = RecipeRecord
+
+    brews = None
+    kbhId = None	# Sud.ID of a recipe read from KBH
+
+
+
+    def __init__(self, session=None, id=None, xmlfilename=None, data=None, brew_data=None):
+
+        if session and xmlfilename:
+
+            # post xml to convert to json
+            self.session.logger.info("Converting XML recipe file to JSON")
+            response = self.session.post("%s/recipes/xml" % (self.session.baseUrl), files={'xml': (filename, open(filename, 'rb'), 'text/xml')})
+            data = json.loads(response.text)
+
+        super(Recipe, self).__init__(session=session, id=id, data=data)
+
+        if brew_data:
+            self.brews = [ Brew(session=session, data=brew_data) ]
+     
+
+
+    def tidy(self):
+
+        # add required fields, if missing
+        if not 'unit_type_id' in self.data:
+            self.data['unit_type_id'] = UnitType.METRIC.value;
+        if not 'recipe_type_id' in self.data:
+            self.data['recipe_type_id'] = RecipeType.ALLGRAIN.value;
+
+        # others
+        if not 'source' in self.data:
+            self.data['source'] = DEFAULT_SOURCE
+        if not 'parent_recipe_id' in self.data:
+            self.data['parent_recipe_id'] = None
+
+
+
+    def isFull(self):
+
+        """Checks whether the object contains all attributes. When
+        false, some attributes may be missing, which happens for
+        search results, for example."""
+
+        if "fermentables" in self.data:
+            return True
+        else:
+            return False
+
+
+
+    def reload(self, id=None, full=False, brews=False):
+
+        super(Recipe, self).reload(id=id)
+
+        if brews:
+            self.getBrews(full=full)
+
+
+
+    def toGal(self, value):
+
+        if self.data['unit_type_id'] == UnitType.METRIC.value:
+            return Util.lToGal(value)
+        else:
+            return value
+
+
+
+    def toLb(self, value):
+
+        if self.data['unit_type_id'] == UnitType.METRIC.value:
+            return Util.kgToLb(value)
+        else:
+            return value
+
+
+
+    def toOz(self, value):
+
+        if self.data['unit_type_id'] == UnitType.METRIC.value:
+            return Util.gToOz(value)
+        else:
+            return value
+
+
+
+    def recalculate(self, force=False):
+
+        """Recalculate those recipe attributes that are not primarily
+        part of the recipe, but can be derived from other
+        user-adjusted attributes of ingredients, mash steps, etc., and
+        the equipment. Those attributes than can be recalculated but
+        that hold already some value, are only recalculated, if the
+        force flags is True, or if their inputs have changed and they
+        have not been set explicitly (see CalculatedRecord.stale() and
+        pinned())."""
+
+        ## og       from fermentables (amount, ppg, usage), efficiency, batch_size, losses
+        ## fg       from og and attenuation
+        ## abv      from og and fg
+        ## srm      from fermentables (amount, lovibond), batch_size, losses
+        ## calories from og and fg
+        ## ibu      from hops (amount, aa, time, usage), og
+        ## bugu     from ibu, og
+        ## (see RecipeRecord.dependencies for the exact graph)
+
+        ## most parts of these calculations are based on the
+        ## javascript code from the Grainfather web frontend, so that
+        ## our calculations should match those after uploading recipes.
+
+        with PROFILER.span("recalculate"):
+
+            if self.data._values:
+                self.data._values.clear()
+
+            totalGravityPoints, earlyGravityPoints = self.calculated("gravity")
+            hopIBUs, totalIBU = self.calculated("hopIBUs")
+
+            self.applyCalculation(force, totalGravityPoints, self.calculated("attenuation"), self.calculated("color"), hopIBUs, totalIBU)
+
+
+
+    def recalculateStale(self):
+
+        """Recalculates only those attributes whose inputs have changed
+        since the last calculation, e.g. by set() or by editing an
+        ingredient, while attributes that have been set explicitly are
+        kept. Intermediate results of unaffected nodes are reused.
+        Returns the set of recalculated attributes."""
+
+        stale = self.data.stale()
+        if not stale:
+            return set()
+
+        targets = (stale - self.data.pinned()) & { "og", "fg", "abv", "srm", "calories", "ibu", "bggu" }
+
+        totalGravityPoints = attenuation = color = hopIBUs = totalIBU = None
+        if targets & { "og", "fg" }:
+            totalGravityPoints, earlyGravityPoints = self.calculated("gravity")
+        if "fg" in targets:
+            attenuation = self.calculated("attenuation")
+        if "srm" in targets:
+            color = self.calculated("color")
+        if "ibu" in targets:
+            hopIBUs, totalIBU = self.calculated("hopIBUs")
+
+        self.applyCalculation(True, totalGravityPoints, attenuation, color, hopIBUs, totalIBU, targets=targets)
+
+        return targets
+
+
+
+    def calculated(self, node):
+
+        """Returns the intermediate result of a calculation node,
+        calculating it only if it is not known, yet."""
+
+        values = self.data._values
+        if values is None:
+            values = self.data._values = {}
+
+        if node not in values:
+            if node == "gravity":
+                values[node] = self.calculateGravity()
+            elif node == "color":
+                values[node] = self.calculateColor()
+            elif node == "attenuation":
+                values[node] = self.calculateAttenuation()
+            elif node == "hopIBUs":
+                totalGravityPoints, earlyGravityPoints = self.calculated("gravity")
+                values[node] = self.calculateHopIBUs(1.0 + earlyGravityPoints / 1000)
+            else:
+                raise KeyError(node)
+
+        return values[node]
+
+
+
+    def calculateAttenuation(self):
+
+        attenuation = 0.75 # if we do not know any better
+        if ("yeasts" in self.data) and (len(self.data["yeasts"]) > 0):
+            attenuation = 0.0
+            for yeast in self.data["yeasts"]:
+                if ("attenuation" in yeast) and (yeast["attenuation"] > 0):
+                    attenuation += float(yeast["attenuation"])
+                else:
+                    attenuation += 0.75  # if no explicit attenuation is given
+            attenuation /= len(self.data["yeasts"])
+        # TBD: take influence of maltose rest temperature into account
+
+        return attenuation
+
+
+
+    def calculateGravity(self):
+
+        """Returns the total and the early (without late additions)
+        gravity points."""
+
+        postBoilVolume = self.toGal(self.data["batch_size"] + self.data["losses"])
+        earlyGravityPoints = 0.0
+        totalGravityPoints = 0.0
+
+        if ("fermentables" in self.data) and (len(self.data["fermentables"]) > 0):
+            for fermentable in self.data["fermentables"]:
+                if fermentable["amount"] > 0:
+                    if fermentable["fermentable_usage_type_id"] == FermentableUsageType.MASH.value:
+                        efficiency = self.data["efficiency"]
+                    elif fermentable["fermentable_usage_type_id"] == FermentableUsageType.STEEP.value:
+                        efficiency = 0.5 # we assume this as a default steep efficiency
+                    else:
+                        efficiency = 1.0
+                    g = self.toLb(fermentable["amount"]) * fermentable["ppg"] * efficiency / postBoilVolume
+                    totalGravityPoints += g
+                    if fermentable["fermentable_usage_type_id"] != FermentableUsageType.LATEADDITION.value:
+                        earlyGravityPoints += g
+
+        return (totalGravityPoints, earlyGravityPoints)
+
+
+
+    def calculateColor(self):
+
+        postBoilVolume = self.toGal(self.data["batch_size"] + self.data["losses"])
+        color = 0.0
+
+        if "fermentables" in self.data:
+            for fermentable in self.data["fermentables"]:
+                if fermentable["amount"] > 0:
+                    color += self.toLb(fermentable["amount"]) * fermentable["lovibond"] / postBoilVolume
+
+        return color
+
+
+
+    def calculateHopIBUs(self, earlyOG):
+
+        """Returns the list of IBUs of each hop and their total."""
+
+        postBoilVolume = self.toGal(self.data["batch_size"] + self.data["losses"])
+        totalIBU = 0.0
+        hopIBUs = []
+        if ("hops" in self.data) and (len(self.data["hops"]) > 0):
+            for hop in self.data["hops"]:
+                ibu = 0.0
+                if hop["hop_usage_type_id"] in [HopUsageType.MASH.value, HopUsageType.FIRSTWORT.value, HopUsageType.BOIL.value, HopUsageType.AROMA.value]:
+                    if hop["hop_usage_type_id"] == HopUsageType.FIRSTWORT.value:
+                        time = self.data["boil_time"]
+                    else:
+                        time = hop["time"]
+                    if hop["hop_usage_type_id"] in [HopUsageType.MASH.value, HopUsageType.FIRSTWORT.value, HopUsageType.BOIL.value]:
+                        factor = 1.1
+                    else:
+                        factor = 1.0
+                    utilization = 1.65 * math.pow(0.000125, earlyOG - 1.0) * (1.0 - math.exp(-0.04 * time)) / 4.15 * factor
+                    ibu = hop["aa"] / 100.0 * self.toOz(hop["amount"]) * 7490 / postBoilVolume * utilization
+
+                    if hop["hop_usage_type_id"] == HopUsageType.AROMA.value:
+                        ibu /= 2
+                    elif hop["hop_usage_type_id"] == HopUsageType.MASH.value:
+                        ibu *= 0.2
+                    elif hop["hop_usage_type_id"] == HopUsageType.FIRSTWORT.value:
+                        ibu *= 1.1 # Note: other sources say that first worst hopping leads to slightly _less_ bitterness ?!
+
+                    totalIBU += ibu
+                hopIBUs.append(ibu)
+
+        return (hopIBUs, totalIBU)
+
+
+
+    def applyCalculation(self, force, totalGravityPoints, attenuation, color, hopIBUs, totalIBU, targets=None):
+
+        """Writes the results of a calculation to the recipe. This is
+        shared by recalculate(), recalculateStale() and the batched
+        Calculator, so that all of them round and respect existing
+        values in the same way. If targets are given, exactly those
+        attributes are written. Otherwise, missing values and stale
+        values that are not pinned are written, all of them if forced."""
+
+        d = self.data
+        stale = (d.stale() - d.pinned()) if targets is None else set()
+
+        def due(key, minimum=None):
+            if targets is not None:
+                return key in targets
+            return (force) or (key in stale) or (not key in d) or (d[key] == None) or ((minimum is not None) and (float(d[key]) <= minimum))
+
+        d._calculating = True
+        try:
+            if due("og", 1.000):
+                d["og"] = float("%.3f" % (1.0 + totalGravityPoints / 1000))
+            if due("fg", 1.000):
+                d["fg"] = float("%.3f" % (1.0 + (totalGravityPoints * (1.0 - attenuation)) / 1000))
+            if due("abv", 0.0):
+                d["abv"] = float("%.01f" % ((d["og"] - d["fg"]) * 131.25))
+            if due("srm", 0.0):
+                d["srm"] = float("%.1f" % (1.49 * math.pow(color, 0.69)))
+            if due("calories", 0.0):
+                d["calories"] = round(1881.22 * d["fg"] * (d["og"] - d["fg"]) / (1.775 - d["og"]) + 3550.0 * d["fg"] * (0.1808 * d["og"] + 0.8192 * d["fg"] - 1.0004))
+
+            if hopIBUs and ((targets is None) or ("ibu" in targets)):
+                for hop, ibu in zip(d["hops"], hopIBUs):
+                    if (force) or ("ibu" in stale) or (not "ibu" in hop) or (hop["ibu"] == None):
+                        hop["ibu"] = float("%0.01f" % ibu)
+            if due("ibu", 0.0):
+                d["ibu"] = float("%0.01f" % totalIBU)
+
+            if due("bggu", 0.0):
+                if (d["og"] <= 1.0) and (d["ibu"]) > 0:
+                    d["bggu"] = 1.0
+                elif (d["og"] <= 1.0) and (d["ibu"]) == 0:
+                    d["bggu"] = 0.0
+                else:
+                    d["bggu"] = d["ibu"] / ((d["og"] - 1.0) * 1000)
+        finally:
+            d._calculating = False
+
+        d._stale = None
+        if force and (targets is None):
+            d._pinned = None
+
+
+
+    def getBrews(self, full=False):
+
+        if self.brews != None:
+
+            return self.brews
+
+        self.brews = list(self.session.iterBrews(self.get("id")))
+
+        if full:
+            for brew in self.brews:
+                if not brew.isFull():
+                    brew.reload(recipe_id=self.get("id"))
+
+        return self.brews
+
+
+
+    def convertToBrewfather(self):
+
+        r = {}
+
+        r["_type"] = "recipe"
+        r["author"] = self.get("author")
+        r["name"] = self.data["name"]
+        r["notes"] = self.get("notes")
+        r["description"] = self.get("description")
+
+        r["abv"] = self.data["abv"]
+        r["batchSize"] = self.data["batch_size"]
+        r["boilTime"] = self.data["boil_time"]
+        r["buGuRatio"] = self.get("bggu")
+        r["color"] = self.data["srm"]
+        r["efficiency"] = self.data["efficiency"] * 100
+        r["og"] = self.data["og"]
+        r["fg"] = self.data["fg"]
+        r["ibu"] = self.data["ibu"]
+
+        r["fermentables"] = []
+        for f in self.get("fermentables") or []:
+            r["fermentables"].append({
+                    "name": f["name"],
+                    "color": f["lovibond"],
+                    "amount": f["amount"],
+                    "potential": 1.0 + f["ppg"] / 1000,
+                    })
+
+        r["hops"] = []
+        for h in self.get("hops") or []:
+            r["hops"].append({
+                    "name": h["name"],
+                    "time": h["time"],
+                    "alpha": h["aa"],
+                    "amount": h["amount"],
+                    "type": HopType.getBrewfather(h["hop_type_id"]),
+                    "use": HopUsageType.getBrewfather(h["hop_usage_type_id"])
+                    })
+
+        r["mash"] = { "steps": [] }
+        for m in self.get("mash_steps") or []:
+            r["mash"]["steps"].append({
+                    "name": m["name"],
+                    "stepTemp": m["temperature"],
+                    "stepTime": m["time"],
+                    "type": "Temperature"
+                    })
+
+        r["yeasts"] = []
+        for y in self.get("yeasts") or []:
+            r["yeasts"].append({
+                    "name": y["name"],
+                    "attenuation": y["attenuation"] * 100,
+                    "amount": y["amount"],
+                    "unit": y.get("unit")
+                    })
+
+        return r
+
+
+
+class Brew(Object):
+
+    urlload = "{base}/recipes/{recipe_id}/brew-sessions/data/{id}"
+    urlsave = "{base}/recipes/{recipe_id}/brew-sessions/{id}"
+    urlcreate = "{base}/recipes/{recipe_id}/brew-sessions/"
+    recordClass = BrewRecord
+
+    recipe_id = None
+
+
+
+    def __init__(self, session=None, recipe=None, id=None, data=None):
+
+        if recipe and recipe.get("id"):
+            # fill in recipe_id into url templates
+            self.recipe_id = recipe.get("id")
+            self.urlload = self.urlload.format(base="{base}", recipe_id=self.recipe_id, id="{id}")
+            self.urlsave = self.urlsave.format(base="{base}", recipe_id=self.recipe_id, id="{id}")
+            self.urlcreate = self.urlcreate.format(base="{base}", recipe_id=self.recipe_id)
+
+        super(Brew, self).__init__(session=session, id=id, data=data)
+
+     
+
+
+    def tidy(self):
+
+        # add required fields, if missing
+        if not 'unit_type_id' in self.data:
+            self.data['unit_type_id'] = UnitType.METRIC.value;
+
+        # others
+        if not 'recipe_id' in self.data:
+            self.data['recipe_id'] = None
+
+        # no official GF attribute, but the name is used later to search the equipment_profiles_id
+        if (not 'equipment_profiles_id' in self.data) and (self.session):
+            for e in self.session.getBrewingEquipment().data:
+                if e["name"] == self.data['equipment_profiles']:
+                    self.data['equipment_profiles_id'] = e["id"]
+
+
+
+    def isFull(self):
+
+        """Checks whether the object contains all attributes. When
+        false, some attributes may be missing, which happens for
+        search results, for example."""
+
+        if ("ferment_volume_actual" in self.data) and not getattr(self.data, "summary", False):
+            return True
+        else:
+            return False
+
+
+
+    def convertToBrewfather(self, recipe=None):
+
+        """Returns the Brewfather batch document of this brew session,
+        referring to the given recipe by name."""
+
+        b = {}
+
+        b["_type"] = "batch"
+        b["name"] = self.get("name") or (recipe.get("name") if recipe else None)
+        b["status"] = BrewStatusType.getBrewfather(self.get("status"))
+        if self.get("created_at"):
+            # Brewfather counts milliseconds since the epoch
+            t = datetime.datetime.strptime(self.get("created_at")[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+            b["brewDate"] = int(t.timestamp() * 1000)
+        b["notes"] = self.get("notes")
+
+        b["measuredOg"] = self.get("original_gravity")
+        b["measuredFg"] = self.get("final_gravity")
+        b["measuredPreBoilGravity"] = self.get("pre_boil_gravity")
+        b["measuredAbv"] = self.get("source_abv")
+        b["measuredBoilSize"] = self.get("boil_volume_actual")
+        b["measuredKettleSize"] = self.get("post_boil_volume")
+        b["measuredBatchSize"] = self.get("ferment_volume_actual")
+        b["measuredMashPh"] = self.get("mash_ph")
+        b["boilTime"] = self.get("boil_time_actual")
+
+        if recipe:
+            b["recipe"] = { "name": recipe.get("name") }
+
+        return b
+
+
+
+class BrewingEquipment(Object):
+
+    urlload = "{base}/my-equipment/brewing/data"
+
+
+
+    def __init__(self, session=None):
+
+        super(BrewingEquipment, self).__init__(session=session)
+        self.reload()
+
+
+
+class Fermentable(Object):
+
+    # TBD... how can we access specific ingredients?
+
+    urlload = "{base}/api/ingredients/fermentables?api_token={api_token}&q={id}"
+    urlsave = None
+    urlcreate = None
+
+
+
+class Calculator(object):
+
+    """Batched recalculation of many recipes at once. The fermentables,
+    hops and yeasts of all recipes are packed into flat NumPy arrays,
+    with an array of recipe indices alongside, so that gravity points,
+    color and IBUs of all recipes are computed by a few array
+    operations. Results are written back by Recipe.applyCalculation(),
+    the operations are done in the same order as in
+    Recipe.recalculate(), and the transcendental functions are taken
+    from the math module, so that the results match exactly."""
 
-        brew_data["condition_date"] = "%sT00:00:00.000000Z" % sud["Abfuelldatum"][:10]
-        s = self.extractFromText(sud["Kommentar"], "Gebinde")
-        if s and any(x in s for x in ["Fass", "Faß", "Keg", "Cask", "Barrel", "19", "18", "17"]):
-            brew_data["condition_id"] = ConditionType.KEG.value
-        else:
-            brew_data["condition_id"] = ConditionType.BOTTLE.value
-        s = self.extractFromText(sud["Kommentar"], "Zucker")
-        
-        temperature = sud["TemperaturJungbier"]
-        #co2beer = 3.1557 * math.exp(-0.032 * temperature) # fabier
-        co2beer = 1.013 * ( math.pow(2.71828182845904, (-10.73797 + (2617.25 / (temperature + 273.15))))) * 10; # kbh
-        co2add = sud["CO2"] - co2beer
-        menge = sud["JungbiermengeAbfuellen"]
-        hz = (co2add * 1.0 / 0.468) * menge
-        tz = hz * 1.16
-        brew_data["priming_sugar_type"] = "Haushaltszucker"
-        # from KBH:
-        #        DichteRestextrakt = GetDichte(Restextrakt);
-        #        CO2Saettigung = 1.013 * ( pow(2.71828182845904, (-10.73797 + (2617.25 / (Temperatur + 273.15) ) ) ) ) * 10;
-        #        BenoetigteKarbonisierung = SollCO2 - CO2Saettigung;
-        #        ErforderlicherZuckerEndvergoren = 2 * BenoetigteKarbonisierung;
-        #        Gruenschlauchzeitpunkt = Restextrakt + (ErforderlicherZuckerEndvergoren / (8.192 * DichteRestextrakt));
-        #        ErforderlicherZucker = (Gruenschlauchzeitpunkt - Restextrakt) * 8.192 * DichteRestextrakt;
-        brew_data["priming_sugar_amount"] = round(hz)
-        # from KBH:
-        bar = sud["CO2"] / ((math.pow(2.71828182845904, (-10.73797 + (2617.25 / (temperature + 273.15))))) * 10) - 1.013
-        psi = bar * 14.5038
-        brew_data["keg_psi"] = round(psi)
+    fermentableKeys = ("amount", "ppg", "lovibond", "fermentable_usage_type_id")
+    hopKeys = ("hop_usage_type_id", "aa", "amount", "time")
 
-        if sud["BierWurdeVerbraucht"]:
-            brew_data["status"] = BrewStatusType.COMPLETE.value
-        elif sud["BierWurdeAbgefuellt"]:
-            # Note: the transition from CONDITIONING to COMPLETE is
-            # dynamic, it depends on the current date compared to the
-            # kegging date plus conditioning weeks.
-            d = datetime.datetime.strptime(sud["Abfuelldatum"][:10], '%Y-%m-%d') + datetime.timedelta(weeks = sud["Reifezeit"])
-            if  datetime.datetime.now() > d:
-                brew_data["status"] = BrewStatusType.COMPLETE.value
-            else:
-                brew_data["status"] = BrewStatusType.CONDITIONING.value
-        elif sud["BierWurdeGebraut"]:
-            brew_data["status"] = BrewStatusType.FERMENTATION.value
-        else:
-            brew_data["status"] = BrewStatusType.BREWDAY.value
 
-        # no official GF attribute, but the name is used later to search the equipment_profiles_id
-        brew_data["equipment_profiles"] = sud["AuswahlBrauanlageName"]
 
-        # these brew attributes are not set:
-        # "fermentation_device_id"
-        # "first_runnings_volume"
-        # "rating"
-        # "recipe"
-        # "runoff_volume"
+    def recalculateAll(recipes, force=False):
 
-        # finally create the Recipe and Brew objects from the dicts
-        r = Recipe(data=data, brew_data=brew_data)
+        """Recalculates the given recipes, batched if NumPy is available."""
 
-        r.recalculate(force=False)
+        recipes = list(recipes)
+
+        with PROFILER.span("recalculate"):
+
+            if (not numpy) or (len(recipes) < 2):
+                for recipe in recipes:
+                    recipe.recalculate(force=force)
+                return
+
+            Calculator(recipes).apply(force=force)
+
+
+
+    def columns(items, keys):
+
+        """Returns a tuple of the given attributes for each item. Records
+        are read by a fast attribute getter."""
+
+        try:
+            return list(map(operator.attrgetter(*keys), items))
+        except AttributeError:
+            return [ tuple(item[key] for key in keys) for item in items ]
 
-        if data["og"] > 1.0:
-            data["bggu"] = float(data["ibu"]) / (float(data["og"]) - 1.0) / 1000
-        else:
-            data["bggu"] = 0
+
+
+    def __init__(self, recipes):
+
+        self.recipes = []
+        self.scalar = []
+
+        metric = []
+        postBoilVolumes = []
+        efficiencies = []
+        boilTimes = []
+        fermentables = []
+        fermentableIndex = []
+        hops = []
+        hopIndex = []
+        hopOffsets = [ 0 ]
+        attenuations = []
+        yeastIndex = []
+        yeastCounts = []
+
+        for recipe in recipes:
+
+            # recipes with incomplete data are left to the scalar
+            # calculation, which then behaves like it always did
+            try:
+                d = recipe.data
+                m = d["unit_type_id"] == UnitType.METRIC.value
+                postBoilVolume = float(recipe.toGal(d["batch_size"] + d["losses"]))
+                efficiency = float(d["efficiency"])
+                boilTime = float(d["boil_time"])
+                f = Calculator.columns(d["fermentables"], Calculator.fermentableKeys) if "fermentables" in d else []
+                h = Calculator.columns(d["hops"], Calculator.hopKeys) if "hops" in d else []
+                y = d["yeasts"] if "yeasts" in d else []
+                # 0.75 if no explicit attenuation is given
+                a = [ float(yeast["attenuation"]) if ("attenuation" in yeast) and (yeast["attenuation"] > 0) else 0.75
+                      for yeast in y ]
+                if postBoilVolume == 0:
+                    raise ValueError("no volume")
+            except (KeyError, AttributeError, TypeError, ValueError):
+                self.scalar.append(recipe)
+                continue
+
+            i = len(self.recipes)
+            self.recipes.append(recipe)
+            metric.append(m)
+            postBoilVolumes.append(postBoilVolume)
+            efficiencies.append(efficiency)
+            boilTimes.append(boilTime)
+            fermentables.extend(f)
+            fermentableIndex.extend([ i ] * len(f))
+            hops.extend(h)
+            hopIndex.extend([ i ] * len(h))
+            hopOffsets.append(hopOffsets[-1] + len(h))
+            attenuations.extend(a)
+            yeastIndex.extend([ i ] * len(y))
+            yeastCounts.append(len(y))
+
+        self.metric = numpy.array(metric, dtype=bool)
+        self.postBoilVolume = numpy.array(postBoilVolumes, dtype=float)
+        self.efficiency = numpy.array(efficiencies, dtype=float)
+        self.boilTime = numpy.array(boilTimes, dtype=float)
+        self.fermentables = numpy.array(fermentables, dtype=float).reshape(-1, len(Calculator.fermentableKeys))
+        self.fermentableIndex = numpy.array(fermentableIndex, dtype=numpy.intp)
+        self.hops = numpy.array(hops, dtype=float).reshape(-1, len(Calculator.hopKeys))
+        self.hopIndex = numpy.array(hopIndex, dtype=numpy.intp)
+        self.hopOffsets = hopOffsets
+        self.attenuations = numpy.array(attenuations, dtype=float)
+        self.yeastIndex = numpy.array(yeastIndex, dtype=numpy.intp)
+        self.yeastCounts = numpy.array(yeastCounts, dtype=float)
+
+        # null values have become NaN, recipes with any non-finite input
+        # are left to the scalar calculation as well, instead of
+        # yielding NaN
+        n = len(self.recipes)
+        bad = ~(numpy.isfinite(self.postBoilVolume) & numpy.isfinite(self.efficiency) & numpy.isfinite(self.boilTime))
+        for values, index in ((self.fermentables, self.fermentableIndex), (self.hops, self.hopIndex),
+                              (self.attenuations[:, None], self.yeastIndex)):
+            bad |= numpy.bincount(index, weights=~numpy.isfinite(values).all(axis=1), minlength=n) > 0
+        if bad.any():
+            self.drop(bad)
+
+
+
+    def drop(self, bad):
+
+        """Moves the recipes flagged in the bad mask from the packed
+        arrays to the scalar calculation."""
+
+        keep = ~bad
+        renumber = numpy.cumsum(keep) - 1
+
+        self.scalar.extend(recipe for recipe, b in zip(self.recipes, bad.tolist()) if b)
+        self.recipes = [ recipe for recipe, b in zip(self.recipes, bad.tolist()) if not b ]
+
+        self.metric = self.metric[keep]
+        self.postBoilVolume = self.postBoilVolume[keep]
+        self.efficiency = self.efficiency[keep]
+        self.boilTime = self.boilTime[keep]
+        self.yeastCounts = self.yeastCounts[keep]
+
+        rows = keep[self.fermentableIndex]
+        self.fermentables = self.fermentables[rows]
+        self.fermentableIndex = renumber[self.fermentableIndex[rows]]
+        rows = keep[self.hopIndex]
+        self.hops = self.hops[rows]
+        self.hopIndex = renumber[self.hopIndex[rows]]
+        self.hopOffsets = [ 0 ] + numpy.cumsum(numpy.bincount(self.hopIndex, minlength=len(self.recipes))).tolist()
+        rows = keep[self.yeastIndex]
+        self.attenuations = self.attenuations[rows]
+        self.yeastIndex = renumber[self.yeastIndex[rows]]
+
+
+
+    def compute(self):
+
+        """Computes gravity points, attenuation, color and IBUs of all
+        packed recipes. Sums are built by numpy.bincount(), which adds
+        up in the order of the ingredients, just like the scalar loops."""
+
+        n = len(self.recipes)
+
+        # fermentables
+        fi = self.fermentableIndex
+        amount, ppg, lovibond, usage = self.fermentables.T
+        pbv = self.postBoilVolume[fi]
+        lb = numpy.where(self.metric[fi], Util.kgToLb(amount), amount)
+        efficiency = numpy.where(usage == FermentableUsageType.MASH.value, self.efficiency[fi],
+                                 numpy.where(usage == FermentableUsageType.STEEP.value, 0.5, 1.0))
+        with numpy.errstate(all="ignore"):
+            g = lb * ppg * efficiency / pbv
+            c = lb * lovibond / pbv
+        valid = amount > 0
+        total = numpy.bincount(fi, weights=numpy.where(valid, g, 0.0), minlength=n)
+        early = numpy.bincount(fi, weights=numpy.where(valid & (usage != FermentableUsageType.LATEADDITION.value), g, 0.0), minlength=n)
+        color = numpy.bincount(fi, weights=numpy.where(valid, c, 0.0), minlength=n)
+
+        # yeasts
+        attenuation = numpy.bincount(self.yeastIndex, weights=self.attenuations, minlength=n)
+        attenuation = numpy.where(self.yeastCounts > 0, attenuation / numpy.maximum(self.yeastCounts, 1), 0.75)
+
+        # hops
+        hi = self.hopIndex
+        usage, aa, amount, time = self.hops.T
+        earlyOG = (1.0 + early / 1000).tolist()
+        bitterness = numpy.array([ math.pow(0.000125, og - 1.0) for og in earlyOG ], dtype=float)
+        bittering = numpy.isin(usage, [ HopUsageType.MASH.value, HopUsageType.FIRSTWORT.value, HopUsageType.BOIL.value, HopUsageType.AROMA.value ])
+        time = numpy.where(usage == HopUsageType.FIRSTWORT.value, self.boilTime[hi], time)
+        factor = numpy.where(numpy.isin(usage, [ HopUsageType.MASH.value, HopUsageType.FIRSTWORT.value, HopUsageType.BOIL.value ]), 1.1, 1.0)
+        # there are only few distinct times, so exp() is taken from math for each of them
+        exponents, inverse = numpy.unique(numpy.where(bittering, -0.04 * time, 0.0), return_inverse=True)
+        decay = numpy.array([ math.exp(x) for x in exponents.tolist() ], dtype=float)[inverse.reshape(-1)]
+        oz = numpy.where(self.metric[hi], Util.gToOz(amount), amount)
+        with numpy.errstate(all="ignore"):
+            utilization = 1.65 * bitterness[hi] * (1.0 - decay) / 4.15 * factor
+            ibu = aa / 100.0 * oz * 7490 / self.postBoilVolume[hi] * utilization
+        ibu = numpy.where(usage == HopUsageType.AROMA.value, ibu / 2, ibu)
+        ibu = numpy.where(usage == HopUsageType.MASH.value, ibu * 0.2, ibu)
+        ibu = numpy.where(usage == HopUsageType.FIRSTWORT.value, ibu * 1.1, ibu)
+        ibu = numpy.where(bittering, ibu, 0.0)
+        totalIBU = numpy.bincount(hi, weights=ibu, minlength=n)
+
+        return (total.tolist(), early.tolist(), attenuation.tolist(), color.tolist(), ibu.tolist(), totalIBU.tolist())
+
+
+
+    def apply(self, force=False):
+
+        """Computes and writes back the results to all recipes."""
+
+        if self.recipes:
+            total, early, attenuation, color, ibu, totalIBU = self.compute()
+            o = self.hopOffsets
+            for i, recipe in enumerate(self.recipes):
+                hopIBUs = ibu[o[i]:o[i + 1]]
+                recipe.applyCalculation(force, total[i], attenuation[i], color[i], hopIBUs, totalIBU[i])
+                # keep the intermediate results for later incremental updates
+                recipe.data._values = {
+                    "gravity": (total[i], early[i]),
+                    "attenuation": attenuation[i],
+                    "color": color[i],
+                    "hopIBUs": (hopIBUs, totalIBU[i]) }
+
+        for recipe in self.scalar:
+            recipe.recalculate(force=force)
+
+
+
+class Solver(object):
+
+    """Finds grain and hop amounts of a recipe that hit target values of
+    OG, IBU and SRM, optionally at a different volume or efficiency.
+
+    The gravity points and the color are linear in the grain amounts,
+    so each candidate grain bill is scaled to hit the target OG
+    exactly. If an SRM target is given, the proportions of the grains
+    are searched by the cross-entropy method: in each iteration a few
+    thousand candidate bills are drawn around the current mean, scored
+    all at once by array operations (SRM and OG error after rounding
+    and the deviation from the original proportions), and the best of
+    them become the next mean. For the chosen bill the IBU is linear
+    in the hop amounts again, so the bittering hops are scaled to hit
+    the target in closed form, while later hops keep their rate."""
+
+    def __init__(self, recipe, candidates=4096, iterations=40, seed=0):
+
+        if not numpy:
+            raise RuntimeError("The solver requires NumPy")
+
+        self.recipe = recipe
+        self.candidates = candidates
+        self.iterations = iterations
+        self.seed = seed
+        self.logger = logging.getLogger('solver')
+
+
+
+    def solve(self, og=None, ibu=None, srm=None, volume=None, efficiency=None):
+
+        """Returns a new, unbound Recipe that hits the given targets.
+        OG and IBU default to the calculated values of the original
+        recipe, so that e.g. only a volume rescales the recipe. If no
+        SRM is given, the grain proportions are kept."""
+
+        original = Recipe(data=self.recipe.toDict())
+        original.recalculate(force=True)
+        og = original.get("og") if og is None else og
+        ibu = original.get("ibu") if ibu is None else ibu
+
+        r = Recipe(data=self.recipe.toDict())
+        d = r.data
+
+        # volume and efficiency are settings rather than results
+        if volume is not None:
+            ratio = float(volume) / d["batch_size"]
+            d["batch_size"] = float(volume)
+            if d.get("boil_size"):
+                d["boil_size"] = float("%.1f" % (d["boil_size"] * ratio))
+            for item in (d.get("hops") or []) + (d.get("adjuncts") or []):
+                if isinstance(item.get("amount"), (int, float)):
+                    item["amount"] = float("%.1f" % (item["amount"] * ratio))
+        if efficiency is not None:
+            d["efficiency"] = float(efficiency)
+
+        self.solveGrains(r, og, srm)
+        if ibu is not None:
+            self.solveHops(r, ibu)
+
+        r.recalculate(force=True)
 
         return r
 
 
-        
-    def getRecipes(self, namepattern="*"):
 
-        """Retrieves an array of Recipe objects from the KBH database
-        based on an optional name pattern."""
+    def solveGrains(self, r, og, srm):
 
-        namepattern = namepattern.replace("*", "%")
+        d = r.data
+        postBoilVolume = r.toGal(d["batch_size"] + d["losses"])
+        fermentables = [ f for f in (d.get("fermentables") or []) if f["amount"] > 0 ]
+        if not fermentables:
+            return
 
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM Sud WHERE Sudname LIKE ?", (namepattern,))
-        sude = c.fetchall()
+        efficiency = { FermentableUsageType.MASH.value: d["efficiency"], FermentableUsageType.STEEP.value: 0.5 }
+        points = numpy.array([ r.toLb(1.0) * f["ppg"] * efficiency.get(f["fermentable_usage_type_id"], 1.0) / postBoilVolume for f in fermentables ])
+        colors = numpy.array([ r.toLb(1.0) * f["lovibond"] / postBoilVolume for f in fermentables ])
+        amounts = numpy.array([ float(f["amount"]) for f in fermentables ])
+        target = (og - 1.0) * 1000
 
-        recipes = []
-        for sud in sude:
-            recipe = self.sudToRecipe(sud)
-            recipes.append(recipe)
+        if amounts @ points <= 0:
+            self.logger.warning("%s has no fermentables with any extract, keeping grain bill" % (r))
+            return
 
-        return recipes
+        def evaluate(z):
+            # candidates are rows of log factors on the original amounts
+            w = amounts * numpy.exp(z)
+            a = numpy.round(w * (target / (w @ points))[:, None], 3)
+            error = (a @ points - target) ** 2
+            if srm is not None:
+                error += ((1.49 * numpy.power(a @ colors, 0.69) - srm) / 0.5) ** 2
+            deviation = z - z.mean(axis=1, keepdims=True)
+            return a, error + (deviation ** 2).mean(axis=1)
+
+        n = len(fermentables)
+        mean = numpy.zeros(n)
+        best, score = evaluate(mean[None, :])
+        best, score = best[0], score[0]
+
+        if (srm is not None) and (n > 1):
+            rng = numpy.random.default_rng(self.seed)
+            sigma = numpy.full(n, 0.5)
+            elite = max(2, self.candidates // 20)
+            for i in range(self.iterations):
+                z = mean + sigma * rng.standard_normal((self.candidates, n))
+                z[0] = mean
+                a, e = evaluate(z)
+                order = numpy.argsort(e)
+                if e[order[0]] < score:
+                    best, score = a[order[0]], e[order[0]]
+                mean = z[order[:elite]].mean(axis=0)
+                sigma = z[order[:elite]].std(axis=0)
+                if sigma.max() < 1e-3:
+                    break
+            self.logger.debug("Grain bill search ended after %d iterations with score %.4f" % (i + 1, score))
 
+        for f, amount in zip(fermentables, best.tolist()):
+            f["amount"] = amount
 
 
-    def getRecipe(self, namepattern):
 
-        """Retrieves one Recipe object from the KBH database based on
-        a name pattern."""
+    def solveHops(self, r, ibu):
 
-        recipes = self.getRecipes(namepattern)
+        d = r.data
+        hops = d.get("hops") or []
+        if not hops:
+            return
 
-        if len(recipes) == 0:
-            self.logger.warn("pattern did not result in any entry")
-            return None
+        # the IBUs of each hop for the new grain bill, at the current amounts
+        r.recalculate(force=True)
+        hopIBUs, totalIBU = r.calculated("hopIBUs")
+        hopIBUs = numpy.array(hopIBUs)
+
+        # boil additions of 30 minutes and more, first wort and mash
+        # hops set the bitterness, the others keep their amounts
+        bittering = numpy.array([ (h["hop_usage_type_id"] in (HopUsageType.MASH.value, HopUsageType.FIRSTWORT.value)) or
+                                  ((h["hop_usage_type_id"] == HopUsageType.BOIL.value) and (h["time"] >= 30)) for h in hops ])
+        if (hopIBUs[bittering].sum() <= 0) or (hopIBUs[~bittering].sum() > ibu):
+            bittering = hopIBUs > 0
+        if hopIBUs[bittering].sum() <= 0:
+            self.logger.warning("%s has no bittering hops, keeping hop amounts" % (r))
+            return
 
-        if len(recipes) > 1:
-            self.logger.warn("pattern did not result in a unique entry")
-            return None
+        factor = (ibu - hopIBUs[~bittering].sum()) / hopIBUs[bittering].sum()
+        for hop, b in zip(hops, bittering.tolist()):
+            if b:
+                hop["amount"] = float("%.1f" % (hop["amount"] * factor))
 
-        return recipes[0]
 
 
+class RecipeIndex(object):
 
-    def getBrew(self, recipe=None, namepattern=None):
+    """Recipes of one source (KBH, BeerSmith or the Grainfather site),
+    hashed by name and by Grainfather id. Names are not unique in any
+    of the sources, so each name refers to a list of recipes in the
+    order they have been added."""
 
-        """Retrieves a Brew objects from the KBH database based on
-        either a given Recipe object or an SQL recipe name pattern
-        (use e.g. % as a wildcard)."""
+    def __init__(self, recipes=()):
 
-        if not recipe:
+        self.byName = {}
+        self.byId = {}
 
-            recipes = self.getRecipes(namepattern)
+        for recipe in recipes:
+            self.add(recipe)
 
-            if len(recipes) == 0:
-                self.logger.warn("pattern did not result in any entry")
-                return None
 
-            if len(recipes) > 1:
-                self.logger.warn("pattern did not result in a unique entry")
-                return None
 
-            recipe = recipes[0]
+    def __len__(self):
 
+        return sum(len(l) for l in self.byName.values())
 
 
-class Session(object):
 
-    """Representation of a user session on the Grainfather brew community database."""
-    
-    session = None
-    username = None
-    logger = None
-    readonly = False
-    headers = {}
-    cookies = {}
-    state = {}
+    def __contains__(self, name):
 
+        return name in self.byName
 
 
-    def get(self, url, relogin=True, redirect=False):
 
-        response = self.session.get(url, headers=self.headers, cookies=self.cookies, allow_redirects=redirect)
-        self.logger.info("GET %s -> %s" % (url, response.status_code))
-        if (response.status_code == 401) or ((response.status_code == 302) and ("/login" in response.headers["Location"])):
-            if relogin:
-                # if the response seems to be the login page
-                self.login()
-            response = self.session.get(url, headers=self.headers, cookies=self.cookies)
-            self.logger.info("GET %s -> %s" % (url, response.status_code))
-        return response
+    def add(self, recipe):
 
+        self.byName.setdefault(recipe.get("name"), []).append(recipe)
+        id = recipe.get("id")
+        if id is not None:
+            self.byId[id] = recipe
 
 
-    def post(self, url, data=None, json=None, files=None, force=False, relogin=True, redirect=False):
 
-        if (self.readonly == False) or force:
-            response = self.session.post(url, headers=self.headers, cookies=self.cookies, data=data, json=json, files=files, allow_redirects=redirect)
-            self.logger.info("POST %s -> %s" % (url, response.status_code))
-            if (response.status_code == 401) or ((response.status_code == 302) and ("/login" in response.headers["Location"])):
-                if relogin:
-                    # if the response seems to be the login page
-                    self.login()
-                response = self.session.post(url, headers=self.headers, cookies=self.cookies, data=data, json=json, files=files)
-                self.logger.info("POST %s -> %s" % (url, response.status_code))
-        else:
-            self.logger.info("POST %s (dryrun)" % (url))
-            response = None
-        return response
+    def get(self, name):
 
+        """Returns the first recipe of the given name or None."""
 
+        l = self.byName.get(name)
+        return l[0] if l else None
 
-    def put(self, url, data=None, json=None, force=False, relogin=True):
 
-        if (self.readonly == False) or force:
-            response = self.session.put(url, headers=self.headers, cookies=self.cookies, data=data, json=json, allow_redirects=False)
-            self.logger.info("PUT %s -> %s" % (url, response.status_code))
-            if (response.status_code == 401) or ((response.status_code == 302) and ("/login" in response.headers["Location"])):
-                if relogin:
-                    # if the response seems to be the login page
-                    self.login()
-                response = self.session.put(url, headers=self.headers, cookies=self.cookies, data=data, json=json)
-                self.logger.info("PUT %s -> %s" % (url, response.status_code))
-        else:
-            self.logger.info("PUT %s (dryrun)" % (url))
-            response = None
-        return response
 
+    def getAll(self, name):
 
+        return self.byName.get(name, [])
 
-    def delete(self, url, force=False, relogin=True):
 
-        if (self.readonly == False) or force:
-            response = self.session.delete(url, headers=self.headers, cookies=self.cookies, allow_redirects=False)
-            self.logger.info("DELETE %s -> %s" % (url, response.status_code))
-            if (response.status_code == 401) or ((response.status_code == 302) and ("/login" in response.headers["Location"])):
-                if relogin:
-                    # if the response seems to be the login page
-                    self.login()
-                response = self.session.delete(url, headers=self.headers, cookies=self.cookies)
-                self.logger.info("DELETE %s -> %s" % (url, response.status_code))
-        else:
-            self.logger.info("DELETE %s (dryrun)" % (url))
-            response = None
-        return response
 
+    def getById(self, id):
 
+        return self.byId.get(id)
 
-    def saveState(self, response):
-        
-        # save session information persistently for subsequent program calls
-        self.state["username"] = self.username
-        self.state["cookies"] = response.cookies.get_dict()
-        with open(os.path.expanduser(self.stateFile), "w") as f:
-            json.dump(self.state, f, sort_keys=True, indent=4)
-        self.logger.info("Saved session state to %s" % (self.stateFile))
 
 
+    def names(self):
 
-    def loadState(self):
+        return self.byName.keys()
 
-        try:
-            f = open(os.path.expanduser(self.stateFile))
-            self.state = json.load(f)
-            f.close()
-            self.username = self.state["username"]
-            self.cookies.update(self.state["cookies"])
-            self.headers.update({'X-CSRF-TOKEN': self.state["csrfToken"]})
-            self.headers.update({'X-XSRF-TOKEN': self.state["xsrfToken"]})
-            self.logger.info("Read session state from %s" % (self.stateFile))
-        except Exception as error:
-            self.logger.debug("No valid session state found at %s: %s" % (self.stateFile, error))
 
 
+    def duplicates(self):
 
-    def removeState(self):
+        """Returns a dict of all names that refer to more than one
+        recipe, mapped to these recipes."""
 
-        os.remove(os.path.expanduser(self.stateFile))
-        self.logger.info("Removed session state file %s" % (self.stateFile))
+        return { name: l for name, l in self.byName.items() if len(l) > 1 }
 
 
 
-    def __init__(self, username=None, password=None, readonly=False, force=False, stateFile=None):
+    def join(*indexes):
 
-        self.username = username
-        self.password = password
-        self.readonly = readonly
-        self.force = force
-        self.stateFile = stateFile
+        """Iterates over the union of the names of all given indexes
+        in sorted order and yields tuples of the name and the first
+        recipe of that name in each index (or None)."""
 
-        self.logger = logging.getLogger('session')
+        names = set()
+        for index in indexes:
+            names.update(index.names())
 
-        self.session = requests.session()
+        for name in sorted(names):
+            yield (name,) + tuple(index.get(name) for index in indexes)
 
-        # seems to be necessary:
-        self.headers.update({'User-Agent': "Mozilla/5.0 (or something else)" })
-        self.cookies.update({'_ga_ssr': "-658533274" })
 
-        if self.stateFile:
-            self.loadState()
-            
-        self.brewingEquipment = BrewingEquipment(self)
 
+class JsonDiff(object):
 
+    """Structural comparison of two JSON documents. Differences are
+    reported by field path, e.g. "hops[Cascade].amount". Items of
+    lists of named objects are matched by name (the second item of
+    the same name as "[Cascade#2]"), other lists by position. Numbers
+    are equal within a relative or absolute tolerance. Fields that are
+    maintained by the server (ids, timestamps) are ignored, as well as
+    fields that only the right document has, unless all is set. A
+    missing field equals a null field."""
 
-    def login(self):
-        
-        # fetch start page, we expect to get redirected to oauth login page
-        response = self.get("https://brew.grainfather.com/login", relogin=False, redirect=True)
+    IGNORED = ("id", "user_id", "recipe_id", "created_at", "updated_at", "deleted_at")
 
-        # pick the form_key from the login form
-        form_key = None
-        oauth_token = None
-        for line in response.text.splitlines():
-            if "form_key" in line:
-                form_key = re.sub(r'^.*value="([a-zA-Z_0-9]*).*$', r'\1', line)
-            if "oauth_token" in line:
-                oauth_token = re.sub(r'^.*value="([a-zA-Z_0-9]*).*$', r'\1', line)
-        if (not form_key or not oauth_token):
-            self.logger.error("Could not fetch form_key and/or oauth_token from login page")
+    def __init__(self, tolerance=0.001, ignored=IGNORED, all=False):
+
+        self.tolerance = tolerance
+        self.ignored = set(ignored)
+        self.all = all
+
+
+
+    def compare(self, left, right, path=""):
+
+        """Returns a list of tuples of path, left value and right value.
+        A value of None denotes a missing item."""
+
+        differences = []
+        self.compareValues(left, right, path, differences)
+
+        return differences
+
+
+
+    def compareValues(self, left, right, path, differences):
+
+        if isinstance(left, dict) and isinstance(right, dict):
+            for key in sorted(set(left) | set(right)):
+                if key in self.ignored:
+                    continue
+                if (key not in left) and not self.all:
+                    continue
+                self.compareValues(left.get(key), right.get(key), "%s.%s" % (path, key) if path else key, differences)
+
+        elif isinstance(left, list) and isinstance(right, list):
+            l = self.keyed(left)
+            r = self.keyed(right)
+            for key in list(l.keys()) + [ k for k in r.keys() if k not in l ]:
+                self.compareValues(l.get(key), r.get(key), "%s[%s]" % (path, key), differences)
+
+        elif not self.equal(left, right):
+            differences.append((path, left, right))
+
+
+
+    def keyed(self, items):
+
+        """Returns an ordered dict of the items of a list, keyed by name
+        or by position."""
+
+        keyed = collections.OrderedDict()
+        for i, item in enumerate(items):
+            if isinstance(item, dict) and item.get("name") is not None:
+                key = str(item["name"])
+                n = 2
+                while key in keyed:
+                    key = "%s#%d" % (item["name"], n)
+                    n += 1
+            else:
+                key = str(i)
+            keyed[key] = item
+
+        return keyed
+
+
+
+    def equal(self, left, right):
+
+        if isinstance(left, bool) or isinstance(right, bool):
+            return left == right
+        if isinstance(left, (int, float)) and isinstance(right, (int, float)):
+            return math.isclose(left, right, rel_tol=self.tolerance, abs_tol=self.tolerance)
+
+        return left == right
+
+
+
+    def format(differences):
+
+        """Returns the lines of a list of differences, "~" for changed,
+        "-" for missing on the right and "+" for missing on the left."""
+
+        lines = []
+        for (path, left, right) in differences:
+            if right is None:
+                lines.append("- %s: %s" % (path, json.dumps(left, sort_keys=True)))
+            elif left is None:
+                lines.append("+ %s: %s" % (path, json.dumps(right, sort_keys=True)))
+            else:
+                lines.append("~ %s: %s -> %s" % (path, json.dumps(left, sort_keys=True), json.dumps(right, sort_keys=True)))
+
+        return lines
+
+
+
+class BrewCache(object):
+
+    """Brew session listings of GF recipes (id, created_at and
+    updated_at of each brew), kept in a JSON file between program
+    runs. Listings older than maxAge seconds are not returned. Own
+    changes are recorded from the server's responses, so the cache
+    stays current without asking the server."""
+
+    def __init__(self, filename=None, maxAge=86400):
+
+        self.filename = filename
+        self.maxAge = maxAge
+        self.recipes = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('cache')
+
+        if self.filename:
+            self.load()
+
+
+
+    def load(self):
+
+        try:
+            with open(os.path.expanduser(self.filename)) as f:
+                self.recipes = json.load(f)
+            self.logger.info("Read %d brew listings from %s" % (len(self.recipes), self.filename))
+        except FileNotFoundError:
+            pass
+        except Exception as error:
+            self.logger.warning("Could not read brew cache %s: %s" % (self.filename, error))
+
+
+
+    def save(self):
+
+        if not self.filename:
             return
 
-        # post to the login form
-        payload = {'form_key': form_key, 'oauth_token': oauth_token, 'login[username]': self.username, 'login[password]': self.password}
-        response = self.post("https://oauth.grainfather.com/customer/account/loginPost/", data=payload, relogin=False, redirect=True)
+        with self.lock:
+            data = json.dumps(self.recipes, sort_keys=True, indent=4)
+        filename = os.path.expanduser(self.filename)
+        with open(filename + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(filename + ".tmp", filename)
 
-        self.state["xsrfToken"] = response.cookies.get_dict()["XSRF-TOKEN"]
 
-        #response = self.get("https://brew.grainfather.com/whats-new-notifications/data?page=1", relogin=False, redirect=False)
-        
-        # fetch start page from the recipe creator
-        response = self.get("https://brew.grainfather.com", relogin=False)
 
-        # pick session metadata from response and set the CSRF token for this session
-        metadata = None
-        for line in response.text.splitlines():
-            if "window.Grainfather" in line:
-                s = re.sub(r'window.Grainfather *= *', r'', line)
-                metadata = json.loads(s)
-        if (not metadata):
-            self.logger.error("Could not fetch session metadata from login response")
+    def entry(brew):
+
+        return { "id": brew.get("id"), "created_at": brew.get("created_at"), "updated_at": brew.get("updated_at") }
+
+
 
-        self.state["csrfToken"] = metadata["csrfToken"]
-        self.state["api_token"] = metadata["user"]["api_token"]
+    def get(self, recipe_id):
 
-        self.headers.update({'X-CSRF-TOKEN': self.state["csrfToken"]})
-        self.headers.update({'X-XSRF-TOKEN': self.state["xsrfToken"] })
+        """Returns the cached listing of a GF recipe as a list of dicts,
+        or None if it is unknown or too old."""
 
-        self.saveState(response)
+        with self.lock:
+            entry = self.recipes.get(str(recipe_id))
+        if entry and (time.time() - entry["fetched"] <= self.maxAge):
+            return entry["brews"]
 
-        #response = self.get("https://brew.grainfather.com/api/terms-and-conditions/data?api_token=%s" % (self.state["api_token"]), relogin=False, redirect=True)
+        return None
 
-        #response = self.get("https://brew.grainfather.com/my-recipes")
 
 
+    def put(self, recipe_id, brews):
 
-    def logout(self):
+        """Records the complete listing of a GF recipe and returns it."""
 
-        response = self.get("https://brew.grainfather.com/logout", relogin=False)
+        listing = [ BrewCache.entry(b) for b in brews ]
+        with self.lock:
+            self.recipes[str(recipe_id)] = { "fetched": time.time(), "brews": listing }
 
-        self.removeState()
+        return listing
 
 
 
-    def register(self, obj, recipe_id=None, id=None):
+    def update(self, recipe_id, brew):
 
-        """If the given object has been defined locally and is not yet registered to
-        a Grainfather session, this method will register it without actually saving
-        it to the Grainfather site. Saving can be done by a subsequent save() call
-        on the object."""
+        """Records a single brew of a GF recipe after it has been saved.
+        Without a cached listing nothing is known about other brews, so
+        nothing is recorded."""
 
-        if id:
-            obj.set("id", id)
+        with self.lock:
+            entry = self.recipes.get(str(recipe_id))
+            if entry is None:
+                return
+            entry["brews"] = [ b for b in entry["brews"] if b["id"] != brew.get("id") ] + [ BrewCache.entry(brew) ]
+
+
+
+class SyncJournal(object):
+
+    """Records which GF recipe and brew each KBH sud has been pushed
+    to, together with the content hashes and timestamps of the last
+    successful push, in an SQLite file. This lets push update recipes
+    by their id, even after a rename in KBH, and skip unchanged
+    recipes and brews without asking the server. Each record is
+    committed right away, the entries are also kept in memory.
+
+    Sud IDs are only unique within a KBH database, and recipe ids
+    within a GF account, so entries and runs belong to a scope of KBH
+    file, GF user and site. Entries of other scopes are not seen, the
+    suds are matched by name as if they had never been pushed.
+
+    The journal also holds a checkpoint of each push run: its
+    arguments and the state of each operation of its plan (pending,
+    started, done or failed), so that an interrupted run can be
+    resumed. A create is marked as started, with the Sync-ID that is
+    put into the recipe notes, before it is sent, so a recipe whose
+    creation had an unknown outcome can be found again."""
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS recipes (
+            scope TEXT NOT NULL,
+            sud_id INTEGER NOT NULL,
+            recipe_id INTEGER NOT NULL,
+            name TEXT,
+            hash TEXT,
+            kbh_updated_at TEXT,
+            gf_updated_at TEXT,
+            brew_id INTEGER,
+            brew_hash TEXT,
+            pushed_at TEXT,
+            PRIMARY KEY (scope, sud_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            scope TEXT NOT NULL,
+            args TEXT,
+            status TEXT,
+            started_at TEXT,
+            finished_at TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS operations (
+            run_id TEXT,
+            seq INTEGER,
+            kind TEXT,
+            sud_id INTEGER,
+            name TEXT,
+            status TEXT,
+            id INTEGER,
+            sync_id TEXT,
+            hash TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (run_id, seq)
+        )""",
+        ]
+
+    def __init__(self, filename, scope=""):
+
+        self.filename = filename
+        self.scope = scope
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('journal')
+
+        # used by the executor's worker threads, serialized by the lock
+        self.conn = sqlite3.connect(os.path.expanduser(filename), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            columns = [ row["name"] for row in self.conn.execute("PRAGMA table_info(recipes)") ]
+            if columns and ("scope" not in columns):
+                # entries without a scope cannot be trusted, the suds
+                # are simply matched by name again
+                self.logger.warning("Discarding unscoped entries of %s" % (filename))
+                for table in ("recipes", "runs", "operations"):
+                    self.conn.execute("DROP TABLE IF EXISTS %s" % (table))
+            for statement in SyncJournal.SCHEMA:
+                self.conn.execute(statement)
 
-        if recipe_id:
-            obj.set("recipe_id", recipe_id)
+        self.entries = { row["sud_id"]: dict(row) for row in self.conn.execute("SELECT * FROM recipes WHERE scope = ?", (scope,)) }
+        self.logger.info("Read %d journal entries of %s from %s" % (len(self.entries), scope, filename))
 
-        if obj.session == None:
-            obj.session = self
-        else:
-            self.logger.error("%s is already registered to a session" % obj)
 
 
+    def scopeOf(kbhPath, username, baseUrl):
 
-    def __str__(self):
+        """Returns the scope of a KBH file pushed to a GF account."""
 
-        return "<Session of user %s>" % (self.username)
+        return "%s|%s|%s" % (os.path.realpath(os.path.expanduser(kbhPath)), username, baseUrl)
 
 
 
-    def getRecipe(self, id):
+    def get(self, sud_id):
 
-        return Recipe(self, id=id)
+        """Returns the entry of a sud as a dict, or None."""
 
+        if sud_id is None:
+            return None
 
+        with self.lock:
+            entry = self.entries.get(sud_id)
+            return dict(entry) if entry else None
 
-    def getMyRecipes(self, namepattern=None, full=False, brews=False):
 
-        recipes = []
 
-        url = "https://brew.grainfather.com/my-recipes/data?page=1"
+    def recordRecipe(self, sud_id, recipe, hash, kbh_updated_at):
 
-        while url:
+        """Records a successful push of a sud's recipe."""
 
-            response = self.get(url)
-            responsedata = json.loads(response.text)
+        entry = self.get(sud_id) or { "brew_id": None, "brew_hash": None }
+        if entry.get("recipe_id") not in (None, recipe.get("id")):
+            # pushed to another recipe, so the brew is unknown there
+            entry.update(brew_id=None, brew_hash=None)
+        entry.update(scope=self.scope, sud_id=sud_id, recipe_id=recipe.get("id"), name=recipe.get("name"), hash=hash,
+                     kbh_updated_at=kbh_updated_at, gf_updated_at=recipe.get("updated_at"),
+                     pushed_at=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"))
+        self.write(entry)
 
-            for data in responsedata["data"]:
-                recipe = Recipe(data=data)
-                self.register(recipe)
-                recipes.append(recipe)
-                    
-            if "next_page_url" in responsedata:
-                url = responsedata["next_page_url"]
-            else:
-                break
 
-        if namepattern:
-            recipes = list(filter(lambda r: fnmatch.fnmatch(r.get("name"), namepattern), recipes))
 
-        if full:
-            for recipe in recipes:
-                recipe.reload()
+    def recordBrew(self, sud_id, brew, hash):
 
-        if brews:
-            for recipe in recipes:
-                recipe.getBrews(full=full)
-                # XXX print(json.dumps(recipe.brews[0].data, sort_keys=True, indent=4))
+        """Records a successful push of a sud's brew."""
 
-        return recipes
+        entry = self.get(sud_id)
+        if entry is None:
+            return
+        entry.update(brew_id=brew.get("id"), brew_hash=hash)
+        self.write(entry)
 
 
 
-    def getMyRecipe(self, namepattern=None, id=None, full=True, brews=False):
+    def write(self, entry):
 
-        if id:
+        with self.lock:
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO recipes (scope, sud_id, recipe_id, name, hash, kbh_updated_at, gf_updated_at, brew_id, brew_hash, pushed_at) "
+                                  "VALUES (:scope, :sud_id, :recipe_id, :name, :hash, :kbh_updated_at, :gf_updated_at, :brew_id, :brew_hash, :pushed_at)", entry)
+            self.entries[entry["sud_id"]] = entry
 
-            recipe = Recipe(session=self.session, id=id)
 
-            return recipe
 
-        else:
+    def forget(self, sud_id):
 
-            recipes = self.getMyRecipes(namepattern, full=full, brews=brews)
+        """Removes the entry of a sud, e.g. after its GF recipe has been
+        deleted, so that it is matched by name again."""
 
-            if len(recipes) == 0:
-                self.logger.warn("pattern did not result in any entry")
-                return None
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM recipes WHERE scope = ? AND sud_id = ?", (self.scope, sud_id))
+            self.entries.pop(sud_id, None)
 
-            if len(recipes) > 1:
-                self.logger.warn("pattern did not result in a unique entry")
-                return None
 
-            return recipes[0]
 
+    def claimed(self):
 
+        """Returns the ids of all GF recipes of the journal."""
 
-    
+        with self.lock:
+            return set(entry["recipe_id"] for entry in self.entries.values())
 
 
-class AdjunctUsageType(Enum):
 
-    MASH		= 10	# min
-    SPARGE		= 15	# min
-    BOIL		= 20	# min
-    FLAMEOUT		= 25	# min
-    PRIMARY		= 30	# days
-    SECONDARY		= 40	# days
-    BOTTLE		= 50	# min
+    def startRun(self, plan, args):
 
+        """Records a push run with its arguments and the operations of
+        its plan, returns the run id. Skips are done right away. Each
+        operation is numbered by its position in the plan (seq)."""
 
+        run_id = uuid.uuid4().hex
+        rows = []
+        for seq, operation in enumerate(plan.operations):
+            operation.seq = seq
+            sud_id = operation.source.kbhId if operation.kind in ("create", "update", "skip") else operation.parent.source.kbhId
+            status = "pending" if operation.requests else "done"
+            rows.append((run_id, seq, operation.kind, sud_id, operation.name, status, operation.id, operation.updated_at))
 
-class FermentableUsageType(Enum):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("INSERT INTO runs (run_id, scope, args, status, started_at) VALUES (?, ?, ?, 'running', ?)",
+                                  (run_id, self.scope, json.dumps(args), datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")))
+                self.conn.executemany("INSERT INTO operations (run_id, seq, kind, sud_id, name, status, id, updated_at) "
+                                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
 
-    MASH		= 10
-    EXTRACT		= 20
-    STEEP		= 30
-    LATEADDITION	= 40	# what is this? probably after boil during fermentation or even later?
+        return run_id
 
 
 
-class HopType(Enum):
+    def checkpoint(self, run_id, seq, status, id=None, sync_id=None, hash=None):
 
-    LEAF		= 10
-    PELLET		= 20
-    PLUG		= 30
-    EXTRACT             = 40    # ???
+        """Records the state of an operation of a run."""
 
-    def getBrewfather(id):
-        
-        if id == HopType.LEAF.value:
-            return "Leaf"
-        elif id == HopType.PELLET.value:
-            return "Pellet"
-        elif id == HopType.PLUG.value:
-            return "Plug"
-        elif id == HopType.EXTRACT.value:
-            return "Extract"
-        else:
-            return "Unknown"
+        with self.lock:
+            with self.conn:
+                self.conn.execute("UPDATE operations SET status = ?, id = coalesce(?, id), sync_id = coalesce(?, sync_id), "
+                                  "hash = coalesce(?, hash) WHERE run_id = ? AND seq = ?",
+                                  (status, id, sync_id, hash, run_id, seq))
 
 
 
-class HopUsageType(Enum):
+    def finishRun(self, run_id, status):
 
-    MASH		= 10	# min
-    FIRSTWORT		= 15	# min
-    BOIL		= 20	# min
-    HOPSTAND		= 30	# min # obsolete?
-    AROMA		= 30	# min
-    DRYHOP		= 40	# days
+        """Records the end of a run. Runs that are "running" or
+        "incomplete" can be resumed."""
 
-    def getBrewfather(id):
-        
-        if id == HopUsageType.MASH.value:
-            return "Mash"
-        elif id == HopUsageType.FIRSTWORT.value:
-            return "First Wort"
-        elif id == HopUsageType.BOIL.value:
-            return "Boil"
-        elif id == HopUsageType.HOPSTAND.value:
-            return "Hopstand"
-        elif id == HopUsageType.AROMA.value:
-            return "Aroma"
-        elif id == HopUsageType.DRYHOP.value:
-            return "Dry Hop"
-        else:
-            return "Unknown"
+        with self.lock:
+            with self.conn:
+                self.conn.execute("UPDATE runs SET status = ?, finished_at = ? WHERE run_id = ?",
+                                  (status, datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"), run_id))
 
 
 
-class RecipeType(Enum):
+    def unfinishedRun(self):
 
-    ALLGRAIN		= 10
-    # TBD: others?
+        """Returns the latest run that has not finished successfully as
+        a dict of run_id, args and status, or None."""
 
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM runs WHERE scope = ? AND status IN ('running', 'incomplete') "
+                                    "ORDER BY started_at DESC, rowid DESC LIMIT 1", (self.scope,)).fetchone()
+        if row is None:
+            return None
 
+        return dict(row, args=json.loads(row["args"]))
 
-class UnitType(Enum):
 
-    METRIC		= 10
-    # TBD: others?
 
+    def operations(self, run_id, statuses):
 
+        """Returns the operations of a run in the given states as dicts."""
 
-YeastUnitTypes = [ "packets", "vials", "g", "ml" ]
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM operations WHERE run_id = ? AND status IN (%s) ORDER BY seq" %
+                                     (", ".join("?" for s in statuses)), [ run_id ] + list(statuses)).fetchall()
 
+        return [ dict(row) for row in rows ]
 
 
-AdjunctUnitTypes = [ "each", "kg", "g", "l", "ml", "tbsp", "tsp" ]
 
+class ResidentIndex(RecipeIndex):
 
+    """Index of the GF recipes of a long running process, e.g. the
+    daemon. It is filled by a full listing, which is repeated only on a
+    slow schedule, and kept current from the responses to the
+    process's own saves in between. For each saved recipe, the hash of
+    the document sent is kept, so that unchanged content can be
+    recognized regardless of timestamps."""
 
-class BrewStatusType(Enum):
+    def __init__(self, recipes=()):
 
-    BREWDAY		= 10
-    FERMENTATION	= 20
-    CONDITIONING	= 30
-    COMPLETE		= 40
+        self.lock = threading.RLock()
+        self.hashes = {}
+        self.touched = {}
+        self.refreshed = None
+        super(ResidentIndex, self).__init__(recipes)
 
-    def getName(id):
-        
-        if id == BrewStatusType.BREWDAY.value:
-            return "Brew Day"
-        elif id == BrewStatusType.FERMENTATION.value:
-            return "Fermentation"
-        elif id == BrewStatusType.CONDITIONING.value:
-            return "Conditioning"
-        elif id == BrewStatusType.COMPLETE.value:
-            return "Complete"
-        else:
-            return "Unknown"
 
 
+    def add(self, recipe):
 
-class ConditionType(Enum):
+        with self.lock:
+            super(ResidentIndex, self).add(recipe)
 
-    BOTTLE		= 10
-    KEG          	= 20
 
-    def getName(id):
-        
-        if id == ConditionType.BOTTLE.value:
-            return "Bottle"
-        elif id == ConditionType.KEG.value:
-            return "Keg"
-        else:
-            return "Unknown"
 
+    def recipes(self):
 
+        """Returns a list of all recipes."""
 
-class Object(object):
+        with self.lock:
+            return [ recipe for l in self.byName.values() for recipe in l ]
 
-    session = None
-    data = {}
 
 
+    def getHash(self, id):
 
-    def __init__(self, session=None, id=None, data={}):
+        with self.lock:
+            return self.hashes.get(id)
 
-        self.session = session
-        self.data = data
 
-        if self.data:
-            self.tidy()
-        
-        if self.session:
-            
-            if id:
 
-                self.reload(id=id)
+    def age(self):
 
-            elif data:
-                
-                self.save()
+        """Returns the seconds since the last full listing."""
 
+        return (time.monotonic() - self.refreshed) if self.refreshed is not None else float("inf")
 
 
-    def tidy(self):
 
-        return
+    def refresh(self, session):
 
+        """Replaces the contents by a full listing of the GF site.
+        Recipes saved while the listing is fetched are kept, the listing
+        may already be outdated for them."""
 
+        started = time.monotonic()
+        listing = session.getMyRecipes()
 
-    def reload(self, id=None, recipe_id=None):
+        with self.lock:
+            kept = [ recipe for id, recipe in self.byId.items() if self.touched.get(id, 0) > started ]
+            keptIds = set(r.get("id") for r in kept)
+            self.byName = {}
+            self.byId = {}
+            for recipe in listing:
+                if recipe.get("id") not in keptIds:
+                    super(ResidentIndex, self).add(recipe)
+            for recipe in kept:
+                super(ResidentIndex, self).add(recipe)
+            self.hashes = { id: h for id, h in self.hashes.items() if id in self.byId }
+            self.refreshed = started
 
-        if not id and ("id" in self.data):
-            id = self.data["id"]
-        if not recipe_id and "recipe_id" in self.data:
-            recipe_id = self.data["recipe_id"]
-            
-        response = self.session.get(self.urlload.format(api_token=self.session.state["api_token"], recipe_id=recipe_id, id=id))
+        session.logger.info("Refreshed index of %d GF recipes" % (len(self.byId)))
 
-        if response and response.status_code == 200:
-            self.data = json.loads(response.text)
 
 
+    def update(self, recipe, hash=None):
 
-    def save(self, id=None, recipe_id=None):
+        """Records a recipe after it has been saved, replacing an entry
+        of the same id."""
 
-        if id:
-            self.data["id"] = id
+        id = recipe.get("id")
+        with self.lock:
+            self.remove(id)
+            super(ResidentIndex, self).add(recipe)
+            if hash:
+                self.hashes[id] = hash
+            self.touched[id] = time.monotonic()
 
-        if recipe_id:
-            self.data["recipe_id"] = recipe_id
 
-        if not recipe_id and "recipe_id" in self.data:
-            recipe_id = self.data["recipe_id"]
 
-        self.tidy()
+    def remove(self, id):
 
-        if self.isBound():
-            response = self.session.put(self.urlsave.format(api_token=self.session.state["api_token"], recipe_id=recipe_id, id=self.data["id"]), json=self.data)
-        else:
-            response = self.session.post(self.urlcreate.format(api_token=self.session.state["api_token"], recipe_id=recipe_id), json=self.data)
+        with self.lock:
+            old = self.byId.pop(id, None)
+            if old is not None:
+                l = self.byName.get(old.get("name"), [])
+                l[:] = [ r for r in l if r is not old ]
+                if not l:
+                    self.byName.pop(old.get("name"), None)
+            self.hashes.pop(id, None)
 
-        if response and response.status_code == 200:
-            self.data = json.loads(response.text)
 
 
+class SyncOperation(object):
 
-    def delete(self):
+    """A single step of a sync plan: what to do with one KBH recipe or
+    brew, why, and how many requests it is expected to cost. Brew
+    operations of a recipe that is still to be created refer to the
+    recipe operation as parent, which provides the GF recipe id."""
 
-        response = self.session.delete(self.urlsave.format(api_token=self.session.state["api_token"], id=self.data["id"]))
+    KINDS = ("create", "update", "skip", "brew-create", "brew-update", "brew-skip")
 
+    def __init__(self, kind, name, reason, requests=0, source=None, id=None, recipe_id=None, parent=None, updated_at=None):
 
+        self.kind = kind
+        self.name = name
+        self.reason = reason
+        self.requests = requests
+        self.source = source
+        self.id = id
+        self.recipe_id = recipe_id
+        self.parent = parent
+        self.updated_at = updated_at
+        self.status = "planned"
+        self.error = None
+        self.seq = None
 
-    def __str__(self):
 
-        s = "<"
-#        if "status" in self.data:
-#            s += "%s " % self.data["status"]
-#        else:
-#            if self.session:
-#                s += "registered "
-#            else:
-#                s += "unregistered "
-        if self.session:
-            s += "registered "
-        else:
-            s += "unregistered "
-        s += "%s" % (self.__class__.__name__)
-        if "id" in self.data:
-            s += " id %s" % self.data["id"]
-        if "name" in self.data:
-            s += " named \"%s\"" % self.data["name"]
-        s += ">"
 
-        return s
+    def isBrew(self):
 
+        return self.kind.startswith("brew-")
 
 
-    def __repr__(self):
 
-        return self.__str__()
+    def toDict(self):
 
+        return {
+            "kind": self.kind,
+            "name": self.name,
+            "reason": self.reason,
+            "requests": self.requests,
+            "id": self.id,
+            "recipe_id": self.recipe_id if (self.recipe_id or not self.parent) else self.parent.id,
+            "updated_at": self.updated_at,
+            "status": self.status,
+            "error": self.error }
 
 
-    def set(self, attr, value):
 
-        self.data[attr] = value
+    def __str__(self):
 
+        return "<SyncOperation %s named \"%s\">" % (self.kind, self.name)
 
 
-    def get(self, attr):
 
-        if attr in self.data:
-            return self.data[attr]
-        else:
-            return None
+class SyncPlan(object):
 
+    """The ordered operations of a push. The requests needed to build
+    the plan (listings) are counted separately from the requests the
+    operations are estimated to cost."""
 
+    ORDERS = ("plan", "name", "date", "cost")
 
-    def isBound(self):
+    def __init__(self, operations=None, requests=0):
 
-        """Checks whether the object has a server-side representation."""
+        self.operations = operations if operations is not None else []
+        self.requests = requests
 
-        if "id" in self.data:
-            return True
-        else:
-            return False
 
 
+    def add(self, operation):
 
-    def isFull(self):
+        self.operations.append(operation)
 
-        """Checks whether the object contains all attributes. When
-        false, some attributes may be missing, which happens for
-        search results, for example."""
+        return operation
 
-        return True
 
 
+    def chains(self, order="plan"):
 
-    def print(self):
+        """Returns lists of operations that have to run in sequence: each
+        recipe operation followed by the operations of its brews. The
+        chains are ordered by plan order, by name, by the KBH
+        modification time (oldest first) or by cost (most requests
+        first, so that long chains start early)."""
 
-        if self.isBound() and (not self.isFull()):
-            self.reload()
+        chains = []
+        byRecipe = {}
+        for operation in self.operations:
+            if operation.isBrew() and operation.parent in byRecipe:
+                byRecipe[operation.parent].append(operation)
+            else:
+                chain = [ operation ]
+                chains.append(chain)
+                byRecipe[operation] = chain
 
-        print(json.dumps(self.data, sort_keys=True, indent=4))
+        if order == "name":
+            chains.sort(key=lambda c: c[0].name)
+        elif order == "date":
+            chains.sort(key=lambda c: c[0].updated_at or "")
+        elif order == "cost":
+            chains.sort(key=lambda c: -sum(o.requests for o in c))
+        elif order != "plan":
+            raise ValueError("unknown order %s" % (order))
 
+        return chains
 
 
-class Recipe(Object):
 
-    urlload = "https://brew.grainfather.com/recipes/data/{id}"
-    urlsave = "https://brew.grainfather.com/recipes/{id}"
-    urlcreate = "https://brew.grainfather.com/recipes"
+    def summary(self):
 
-    brews = None
+        """Returns a dict of operation kinds mapped to the number of
+        operations and their estimated requests."""
 
+        summary = collections.OrderedDict()
+        for kind in SyncOperation.KINDS:
+            operations = [ o for o in self.operations if o.kind == kind ]
+            if operations:
+                summary[kind] = { "operations": len(operations), "requests": sum(o.requests for o in operations) }
 
+        return summary
 
-    def __init__(self, session=None, id=None, xmlfilename=None, data=None, brew_data=None):
 
-        if session and xmlfilename:
 
-            # post xml to convert to json
-            self.session.logger.info("Converting XML recipe file to JSON")
-            response = self.session.post("https://brew.grainfather.com/recipes/xml", files={'xml': (filename, open(filename, 'rb'), 'text/xml')})
-            data = json.loads(response.text)
+    def estimate(self):
 
-        super(Recipe, self).__init__(session=session, id=id, data=data)
+        return sum(o.requests for o in self.operations)
 
-        if brew_data:
-            self.brews = [ Brew(session=session, data=brew_data) ]
-     
 
 
-    def tidy(self):
+    def toDict(self):
+
+        return {
+            "operations": [ o.toDict() for o in self.operations ],
+            "summary": self.summary(),
+            "planning_requests": self.requests,
+            "requests": self.estimate() }
+
+
+
+    def printTable(self):
+
+        print("%-11s %4s %8s %8s %s" % ("operation", "req", "ID", "recipe", "name/reason"))
+        for o in self.operations:
+            recipe_id = o.recipe_id if o.recipe_id else (o.parent.id if o.parent else None)
+            print("%-11s %4d %8s %8s %s (%s)" %
+                  (o.kind, o.requests, o.id if o.id else "-", recipe_id if recipe_id else "-", o.name, o.reason))
+        print()
+        for kind, s in self.summary().items():
+            print("%-11s %4d operations, %4d requests" % (kind, s["operations"], s["requests"]))
+        print("%-11s %4d operations, %4d requests, %d requests to build the plan" %
+              ("total", len(self.operations), self.estimate(), self.requests))
 
-        # add required fields, if missing
-        if not 'unit_type_id' in self.data:
-            self.data['unit_type_id'] = UnitType.METRIC.value;
-        if not 'recipe_type_id' in self.data:
-            self.data['recipe_type_id'] = RecipeType.ALLGRAIN.value;
 
-        # others
-        if not 'source' in self.data:
-            self.data['source'] = DEFAULT_SOURCE
-        if not 'parent_recipe_id' in self.data:
-            self.data['parent_recipe_id'] = None
 
+    def printJson(self):
 
+        print(json.dumps(self.toDict(), sort_keys=True, indent=4))
 
-    def isFull(self):
 
-        """Checks whether the object contains all attributes. When
-        false, some attributes may be missing, which happens for
-        search results, for example."""
 
-        if "fermentables" in self.data:
-            return True
-        else:
-            return False
+class SyncPlanner(object):
 
+    """Decides for each KBH recipe (and its brew) whether it has to be
+    created on the GF site, updated or skipped, without writing
+    anything. Recipes pushed before are found in the SyncJournal by
+    their sud, all others are matched by name, brews by brew date.
+    Recipes and brews whose content is unchanged since their last push
+    are skipped without asking the server, the listing is only needed
+    for suds unknown to the journal.
 
+    Brews are decided from the KBH brew and update dates against the
+    brew listings of a BrewCache. Only if a cached listing is missing,
+    too old or suggests to write, the listing is fetched from the
+    server, up to concurrency listings at a time. So unchanged brews
+    cost no requests at all."""
 
-    def reload(self, full=False, brews=False):
+    def __init__(self, session, brewCache=None, concurrency=1, index=None, journal=None):
 
-        super(Recipe, self).reload()
+        self.session = session
+        self.brewCache = brewCache if brewCache is not None else BrewCache()
+        self.concurrency = max(1, concurrency)
+        self.index = index
+        self.journal = journal
+        self.logger = logging.getLogger('planner')
 
-        if brews:
-            self.getBrews(full=full)
 
 
+    def plan(self, kbh_recipes, gf_recipes, brews=False):
 
-    def toGal(self, value):
+        """Returns the SyncPlan of the KBH recipes. gf_recipes is the
+        listing of the GF recipes, or None if all KBH recipes are in
+        the journal and it has not been fetched."""
 
-        if self.data['unit_type_id'] == UnitType.METRIC.value:
-            return Util.lToGal(value)
-        else:
-            return value
+        plan = SyncPlan()
+        listed = gf_recipes is not None
+        gf_index = RecipeIndex(gf_recipes or [])
 
+        for name, recipes in gf_index.duplicates().items():
+            self.logger.warning("%d GF recipes named \"%s\" (%s), only the first one is synced" %
+                                (len(recipes), name, ", ".join(str(r.get("id")) for r in recipes)))
 
+        # GF recipes of suds in the journal are not matched by name
+        claimed = self.journal.claimed() if self.journal else set()
 
-    def toLb(self, value):
+        # (recipe operation, KBH brew, GF recipe id, journal entry) of all brews to decide
+        pending = []
 
-        if self.data['unit_type_id'] == UnitType.METRIC.value:
-            return Util.kgToLb(value)
-        else:
-            return value
+        seen = set()
+        for kbh_recipe in kbh_recipes:
 
+            name = kbh_recipe.get("name")
+            updated_at = kbh_recipe.get("updated_at")
+
+            entry = self.journal.get(kbh_recipe.kbhId) if self.journal else None
+            if entry and listed and not gf_index.getById(entry["recipe_id"]):
+                self.logger.info("GF recipe %s of \"%s\" is gone, matching by name" % (entry["recipe_id"], name))
+                claimed.discard(entry["recipe_id"])
+                entry = None
+            if entry:
+                operation = plan.add(self.decideJournal(kbh_recipe, entry, gf_index.getById(entry["recipe_id"])))
+                if brews and kbh_recipe.brews:
+                    pending.append((operation, kbh_recipe.brews[0], entry["recipe_id"], entry))
+                continue
+
+            if name in seen:
+                plan.add(SyncOperation("skip", name, "duplicate name in KBH", source=kbh_recipe, updated_at=updated_at))
+                continue
+            seen.add(name)
+
+            gf_recipe = gf_index.get(name)
+            if gf_recipe and gf_recipe.get("id") in claimed:
+                gf_recipe = None
+
+            if not gf_recipe:
+                # with a journal, the Sync-ID is removed by a second request
+                requests = 2 if self.journal is not None else 1
+                operation = plan.add(SyncOperation("create", name, "not on GF", requests, source=kbh_recipe, updated_at=updated_at))
+            elif self.session.force:
+                operation = plan.add(SyncOperation("update", name, "forced", 1, source=kbh_recipe,
+                                                   id=gf_recipe.get("id"), updated_at=updated_at))
+            elif gf_recipe.get("updated_at") > updated_at:
+                operation = plan.add(SyncOperation("skip", name, "GF is newer", source=kbh_recipe,
+                                                   id=gf_recipe.get("id"), updated_at=updated_at))
+            elif self.index and (self.index.getHash(gf_recipe.get("id")) == Util.contentHash(kbh_recipe.toDict())):
+                operation = plan.add(SyncOperation("skip", name, "content unchanged", source=kbh_recipe,
+                                                   id=gf_recipe.get("id"), updated_at=updated_at))
+            else:
+                operation = plan.add(SyncOperation("update", name, "KBH is newer", 1, source=kbh_recipe,
+                                                   id=gf_recipe.get("id"), updated_at=updated_at))
 
+            if brews and kbh_recipe.brews:
+                pending.append((operation, kbh_recipe.brews[0], gf_recipe.get("id") if gf_recipe else None, None))
 
-    def toOz(self, value):
+        if pending:
+            self.planBrews(plan, pending)
 
-        if self.data['unit_type_id'] == UnitType.METRIC.value:
-            return Util.gToOz(value)
-        else:
-            return value
+        return plan
 
 
 
-    def recalculate(self, force=False):
+    def decideJournal(self, kbh_recipe, entry, gf_recipe=None):
 
-        """Recalculate those recipe attributes that are not primarily
-        part of the recipe, but can be derived from other
-        user-adjusted attributes of ingredients, mash steps, etc., and
-        the equipment. Those attributes than can be recalculated but
-        that hold already some value, are only recalculated, if the
-        force flags is True."""
+        """Returns the operation of a KBH recipe that has been pushed
+        before, given its journal entry and, if listed, its GF recipe."""
 
-        ## og       from fermentables (amount, ppg, usage), efficiency, batch_size, losses
-        ## fg       from og and attenuation
-        ## abv      from og and fg
-        ## srm      from fermentables (amount, lovibond), batch_size, losses
-        ## calories from og and fg
-        ## ibu      from hops (amount, aa, time, usage), og
-        ## bugu     from ibu, og
+        name = kbh_recipe.get("name")
+        updated_at = kbh_recipe.get("updated_at")
+        id = entry["recipe_id"]
 
-        ## most parts of these calculations are based on the
-        ## javascript code from the Grainfather web frontend, so that
-        ## our calculations should match those after uploading recipes.
+        if self.session.force:
+            return SyncOperation("update", name, "forced", 1, source=kbh_recipe, id=id, updated_at=updated_at)
+        if gf_recipe and (gf_recipe.get("updated_at") > (entry["gf_updated_at"] or "")) and (gf_recipe.get("updated_at") > updated_at):
+            return SyncOperation("skip", name, "GF changed since last push", source=kbh_recipe, id=id, updated_at=updated_at)
+        if Util.contentHash(kbh_recipe.toDict()) == entry["hash"]:
+            return SyncOperation("skip", name, "unchanged since last push", source=kbh_recipe, id=id, updated_at=updated_at)
+        if entry["name"] != name:
+            return SyncOperation("update", name, "renamed from \"%s\"" % (entry["name"]), 1, source=kbh_recipe, id=id, updated_at=updated_at)
 
-        attenuation = 0.75 # if we do not know any better
-        if ("yeasts" in self.data) and (len(self.data["yeasts"]) > 0):
-            attenuation = 0.0
-            for yeast in self.data["yeasts"]:
-                if ("attenuation" in yeast) and (yeast["attenuation"] > 0):
-                    attenuation += float(yeast["attenuation"])
-                else:
-                    attenuation += 0.75  # if no explicit attenuation is given
-            attenuation /= len(self.data["yeasts"])
-        # TBD: take influence of maltose rest temperature into account
+        return SyncOperation("update", name, "changed since last push", 1, source=kbh_recipe, id=id, updated_at=updated_at)
 
-        postBoilVolume = self.toGal(self.data["batch_size"] + self.data["losses"])
-        color = 0.0
-        earlyGravityPoints = 0.0
-        totalGravityPoints = 0.0
 
-        if ("fermentables" in self.data) and (len(self.data["fermentables"]) > 0):
-            for fermentable in self.data["fermentables"]:
-                if fermentable["amount"] > 0:
-                    if fermentable["fermentable_usage_type_id"] == FermentableUsageType.MASH.value:
-                        efficiency = self.data["efficiency"]
-                    elif fermentable["fermentable_usage_type_id"] == FermentableUsageType.STEEP.value:
-                        efficiency = 0.5 # we assume this as a default steep efficiency
-                    else:
-                        efficiency = 1.0
-                    g = self.toLb(fermentable["amount"]) * fermentable["ppg"] * efficiency / postBoilVolume
-                    totalGravityPoints += g
-                    if fermentable["fermentable_usage_type_id"] != FermentableUsageType.LATEADDITION.value:
-                        earlyGravityPoints += g
-                    color += self.toLb(fermentable["amount"]) * fermentable["lovibond"] / postBoilVolume
-        else:
-            totalGravityPoints = 0.0
-
-        if (force) or (not "og" in self.data) or (self.data["og"] == None) or (float(self.data["og"]) <= 1.000):
-            self.data["og"] = float("%.3f" % (1.0 + totalGravityPoints / 1000))
-        if (force) or (not "fg" in self.data) or (self.data["fg"] == None) or (float(self.data["fg"]) <= 1.000):
-            self.data["fg"] = float("%.3f" % (1.0 + (totalGravityPoints * (1.0 - attenuation)) / 1000))
-        if (force) or (not "abv" in self.data) or (self.data["abv"] == None) or (float(self.data["abv"]) <= 0.0):
-            self.data["abv"] = float("%.01f" % ((self.data["og"] - self.data["fg"]) * 131.25))
-        if (force) or (not "srm" in self.data) or (self.data["srm"] == None) or (float(self.data["srm"]) <= 0.0):
-            self.data["srm"] = float("%.1f" % (1.49 * math.pow(color, 0.69)))
-        if (force) or (not "calories" in self.data) or (self.data["calories"] == None) or (float(self.data["calories"]) <= 0.0):
-            self.data["calories"] = round(1881.22 * self.data["fg"] * (self.data["og"] - self.data["fg"]) / (1.775 - self.data["og"]) + 3550.0 * self.data["fg"] * (0.1808 * self.data["og"] + 0.8192 * self.data["fg"] - 1.0004))
-
-        earlyOG = 1.0 + earlyGravityPoints / 1000
-            
-        totalIBU = 0.0
-        if ("hops" in self.data) and (len(self.data["hops"]) > 0):
-            for hop in self.data["hops"]:
-                ibu = 0.0
-                if hop["hop_usage_type_id"] in [HopUsageType.MASH.value, HopUsageType.FIRSTWORT.value, HopUsageType.BOIL.value, HopUsageType.AROMA.value]:
-                    if hop["hop_usage_type_id"] == HopUsageType.FIRSTWORT.value:
-                        time = self.data["boil_time"]
-                    else:
-                        time = hop["time"]
-                    if hop["hop_usage_type_id"] in [HopUsageType.MASH.value, HopUsageType.FIRSTWORT.value, HopUsageType.BOIL.value]:
-                        factor = 1.1
-                    else:
-                        factor = 1.0
-                    utilization = 1.65 * math.pow(0.000125, earlyOG - 1.0) * (1.0 - math.exp(-0.04 * time)) / 4.15 * factor
-                    ibu = hop["aa"] / 100.0 * self.toOz(hop["amount"]) * 7490 / postBoilVolume * utilization
 
-                    if hop["hop_usage_type_id"] == HopUsageType.AROMA.value:
-                        ibu /= 2
-                    elif hop["hop_usage_type_id"] == HopUsageType.MASH.value:
-                        ibu *= 0.2
-                    elif hop["hop_usage_type_id"] == HopUsageType.FIRSTWORT.value:
-                        ibu *= 1.1 # Note: other sources say that first worst hopping leads to slightly _less_ bitterness ?!
+    def planBrews(self, plan, pending):
 
-                    totalIBU += ibu
-                if (force) or (not "ibu" in hop) or (hop["ibu"] == None):
-                    hop["ibu"] = float("%0.01f" % ibu)
-        if (force) or (not "ibu" in self.data) or (self.data["ibu"] == None) or (float(self.data["ibu"]) <= 0.0):
-            self.data["ibu"] = float("%0.01f" % totalIBU)
-
-        if (force) or (not "bggu" in self.data) or (self.data["bggu"] == None) or (float(self.data["bggu"]) <= 0.0):
-            if (self.data["og"] <= 1.0) and (self.data["ibu"]) > 0:
-                self.data["bggu"] = 1.0
-            elif (self.data["og"] <= 1.0) and (self.data["ibu"]) == 0:
-                self.data["bggu"] = 0.0
+        """Adds the operations of the brews, each right after the
+        operation of its recipe."""
+
+        # first decide from the journal and cached listings, where possible
+        decided = {}
+        unknown = []
+        for (operation, kbh_brew, recipe_id, entry) in pending:
+            if not recipe_id:
+                decided[operation] = SyncOperation("brew-create", operation.name, "new recipe", 1, source=kbh_brew,
+                                                   parent=operation, updated_at=kbh_brew.get("updated_at"))
+                continue
+            if entry and entry["brew_id"] and not self.session.force and (Util.contentHash(kbh_brew.toDict()) == entry["brew_hash"]):
+                decided[operation] = SyncOperation("brew-skip", operation.name, "unchanged since last push", source=kbh_brew,
+                                                   id=entry["brew_id"], recipe_id=recipe_id, parent=operation,
+                                                   updated_at=kbh_brew.get("updated_at"))
+                continue
+            listing = self.brewCache.get(recipe_id)
+            brewOperation = self.decideBrew(operation, kbh_brew, recipe_id, listing) if listing is not None else None
+            if brewOperation and brewOperation.kind == "brew-skip":
+                decided[operation] = brewOperation
             else:
-                self.data["bggu"] = self.data["ibu"] / ((self.data["og"] - 1.0) * 1000)
+                unknown.append((operation, kbh_brew, recipe_id))
+
+        # then fetch the listings of all others and decide again
+        def fetch(recipe_id):
+            return self.brewCache.put(recipe_id, self.session.iterBrews(recipe_id))
+
+        if unknown:
+            self.logger.info("Checking brews of %d of %d recipes" % (len(unknown), len(pending)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                listings = list(pool.map(fetch, [ recipe_id for (operation, kbh_brew, recipe_id) in unknown ]))
+            for (operation, kbh_brew, recipe_id), listing in zip(unknown, listings):
+                decided[operation] = self.decideBrew(operation, kbh_brew, recipe_id, listing)
+
+        operations = []
+        for operation in plan.operations:
+            operations.append(operation)
+            if operation in decided:
+                operations.append(decided[operation])
+        plan.operations = operations
+
+
+
+    def decideBrew(self, operation, kbh_brew, recipe_id, listing):
+
+        """Returns the operation of the KBH brew of a recipe, given
+        the brew listing of the GF recipe as dicts of id, created_at
+        and updated_at."""
+
+        name = operation.name
+        updated_at = kbh_brew.get("updated_at")
+
+        brewDate = Util.utcToLocal(kbh_brew.get("created_at"))[:10]
+        gf_brew = None
+        for brew in listing:
+            if Util.utcToLocal(brew["created_at"])[:10] == brewDate:
+                gf_brew = brew
+
+        if not gf_brew:
+            return SyncOperation("brew-create", name, "no GF brew of %s" % (brewDate), 1, source=kbh_brew,
+                                 recipe_id=recipe_id, parent=operation, updated_at=updated_at)
+        elif self.session.force:
+            return SyncOperation("brew-update", name, "forced", 1, source=kbh_brew,
+                                 id=gf_brew["id"], recipe_id=recipe_id, parent=operation, updated_at=updated_at)
+        elif gf_brew["updated_at"] > updated_at:
+            return SyncOperation("brew-skip", name, "GF brew is newer", source=kbh_brew,
+                                 id=gf_brew["id"], recipe_id=recipe_id, parent=operation, updated_at=updated_at)
+        else:
+            return SyncOperation("brew-update", name, "KBH brew is newer", 1, source=kbh_brew,
+                                 id=gf_brew["id"], recipe_id=recipe_id, parent=operation, updated_at=updated_at)
 
 
 
-    def getBrews(self, full=False):
+class SyncExecutor(object):
 
-        if self.brews != None:
+    """Runs the operations of a sync plan. The operations of a recipe
+    and its brew run in sequence, up to concurrency recipes are
+    processed at the same time. All requests share the rate limit of
+    the session. A failing operation fails the rest of its chain, but
+    not the other recipes."""
 
-            return self.brews
+    def __init__(self, session, concurrency=1, order="plan", brewCache=None, index=None, journal=None, run_id=None):
 
-        self.brews = []
+        self.session = session
+        self.concurrency = max(1, concurrency)
+        self.order = order
+        self.brewCache = brewCache if brewCache is not None else BrewCache()
+        self.index = index
+        self.journal = journal
+        self.run_id = run_id
+        self.logger = logging.getLogger('executor')
 
-        url = "https://brew.grainfather.com/recipes/{recipe_id}/brew-sessions/data?page=1".format(recipe_id=self.get("id"))
 
-        while url:
 
-            response = self.session.get(url)
-            responsedata = json.loads(response.text)
+    def run(self, plan):
 
-            for data in responsedata["data"]:
-                brew = Brew(data=data)
-                self.session.register(brew)
-                self.brews.append(brew)
-                    
-            if "next_page_url" in responsedata:
-                url = responsedata["next_page_url"]
-            else:
-                break
+        """Executes the plan and returns the number of failed operations."""
 
-        if full:
-            for brew in self.brews:
-                brew.reload(recipe_id=self.get("id"))
+        chains = plan.chains(self.order)
+        METRICS.set("grainfather_sync_queue_depth", len(plan.operations))
 
-        return self.brews
+        if self.concurrency == 1:
+            for chain in chains:
+                self.runChain(chain)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                for future in [ pool.submit(self.runChain, chain) for chain in chains ]:
+                    future.result()
+        METRICS.set("grainfather_sync_queue_depth", 0)
 
+        return len([ o for o in plan.operations if o.status == "failed" ])
 
 
-    def convertToBrewfather(self):
 
-        r = {}
+    def runChain(self, chain):
 
-        r["_type"] = "recipe"
-        r["author"] = self.data["author"]
-        r["name"] = self.data["name"]
-        r["notes"] = self.data["notes"]
-        r["description"] = self.data["description"]
+        for operation in chain:
+            try:
+                if operation.parent and operation.parent.status == "failed":
+                    operation.status = "failed"
+                    operation.error = "%s failed" % (operation.parent)
+                    continue
+                try:
+                    operation.status = "done" if self.execute(operation) else "failed"
+                except Exception as error:
+                    self.logger.error("%s: %s" % (operation, error))
+                    operation.status = "failed"
+                    operation.error = str(error)
+                # recorded before the next operation of the chain starts
+                if self.run_id and operation.requests:
+                    self.journal.checkpoint(self.run_id, operation.seq, operation.status, id=operation.id)
+            finally:
+                METRICS.inc("grainfather_sync_queue_depth", -1)
 
-        r["abv"] = self.data["abv"]
-        r["batchSize"] = self.data["batch_size"]
-        r["boilTime"] = self.data["boil_time"]
-        r["buGuRatio"] = self.data["bggu"]
-        r["color"] = self.data["srm"]
-        r["efficiency"] = self.data["efficiency"] * 100
-        r["og"] = self.data["og"]
-        r["fg"] = self.data["fg"]
-        r["ibu"] = self.data["ibu"]
 
-        r["fermentables"] = []
-        for f in self.data["fermentables"]:
-            r["fermentables"].append({
-                    "name": f["name"],
-                    "color": f["lovibond"],
-                    "amount": f["amount"],
-                    "potential": 1.0 + f["ppg"] / 1000,
-                    })
 
-        r["hops"] = []
-        for h in self.data["hops"]:
-            r["hops"].append({
-                    "name": h["name"],
-                    "time": h["time"],
-                    "alpha": h["aa"],
-                    "amount": h["amount"],
-                    "type": HopType.getBrewfather(h["hop_type_id"]),
-                    "use": HopUsageType.getBrewfather(h["hop_usage_type_id"])
-                    })
+    def execute(self, operation):
 
-        r["mash"] = { "steps": [] }
-        for m in self.data["mash_steps"]:
-            r["mash"]["steps"].append({
-                    "name": m["name"],
-                    "stepTemp": m["temperature"],
-                    "stepTime": m["time"],
-                    "type": "Temperature"
-                    })
+        source = operation.source
 
-        r["yeasts"] = []
-        for y in self.data["yeasts"]:
-            r["yeasts"].append({
-                    "name": y["name"],
-                    "attenuation": y["attenuation"] * 100,
-                    "amount": y["amount"],
-                    "unit": y["unit"]
-                    })
+        if operation.kind in ("skip", "brew-skip"):
+            self.logger.info("%s needs no update (%s)" % (source, operation.reason))
+            return True
 
-        return r
+        if operation.kind in ("create", "update"):
+            self.logger.info("%s %s (%s)" % ("Creating" if operation.kind == "create" else "Updating", source, operation.reason))
+            self.session.register(source, id=operation.id)
+            hash = Util.contentHash(source.toDict()) if (self.index is not None) or (self.journal is not None) else None
+            sync_id = None
+            if self.run_id:
+                # a create gets a marker to find the recipe again, should
+                # the outcome be unknown, e.g. after a crash
+                sync_id = uuid.uuid4().hex if operation.kind == "create" else None
+                self.journal.checkpoint(self.run_id, operation.seq, "started", sync_id=sync_id, hash=hash)
+                if sync_id:
+                    notes = source.get("notes")
+                    source.set("notes", SyncExecutor.marked(notes, sync_id))
+            ok = source.save()
+            if ok and sync_id:
+                # the recipe is known now, so the marker is removed again
+                self.journal.checkpoint(self.run_id, operation.seq, "started", id=source.get("id"))
+                source.set("notes", notes)
+                if not source.save():
+                    self.logger.warning("Could not remove the Sync-ID from the notes of %s" % (source))
+            if ok:
+                operation.id = source.get("id")
+                if operation.kind == "create":
+                    # a new recipe has no brews yet
+                    self.brewCache.put(operation.id, [])
+                if self.index is not None:
+                    self.index.update(source, hash)
+                if (self.journal is not None) and (source.kbhId is not None):
+                    self.journal.recordRecipe(source.kbhId, source, hash, operation.updated_at)
+            elif operation.id:
+                # e.g. deleted on the site, the next listing will tell
+                if self.index is not None:
+                    self.index.remove(operation.id)
+                if (self.journal is not None) and (source.kbhId is not None) and self.isGone(operation.id):
+                    self.journal.forget(source.kbhId)
+            return ok or self.session.readonly
+
+        recipe_id = operation.recipe_id if operation.recipe_id else operation.parent.id
+        if not recipe_id:
+            # the recipe has not really been created, e.g. in dry run mode
+            self.logger.info("Creating %s (%s)" % (source, operation.reason))
+            return self.session.readonly
+
+        self.logger.info("%s %s (%s)" % ("Creating" if operation.kind == "brew-create" else "Updating", source, operation.reason))
+        self.session.register(source, recipe_id=recipe_id, id=operation.id)
+        hash = Util.contentHash(source.toDict()) if self.journal is not None else None
+        ok = source.save()
+        if ok:
+            operation.id = source.get("id")
+            self.brewCache.update(recipe_id, source)
+            kbhId = operation.parent.source.kbhId if operation.parent else None
+            if (self.journal is not None) and (kbhId is not None):
+                self.journal.recordBrew(kbhId, source, hash)
+        return ok or self.session.readonly
+
+
+
+    def marked(notes, sync_id):
+
+        return "%s\n\n%s" % (notes, SyncExecutor.marker(sync_id)) if notes else SyncExecutor.marker(sync_id)
+
+
+
+    def marker(sync_id):
+
+        return "[[Sync-ID: %s]]" % (sync_id)
+
+
+
+    def recover(self, run_id, gf_recipes):
+
+        """Resolves the creates of a run whose outcome is unknown: a
+        recipe whose id has been checkpointed, or one of the same name
+        carrying the create's Sync-ID in its notes, has been created
+        and is recorded in the journal (and its marker removed),
+        otherwise the create failed. Returns the number of recipes
+        found."""
+
+        found = 0
+        for row in self.journal.operations(run_id, [ "started" ]):
+            if row["kind"] != "create":
+                # updates are simply repeated
+                self.journal.checkpoint(run_id, row["seq"], "failed")
+                continue
+            marker = SyncExecutor.marker(row["sync_id"])
+            recipe = None
+            for candidate in gf_recipes:
+                if row["id"]:
+                    if candidate.get("id") == row["id"]:
+                        recipe = self.session.getRecipe(candidate.get("id"))
+                        break
+                elif candidate.get("name") == row["name"]:
+                    candidate = self.session.getRecipe(candidate.get("id"))
+                    if marker in (candidate.get("notes") or ""):
+                        recipe = candidate
+                        break
+            if recipe:
+                self.logger.info("Found %s created by an interrupted push" % (recipe))
+                notes = recipe.get("notes") or ""
+                if marker in notes:
+                    recipe.set("notes", notes.replace("\n\n" + marker, "").replace(marker, ""))
+                    recipe.save()
+                self.journal.recordRecipe(row["sud_id"], recipe, row["hash"], row["updated_at"])
+                self.journal.checkpoint(run_id, row["seq"], "done", id=recipe.get("id"))
+                found += 1
+            else:
+                self.journal.checkpoint(run_id, row["seq"], "failed")
 
+        return found
 
 
-class Brew(Object):
 
-    urlload = "https://brew.grainfather.com/recipes/{recipe_id}/brew-sessions/data/{id}"
-    urlsave = "https://brew.grainfather.com/recipes/{recipe_id}/brew-sessions/{id}"
-    urlcreate = "https://brew.grainfather.com/recipes/{recipe_id}/brew-sessions/"
+    def isGone(self, id):
 
-    recipe_id = None
+        """Checks whether a GF recipe has been deleted."""
 
+        response = self.session.get(Recipe.urlload.format(base=self.session.baseUrl, id=id))
 
+        return (response is not None) and (response.status_code == 404)
 
-    def __init__(self, session=None, recipe=None, id=None, data=None):
 
-        if recipe and recipe.get("id"):
-            # fill in recipe_id into url templates
-            self.recipe_id = recipe.get("id")
-            self.urlload = self.urlload.format(recipe_id=self.recipe_id, id="{id}")
-            self.urlsave = self.urlsave.format(recipe_id=self.recipe_id, id="{id}")
-            self.urlcreate = self.urlcreate.format(recipe_id=self.recipe_id)
 
-        super(Brew, self).__init__(session=session, id=id, data=data)
+class QueryServer(object):
 
-     
+    """Answers commands of thin clients on a Unix socket, using the
+    warm state of an interpreter: its session, KBH connection, brew
+    cache and resident index of GF recipes. Each request is one line
+    of JSON, {"command": ..., "args": [...], "dryrun": ..., "level": ...},
+    answered by one line of JSON, {"status": ..., "output": ..., "log": ...},
+    with the standard output of the command and its log messages of
+    at least the requested level. Requests are served one at a time."""
 
+    COMMANDS = [ "list", "dump", "diff", "push" ]
 
-    def tidy(self):
+    class Handler(socketserver.StreamRequestHandler):
 
-        # add required fields, if missing
-        if not 'unit_type_id' in self.data:
-            self.data['unit_type_id'] = UnitType.METRIC.value;
+        def handle(self):
 
-        # others
-        if not 'recipe_id' in self.data:
-            self.data['recipe_id'] = None
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    response = self.server.queryServer.execute(request)
+                except Exception as error:
+                    response = { "status": 1, "output": "", "log": "%s\n" % (error) }
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+                self.wfile.flush()
 
-        # no official GF attribute, but the name is used later to search the equipment_profiles_id
-        if (not 'equipment_profiles_id' in self.data) and (self.session):
-            for e in self.session.brewingEquipment.data:
-                if e["name"] == self.data['equipment_profiles']:
-                    self.data['equipment_profiles_id'] = e["id"]
+    def __init__(self, interpreter, path):
 
+        self.interpreter = interpreter
+        self.path = path
+        self.logger = logging.getLogger('server')
 
+        if os.path.exists(path):
+            os.remove(path)
+        # not threaded: the KBH connection belongs to the serving thread;
+        # the socket is created accessible by the owner only
+        umask = os.umask(0o077)
+        try:
+            self.server = socketserver.UnixStreamServer(path, QueryServer.Handler)
+        finally:
+            os.umask(umask)
+        self.server.queryServer = self
 
-    def isFull(self):
 
-        """Checks whether the object contains all attributes. When
-        false, some attributes may be missing, which happens for
-        search results, for example."""
 
-        if "ferment_volume_actual" in self.data:
-            return True
-        else:
-            return False
+    def serveForever(self):
 
+        self.logger.info("Serving %s on %s" % (", ".join(QueryServer.COMMANDS), self.path))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.path)
 
 
-class BrewingEquipment(Object):
 
-    urlload = "https://brew.grainfather.com/my-equipment/brewing/data"
+    def execute(self, request):
 
+        command = request.get("command")
+        if command not in QueryServer.COMMANDS:
+            return { "status": 2, "output": "", "log": "Unknown command %s, use one of %s\n" % (command, ", ".join(QueryServer.COMMANDS)) }
 
+        self.interpreter.refresh()
 
-    def __init__(self, session=None):
+        output = io.StringIO()
+        log = io.StringIO()
+        handler = logging.StreamHandler(log)
+        handler.setLevel(request.get("level", logging.WARNING))
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        logging.getLogger().addHandler(handler)
 
-        super(BrewingEquipment, self).__init__(session=session)
-        self.reload()
+        session = self.interpreter.session
+        readonly = session.readonly if session else None
+        status = 0
+        try:
+            if session:
+                session.readonly = readonly or bool(request.get("dryrun"))
+            t = time.perf_counter()
+            with contextlib.redirect_stdout(output):
+                result = getattr(self.interpreter, command)(list(request.get("args", [])))
+            status = Interpreter.exitStatus(result)
+            self.logger.info("%s %s took %.3fs" % (command, " ".join(request.get("args", [])), time.perf_counter() - t))
+        except Exception as error:
+            self.logger.error("%s failed: %s" % (command, error))
+            status = 1
+        finally:
+            if session:
+                session.readonly = readonly
+            logging.getLogger().removeHandler(handler)
 
+        return { "status": status, "output": output.getvalue(), "log": log.getvalue() }
 
 
-class Fermentable(Object):
 
-    # TBD... how can we access specific ingredients?
+    def query(path, command, args, dryrun=False, level=logging.WARNING):
 
-    urlload = "https://brew.grainfather.com/api/ingredients/fermentables?api_token={api_token}&q={id}"
-    urlsave = None
-    urlcreate = None
+        """Sends a command to a server and returns its response."""
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            request = { "command": command, "args": args, "dryrun": dryrun, "level": level }
+            sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            with sock.makefile("rb") as f:
+                return json.loads(f.readline())
 
 
 
 class Interpreter(object):
 
-    kbh = None
-    session = None
     logger = None
+    brewCache = None
+    journal = None
+    gfIndex = None
+    kbhMtime = None
 
 
-    def __init__(self, kbh=None, bs=None, session=None, config=None):
+    def exitStatus(result):
 
-        self.kbh = kbh
-        self.bs = bs
-        self.session = session
+        """Maps the result of a command to an exit status: commands
+        return the number of failed operations (or, like diff, of
+        differences), or None if they could not run at all, e.g. on
+        invalid options."""
+
+        if result is None:
+            return 1
+
+        return 1 if isinstance(result, int) and result else 0
+
+
+
+    def __init__(self, kbh=None, bs=None, session=None, config=None, factories=None):
+
+        # kbh, bs and session may also be given as factories, which are
+        # called when a command uses them for the first time
+        self.resources = dict(kbh=kbh, bs=bs, session=session)
+        self.factories = dict(factories or {})
         self.config = config
 
         self.logger = logging.getLogger('interpreter')
 
 
 
+    def getResource(self, name):
+
+        if (self.resources.get(name) is None) and (name in self.factories):
+            self.resources[name] = self.factories.pop(name)()
+
+        return self.resources.get(name)
+
+
+
+    def setResource(self, name, value):
+
+        self.resources[name] = value
+
+
+
+    kbh = property(lambda self: self.getResource("kbh"), lambda self, value: self.setResource("kbh", value))
+    bs = property(lambda self: self.getResource("bs"), lambda self, value: self.setResource("bs", value))
+    session = property(lambda self: self.getResource("session"), lambda self, value: self.setResource("session", value))
+
+
+
     def list(self, args):
 
         flagBrews = False
         flagSortNames = False
         flagSortDates = False
-
-        all_recipes = []
+        format = "table"
 
         if not self.session:
             self.logger.error("No Grainfather session, use -u and -p/-P options")
             return
 
         try:
-            opts, args = getopt.getopt(args, "vbnd", ["verbose", "brews", "name", "date"])
+            opts, args = getopt.getopt(args, "vbndf:", ["verbose", "brews", "name", "date", "format="])
         except getopt.GetoptError as err:
             self.logger.error(str(err))
             return
@@ -2131,6 +5813,11 @@ class Interpreter(object):
                 flagSortNames = True
             elif o in ("-d", "--date"):
                 flagSortDates = True
+            elif o in ("-f", "--format"):
+                if a not in ("ndjson", "json", "table"):
+                    self.logger.error("Unknown format %s, use ndjson, json or table" % (a))
+                    return
+                format = a
             else:
                 assert False, "unhandled option"
 
@@ -2140,40 +5827,41 @@ class Interpreter(object):
         else:
             namepattern = "*"
 
-        gf_recipes = self.session.getMyRecipes(namepattern, brews=flagBrews)
-        for recipe in gf_recipes:
-            if recipe.get("name") not in [r.get("name") for r in all_recipes]:
-                all_recipes.append(recipe)
+        gf_index = RecipeIndex(self.getGfRecipes(namepattern, brews=flagBrews))
+        MEMORY.mark("gf listing")
 
         if self.kbh:
-            kbh_recipes = self.kbh.getRecipes(namepattern)
-            for recipe in kbh_recipes:
-                if recipe.get("name") not in [r.get("name") for r in all_recipes]:
-                    all_recipes.append(recipe)
+            kbh_index = RecipeIndex(self.kbh.getRecipes(namepattern))
         else:
-            kbh_recipes = None
+            kbh_index = RecipeIndex()
+        MEMORY.mark("kbh loaded")
+
+        # names are used to match recipes, so ambiguous names are worth a note
+        for source, index in (("GF", gf_index), ("KBH", kbh_index)):
+            for name, recipes in index.duplicates().items():
+                self.logger.warning("%d %s recipes named \"%s\"%s, only the first one is matched" %
+                                    (len(recipes), source, name,
+                                     " (%s)" % (", ".join(str(r.get("id")) for r in recipes)) if source == "GF" else ""))
 
-        # sort by the requested attribute
+        # join both sources by name, the GF representation is preferred
+        rows = list(RecipeIndex.join(gf_index, kbh_index))
+
+        # sort by the requested attribute, the join is sorted by name
         if flagSortDates:
-            all_recipes = sorted(all_recipes, key=lambda r: "%s:%s" % (r.get("updated_at")[:16],r.get("name")))
-        else:
-            all_recipes = sorted(all_recipes, key=lambda r: r.get("name"))
+            rows.sort(key=lambda row: "%s:%s" % ((row[1] or row[2]).get("updated_at")[:16], row[0]))
+
+        if format != "table":
+            Util.printRecords((self.listEntry(name, gf_recipe, kbh_recipe, flagBrews) for (name, gf_recipe, kbh_recipe) in rows), format)
+            return 0
 
         # now print the lines
         firstLine = True
-        for name in [r.get("name") for r in all_recipes]:
+        for name, gf_recipe, kbh_recipe in rows:
 
             if firstLine:
                 print("%8s flags %16s %16s %7s %s" % ("ID", "KBH up-/brewdate", "GF up-/brewdate", "size", "name/attributes"))
                 firstLine = False
 
-            # try to find the GF and KBH representations of the current recipe name
-            gf_recipe  = next((recipe for recipe in gf_recipes  if recipe.get("name") == name), None)
-            if kbh_recipes:
-                kbh_recipe = next((recipe for recipe in kbh_recipes if recipe.get("name") == name), None)
-            else:
-                kbh_recipe = None
-
             recipe = gf_recipe if gf_recipe else kbh_recipe
 
             print("%8s r%s%s%s%s %16s %16s %7s %s" %
@@ -2237,17 +5925,65 @@ class Interpreter(object):
                                "%.1f" % (volume) + "l" if brew.get("unit_type_id") == 10 else "gal",
                                attrs))
 
+        return 0
+
+
+
+    def listEntry(self, name, gf_recipe, kbh_recipe, brews=False):
+
+        """Returns the document of a line of the recipe list, for the
+        JSON formats of list."""
+
+        recipe = gf_recipe if gf_recipe else kbh_recipe
+
+        entry = {
+            "name": name,
+            "id": gf_recipe.get("id") if gf_recipe else None,
+            "kbh": kbh_recipe is not None,
+            "gf": gf_recipe is not None,
+            "public": bool(gf_recipe and gf_recipe.get("is_public")),
+            "outdated": bool(gf_recipe and kbh_recipe and kbh_recipe.get("updated_at") > gf_recipe.get("updated_at")),
+            "kbh_updated_at": kbh_recipe.get("updated_at") if kbh_recipe else None,
+            "gf_updated_at": gf_recipe.get("updated_at") if gf_recipe else None,
+            "batch_size": recipe.get("batch_size"),
+            "unit": "l" if recipe.get("unit_type_id") == 10 else "gal" }
+
+        if brews:
+            kbh_brew = kbh_recipe.brews[0] if kbh_recipe and kbh_recipe.brews else None
+            entry["kbh_brew_date"] = kbh_brew.get("created_at") if kbh_brew else None
+            entry["brews"] = []
+            for brew in sorted(gf_recipe.brews if gf_recipe else [], key=lambda b: b.get("updated_at")):
+                volume = brew.get("ferment_volume_actual")
+                if (not volume) or (volume <= 0):
+                    volume = brew.get("ferment_volume_est")
+                entry["brews"].append({
+                        "id": brew.get("id"),
+                        "status": BrewStatusType.getName(brew.get("status")),
+                        "public": bool(brew.get("is_public")),
+                        "created_at": brew.get("created_at"),
+                        "updated_at": brew.get("updated_at"),
+                        "volume": volume })
+
+        return entry
+
 
 
     def dump(self, args):
 
+        """Dumps the recipes (and with -b their brews) of KBH (-k) or GF
+        (-g, the default). The json format prints an array like list,
+        ndjson one line per document, table one line of key values per
+        recipe or brew. Each recipe is printed as soon as it is loaded,
+        or with -r recalculated and printed 100 at a time."""
+
         do_k = False
         do_g = False
         flagBrews = False
         flagRecalculate = False
+        format = "json"
 
         try:
-            opts, args = getopt.getopt(args, "kgbr", ["kbh", "grainfather", "brews", "recalculate"])
+            opts, args = getopt.getopt(args, "kgbrf:", ["kbh", "grainfather", "brews", "recalculate", "format="])
         except getopt.GetoptError as err:
             self.logger.error(str(err))
             return
@@ -2260,6 +5996,11 @@ class Interpreter(object):
                 flagBrews = True
             elif o in ("-r", "--recalculate"):
                 flagRecalculate = True
+            elif o in ("-f", "--format"):
+                if a not in ("ndjson", "json", "table"):
+                    self.logger.error("Unknown format %s, use ndjson, json or table" % (a))
+                    return
+                format = a
             else:
                 assert False, "unhandled option"
                 
@@ -2271,121 +6012,362 @@ class Interpreter(object):
         else:
             namepattern = "*"
 
+        sources = []
+
         if do_k:
             if not self.kbh:
                 self.logger.error("No KBH database, use -k option")
                 return
-            recipes = self.kbh.getRecipes(namepattern)
-            for recipe in recipes:
-                if flagRecalculate:
-                    recipe.recalculate(force=True)
-                recipe.print()
-                if flagBrews:
-                    for brew in recipe.brews:
-                        brew.print()
+            sources.append(("kbh", self.kbh.iterRecipes(namepattern)))
 
         if do_g:
             if not self.session:
                 self.logger.error("No Grainfather session, use -u and -p/-P options")
                 return
-            recipes = self.session.getMyRecipes(namepattern, full=True, brews=flagBrews)
-            for recipe in recipes:
-                if flagRecalculate:
-                    recipe.recalculate(force=True)
-                recipe.print()
-                if flagBrews:
-                    for brew in recipe.brews:
-                        brew.print()
+            sources.append(("gf", self.session.iterMyRecipes(namepattern)))
+
+        # batches only pay off for the recalculation
+        def objects():
+            for name, source in sources:
+                for recipes in Util.chunks(source, 100 if flagRecalculate else 1):
+                    for recipe in recipes:
+                        if recipe.isBound():
+                            if not recipe.isFull():
+                                recipe.reload()
+                            if flagBrews:
+                                recipe.getBrews(full=True)
+                    if flagRecalculate:
+                        Calculator.recalculateAll(recipes, force=True)
+                    for recipe in recipes:
+                        yield recipe
+                        if flagBrews:
+                            for brew in recipe.brews or []:
+                                yield brew
+                MEMORY.mark("dumped %s" % (name))
+
+        if format == "table":
+            print("%8s %6s %6s %5s %5s %5s %7s %s" % ("ID", "OG", "FG", "IBU", "SRM", "ABV", "size", "name"))
+            for obj in objects():
+                self.dumpObject(obj)
+        else:
+            Util.printRecords((obj.toDict() for obj in objects()), format)
+
+        return 0
+
+
+
+    def dumpObject(self, obj):
+
+        if isinstance(obj, Brew):
+            volume = obj.get("ferment_volume_actual") or obj.get("ferment_volume_est")
+            print("%8s %6s %6s %5s %5s %5s %7s   brew %s %s" %
+                  (obj.get("id") or "-", obj.get("original_gravity") or "-", obj.get("final_gravity") or "-", "-", "-",
+                   obj.get("source_abv") or "-", "%.1f" % (volume) if volume else "-",
+                   (obj.get("created_at") or "")[:10], BrewStatusType.getName(obj.get("status"))))
+        else:
+            print("%8s %6s %6s %5s %5s %5s %7s %s" %
+                  (obj.get("id") or "-", obj.get("og"), obj.get("fg"), obj.get("ibu"), obj.get("srm"), obj.get("abv"),
+                   "%.1f%s" % (obj.get("batch_size") or 0, "l" if obj.get("unit_type_id") == 10 else "gal"),
+                   obj.get("name")))
 
 
 
     def convert(self, args):
 
-        do_k = False
-        do_g = False
+        """Exports recipes (and with -b their brews) of KBH (-k), GF (-g,
+        the default) and BeerSmith (-s) in Brewfather format. Each
+        document is written as one line of JSON to stdout as soon as it
+        is ready, or with -o into a directory, one file per recipe or
+        brew below a subdirectory per source. The sources are read in
+        turn, loading and converting run on up to -c threads, and only a
+        bounded number of recipes is held at any time."""
+
+        sources = []
         flagBrews = False
         flagRecalculate = False
+        outdir = None
+        concurrency = self.config.get("concurrency", 4) if self.config else 4
 
         try:
-            opts, args = getopt.getopt(args, "kgbr", ["kbh", "grainfather", "brews", "recalculate"])
+            opts, args = getopt.getopt(args, "kgsbro:c:", ["kbh", "grainfather", "beersmith", "brews", "recalculate", "output=", "concurrency="])
         except getopt.GetoptError as err:
             self.logger.error(str(err))
             return
         for o, a in opts:
             if o in ("-k", "--kbh"):
-                do_k = True
+                sources.append("kbh")
             elif o in ("-g", "--grainfather"):
-                do_g = True
+                sources.append("gf")
+            elif o in ("-s", "--beersmith"):
+                sources.append("bs")
             elif o in ("-b", "--brews"):
                 flagBrews = True
             elif o in ("-r", "--recalculate"):
                 flagRecalculate = True
+            elif o in ("-o", "--output"):
+                outdir = a
+            elif o in ("-c", "--concurrency"):
+                concurrency = max(1, int(a))
             else:
                 assert False, "unhandled option"
                 
-        if not do_k and not do_g:
-            do_g = True
+        if not sources:
+            sources.append("gf")
 
         if len(args) >= 1:
             namepattern = args[0]
         else:
             namepattern = "*"
 
-        bfr = []
-        bfb = []
-
-        if do_k:
-            if not self.kbh:
-                self.logger.error("No KBH database, use -k option")
-                return
-            recipes = self.kbh.getRecipes(namepattern)
-            for recipe in recipes:
+        iterators = []
+        for source in sources:
+            if source == "kbh":
+                if not self.kbh:
+                    self.logger.error("No KBH database, use -k option")
+                    return
+                iterators.append(("kbh", self.kbh.iterRecipes(namepattern)))
+            elif source == "gf":
+                if not self.session:
+                    self.logger.error("No Grainfather session, use -u and -p/-P options")
+                    return
+                iterators.append(("gf", self.session.iterMyRecipes(namepattern)))
+            elif source == "bs":
+                if not self.bs:
+                    self.logger.error("No BeerSmith directory, use -b option")
+                    return
+                iterators.append(("bs", self.bs.iterRecipes(namepattern)))
+
+        def export(source, recipe):
+            # runs on a worker thread: load, convert and serialize one recipe
+            try:
+                if recipe.isBound() and not recipe.isFull():
+                    recipe.reload()
                 if flagRecalculate:
                     recipe.recalculate(force=True)
-                bfr.append(recipe.convertToBrewfather())
+                brews = []
                 if flagBrews:
-                    for brew in recipe.brews:
-                        bfb.append(brew.convertToBrewfather())
+                    brews = recipe.getBrews(full=True) if recipe.isBound() else (recipe.brews or [])
+                with PROFILER.span("convertToBrewfather"):
+                    docs = [ recipe.convertToBrewfather() ]
+                    docs.extend(brew.convertToBrewfather(recipe) for brew in brews)
+            except Exception as error:
+                self.logger.error("Could not convert %s: %s" % (recipe, repr(error)))
+                return (source, recipe.get("name"), [])
+            with PROFILER.span("serialize"):
+                return (source, recipe.get("name"), [ json.dumps(doc, sort_keys=True) for doc in docs ])
+
+        names = {}
+        def write(source, name, texts):
+            if not texts:
+                return
+            if not outdir:
+                for text in texts:
+                    sys.stdout.write(text + "\n")
+                sys.stdout.flush()
+                return
+            dir = os.path.join(outdir, source)
+            os.makedirs(dir, exist_ok=True)
+            base = re.sub(r'[^\w\-#. ]', '_', name or "unnamed").lstrip(".") or "unnamed"
+            n = names[(source, base)] = names.get((source, base), 0) + 1
+            if n > 1:
+                base = "%s-%d" % (base, n)
+            for i, text in enumerate(texts):
+                filename = os.path.join(dir, "%s.json" % (base) if i == 0 else "%s.batch-%d.json" % (base, i))
+                with open(filename, "w") as f:
+                    f.write(text + "\n")
+
+        count = 0
+        window = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for source, recipe in Util.roundRobin(iterators):
+                window.append(pool.submit(export, source, recipe))
+                # keep the output in order and the memory bounded
+                while len(window) > 2 * concurrency:
+                    write(*window.popleft().result())
+                    count += 1
+            while window:
+                write(*window.popleft().result())
+                count += 1
+
+        self.logger.info("Exported %d recipes" % (count))
+
+        return 0
+
+
+
+    def push(self, args, resume=None):
+
+        """Pushes KBH recipes (and with -b their brews) to the GF site.
+        All decisions are made up front, see SyncPlanner. In dry run
+        mode, the plan is printed as a table (or as JSON with -j)
+        instead of executing it. The plan is executed by up to -c
+        concurrent workers in the -o order (plan, name, date, cost).
+        The GF recipes are only listed if a sud is not in the sync
+        journal, or with -l to notice recipes deleted on the site.
+        Each operation is checkpointed in the journal, -r resumes the
+        latest interrupted push with its arguments, for the suds it
+        has not finished. Returns the number of failed operations."""
+
+        argv = list(args)
+        flagBrews = False
+        flagJson = False
+        flagList = False
+        flagResume = False
+        concurrency = self.config.get("concurrency", 4) if self.config else 4
+        order = "plan"
 
-        if do_g:
-            if not self.session:
-                self.logger.error("No Grainfather session, use -u and -p/-P options")
+        if not self.kbh:
+            self.logger.error("No KBH database, use -k option")
+            return
+            
+        if not self.session:
+            self.logger.error("No Grainfather session, use -u and -p/-P options")
+            return
+
+        try:
+            opts, args = getopt.getopt(args, "bjlrc:o:", ["brews", "json", "list", "resume", "concurrency=", "order="])
+        except getopt.GetoptError as err:
+            self.logger.error(str(err))
+            return
+        for o, a in opts:
+            if o in ("-b", "--brews"):
+                flagBrews = True
+            elif o in ("-j", "--json"):
+                flagJson = True
+            elif o in ("-l", "--list"):
+                flagList = True
+            elif o in ("-r", "--resume"):
+                flagResume = True
+            elif o in ("-c", "--concurrency"):
+                concurrency = int(a)
+            elif o in ("-o", "--order"):
+                if a not in SyncPlan.ORDERS:
+                    self.logger.error("Unknown order %s, use one of %s" % (a, ", ".join(SyncPlan.ORDERS)))
+                    return
+                order = a
+            else:
+                assert False, "unhandled option"
+
+        journal = self.getJournal()
+        run = journal.unfinishedRun() if journal else None
+
+        if flagResume:
+            if not run:
+                self.logger.error("No interrupted push to resume")
                 return
-            recipes = self.session.getMyRecipes(namepattern, full=True, brews=flagBrews)
-            for recipe in recipes:
-                if flagRecalculate:
-                    recipe.recalculate(force=True)
-                bfr.append(recipe.convertToBrewfather())
-                if flagBrews:
-                    for brew in recipe.brews:
-                        bfb.append(brew.convertToBrewfather())
+            self.logger.info("Resuming push %s" % (" ".join(run["args"])))
+            return self.push(run["args"], resume=run)
 
-        print(json.dumps(bfr[0], sort_keys=True, indent=4))
-        if flagBrews:
-            print(str.encode(json.dumps(bfb[0], sort_keys=True, indent=4)))
+        if len(args) >= 1:
+            namepattern = args[0]
+        else:
+            namepattern = "*"
 
+        kbh_recipes = self.kbh.getRecipes(namepattern)
+        MEMORY.mark("kbh loaded")
+
+        # creates of an interrupted push with an unknown outcome are
+        # looked up by their Sync-ID, before anything could create them again
+        requests = self.session.requests
+        gf_recipes = None
+        if run and not self.session.readonly:
+            if journal.operations(run["run_id"], [ "started" ]):
+                gf_recipes = self.getGfRecipes()
+                SyncExecutor(self.session, journal=journal).recover(run["run_id"], gf_recipes)
+        if resume:
+            suds = set(row["sud_id"] for row in journal.operations(run["run_id"], [ "pending", "started", "failed" ]))
+            kbh_recipes = [ r for r in kbh_recipes if r.kbhId in suds ]
+        elif run:
+            self.logger.warning("The previous push has been interrupted, its finished operations are kept (see -r)")
+
+        # the interrupted run stays resumable until this one is recorded
+        def closePrevious():
+            if run and not self.session.readonly:
+                journal.finishRun(run["run_id"], "resumed" if resume else "abandoned")
 
+        if len(kbh_recipes) == 0:
+            closePrevious()
+            return 0
+
+        # suds pushed before are found in the journal, for all others we
+        # have to know all our recipes on the GF server so that we can
+        # decide which recipe to create and which to update (the daemon
+        # keeps them in a resident index)
+        unknown = [ r for r in kbh_recipes if not (journal and journal.get(r.kbhId)) ]
+        if gf_recipes is not None:
+            pass
+        elif unknown or flagList or (self.gfIndex is not None):
+            gf_recipes = self.getGfRecipes()
+        else:
+            self.logger.info("All %d recipes are in the journal, no listing needed" % (len(kbh_recipes)))
+            gf_recipes = None
+        MEMORY.mark("gf listing")
+
+        brewCache = self.getBrewCache()
+
+        plan = SyncPlanner(self.session, brewCache=brewCache, concurrency=concurrency, index=self.gfIndex,
+                           journal=journal).plan(kbh_recipes, gf_recipes, brews=flagBrews)
+        plan.requests = self.session.requests - requests
+        MEMORY.mark("planned")
+
+        if flagJson:
+            plan.printJson()
+        elif self.session.readonly:
+            plan.printTable()
+
+        failed = 0
+        if not self.session.readonly:
+            run_id = journal.startRun(plan, argv) if journal else None
+            closePrevious()
+            failed = SyncExecutor(self.session, concurrency=concurrency, order=order, brewCache=brewCache, index=self.gfIndex,
+                                  journal=journal, run_id=run_id).run(plan)
+            if journal:
+                journal.finishRun(run_id, "incomplete" if failed else "done")
+            if failed:
+                self.logger.error("%d of %d operations failed" % (failed, len(plan.operations)))
+                if self.gfIndex is not None:
+                    # the index may be wrong, list again next time
+                    self.gfIndex.refreshed = None
+            MEMORY.mark("uploaded")
+
+        brewCache.save()
+
+        return failed
+
+
+
+    def pull(self, args):
+
+        """Pulls GF edits of recipes (and with -b of their brews) back
+        into the KBH database, see KleinerBrauhelfer.recipeToSud(). A
+        recipe is pulled if it has been changed on the site since its
+        last push and after its sud has been saved in KBH, a brew if it
+        is newer than the sud. Suds are mapped to GF recipes by the sync
+        journal, or else by name. The GF documents are loaded by up to
+        -c concurrent requests, then all changes are written in one
+        transaction. In dry run mode, the changes are only printed."""
 
-    def push(self, args):
-        
         flagBrews = False
+        concurrency = self.config.get("concurrency", 4) if self.config else 4
 
         if not self.kbh:
             self.logger.error("No KBH database, use -k option")
             return
-            
+
         if not self.session:
             self.logger.error("No Grainfather session, use -u and -p/-P options")
             return
 
         try:
-            opts, args = getopt.getopt(args, "b", ["brews"])
+            opts, args = getopt.getopt(args, "bc:", ["brews", "concurrency="])
         except getopt.GetoptError as err:
             self.logger.error(str(err))
             return
         for o, a in opts:
-            if o in ("-b", "--brew"):
+            if o in ("-b", "--brews"):
                 flagBrews = True
+            elif o in ("-c", "--concurrency"):
+                concurrency = int(a)
             else:
                 assert False, "unhandled option"
 
@@ -2395,72 +6377,176 @@ class Interpreter(object):
             namepattern = "*"
 
         kbh_recipes = self.kbh.getRecipes(namepattern)
+        MEMORY.mark("kbh loaded")
         if len(kbh_recipes) == 0:
-            return
+            return 0
 
-        # we have to know all our recipes on the GF server so that
-        # we can decide which recipe to create and which to update
-        gf_recipes = self.session.getMyRecipes()
-        #gf_recipes = self.session.getMyRecipes(brews=flagBrews)
+        journal = self.getJournal()
+        gf_index = RecipeIndex(self.getGfRecipes())
+        MEMORY.mark("gf listing")
 
+        # pair the suds with their GF recipes, the journal knows
+        # renamed ones, names may match recipes not pushed by us
+        pairs = []
         for kbh_recipe in kbh_recipes:
-            
-            # try to find matching GF recipe
-            id = None
-            for gf_recipe in gf_recipes:
-                if gf_recipe.get("name") == kbh_recipe.get("name"):
-                    id = gf_recipe.get("id")
-                    break
-            if id:
-                if (gf_recipe.get("updated_at") > kbh_recipe.get("updated_at")) and (not self.session.force):
-                    self.logger.info("%s needs no update" % gf_recipe)
-                    self.logger.debug("kbh:%s, gf:%s" % (kbh_recipe.get("updated_at"), gf_recipe.get("updated_at")))
+            entry = journal.get(kbh_recipe.kbhId) if journal else None
+            gf_recipe = gf_index.getById(entry["recipe_id"]) if entry else gf_index.get(kbh_recipe.get("name"))
+            if not gf_recipe:
+                continue
+            updated_at = gf_recipe.get("updated_at")
+            recipeChanged = self.session.force or ((updated_at > ((entry and entry["gf_updated_at"]) or "")) and
+                                                   (updated_at > kbh_recipe.get("updated_at")))
+            if recipeChanged or flagBrews:
+                pairs.append((kbh_recipe, gf_recipe, entry, recipeChanged))
+
+        def load(pair):
+            (kbh_recipe, gf_recipe, entry, recipeChanged) = pair
+            if recipeChanged and not gf_recipe.isFull():
+                gf_recipe.reload()
+            gf_brew = None
+            if flagBrews and kbh_recipe.brews:
+                kbh_brew = kbh_recipe.brews[0]
+                brewDate = Util.utcToLocal(kbh_brew.get("created_at"))[:10]
+                for brew in gf_recipe.getBrews():
+                    if (entry and (brew.get("id") == entry["brew_id"])) or (Util.utcToLocal(brew.get("created_at"))[:10] == brewDate):
+                        gf_brew = brew
+                if gf_brew and (self.session.force or (gf_brew.get("updated_at") > kbh_brew.get("updated_at"))):
+                    if not gf_brew.isFull():
+                        gf_brew.reload(recipe_id=gf_recipe.get("id"))
                 else:
-                    self.session.register(kbh_recipe, id=id)
-                    self.logger.info("Updating %s" % gf_recipe)
-                    self.logger.debug("kbh:%s, gf:%s" % (kbh_recipe.get("updated_at"), gf_recipe.get("updated_at")))
-                    kbh_recipe.save()
-            else:
-                self.logger.info("Creating %s" % kbh_recipe)
-                self.session.register(kbh_recipe)
-                kbh_recipe.save()
-                gf_recipe = kbh_recipe
-            
-            if flagBrews and len(kbh_recipe.brews) >= 1:
+                    gf_brew = None
+            return gf_brew
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            gf_brews = list(pool.map(load, pairs))
+        MEMORY.mark("gf reloaded")
+
+        changes = []
+        pulled = {}
+        for (kbh_recipe, gf_recipe, entry, recipeChanged), gf_brew in zip(pairs, gf_brews):
+            sud = self.kbh.getSud(kbh_recipe.kbhId)
+            columns, rows = self.kbh.recipeToSud(sud, kbh_recipe, gf_recipe if recipeChanged else None, gf_brew)
+            if columns or rows:
+                changed = sorted(columns) + ([ "Hauptgaerverlauf" ] if rows else [])
+                if self.session.readonly:
+                    print("%8s %-40s %s" % (sud["ID"], kbh_recipe.get("name"), ", ".join(changed)))
+                else:
+                    self.logger.info("Pulling %s into %s" % (", ".join(changed), kbh_recipe))
+                changes.append((sud, columns, rows))
+                pulled[sud["ID"]] = (gf_recipe, entry and (entry["hash"] == Util.contentHash(kbh_recipe.toDict())))
 
-                kbh_brew = kbh_recipe.brews[0]
+        if self.session.readonly:
+            print("%d suds would be updated" % (len(changes)))
+            return 0
 
-                # reload, including full brews
-                gf_recipe.reload(full=True, brews=True)
+        ids = self.kbh.update(changes)
+
+        # record the pulled state like a push, so that the next push
+        # does not send it back, unless the sud has other changes that
+        # have not been pushed yet
+        if journal:
+            for id in ids:
+                (gf_recipe, pushed) = pulled[id]
+                recipe = self.kbh.sudToRecipe(self.kbh.getSud(id))
+                journal.recordRecipe(id, gf_recipe, Util.contentHash(recipe.toDict()) if pushed else None, recipe.get("updated_at"))
+
+        self.logger.info("%d suds updated" % (len(ids)))
+
+        return 0
+
+
+
+    def getBrewCache(self):
+
+        """Returns the brew listing cache, loaded on first use from the
+        "brewCacheFile" of the configuration."""
+
+        if self.brewCache is None:
+            config = self.config or {}
+            self.brewCache = BrewCache(config.get("brewCacheFile"), maxAge=config.get("brewCacheAge", 86400))
+
+        return self.brewCache
+
+
+
+    def getJournal(self):
+
+        """Returns the sync journal, opened on first use from the
+        "journalFile" of the configuration, or None if there is none.
+        Its entries are those of the KBH file and GF account in use."""
+
+        if self.journal is None:
+            filename = self.config.get("journalFile") if self.config else None
+            if filename:
+                self.journal = SyncJournal(filename, SyncJournal.scopeOf(self.kbh.path, self.session.username, self.session.baseUrl))
+
+        return self.journal
+
+
+
+    def getGfRecipes(self, namepattern="*", brews=False):
+
+        """Returns the listing of the user's GF recipes matching a name
+        pattern, from the resident index if there is one (see daemon
+        and serve)."""
+
+        if self.gfIndex is None:
+            return self.session.getMyRecipes(namepattern, brews=brews)
+
+        if self.gfIndex.refreshed is None:
+            self.gfIndex.refresh(self.session)
+        recipes = [ recipe for recipe in self.gfIndex.recipes() if fnmatch.fnmatch(recipe.get("name"), namepattern or "*") ]
+        if brews:
+            for recipe in recipes:
+                recipe.getBrews()
+
+        return recipes
 
-                # search for some brew session on the Grainfather site, based on brew date
-                gf_brew = None
-                for brew in gf_recipe.brews:
-                    if (Util.utcToLocal(brew.get("created_at"))[:10] == Util.utcToLocal(kbh_brew.get("created_at"))[:10]):
-                        gf_brew = brew
-                 
-                if gf_brew:
-                    if (gf_brew.get("updated_at") > kbh_brew.get("updated_at")) and (not self.session.force):
-                        self.logger.info("%s needs no update" % gf_brew)
-                        self.logger.debug("kbh:%s, gf:%s" % (kbh_brew.get("updated_at"), gf_brew.get("updated_at")))
-                    else:
-                        self.session.register(kbh_brew, recipe_id=gf_recipe.get("id"), id=gf_brew.get("id"))
-                        self.logger.info("Updating %s" % gf_brew)
-                        self.logger.debug("kbh:%s, gf:%s" % (kbh_brew.get("updated_at"), gf_brew.get("updated_at")))
-                        kbh_brew.save()
-                else:
-                    self.logger.info("Creating %s" % kbh_brew)
-                    self.session.register(kbh_brew, recipe_id=gf_recipe.get("id"))
-                    kbh_brew.save()
+
+
+    def refresh(self):
+
+        """Brings the warm state of a long running interpreter up to
+        date: reopens the KBH database after it has been modified and
+        lists the GF recipes again after "indexRefresh" seconds."""
+
+        if self.kbh and self.config and self.config.get("kbhFile"):
+            mtime = os.stat(os.path.expanduser(self.config["kbhFile"])).st_mtime
+            if self.kbhMtime and (mtime != self.kbhMtime):
+                self.logger.info("Detected KBH change, reopening")
+                self.kbh.reopen()
+            self.kbhMtime = mtime
+
+        if (self.gfIndex is not None) and self.session:
+            if self.gfIndex.age() > (self.config.get("indexRefresh", 3600) if self.config else 3600):
+                self.gfIndex.refresh(self.session)
 
 
 
     def delete(self, args):
-        
+
+        """Deletes all recipes matching a name pattern by up to -c
+        concurrent requests. In dry run mode, only the recipes are
+        listed. Recipes that are already gone count as deleted, so an
+        interrupted cleanup can simply be repeated."""
+
+        concurrency = self.config.get("concurrency", 4) if self.config else 4
+
         if not self.session:
             self.logger.error("No Grainfather session, use -u and -p/-P options")
             return
 
+        try:
+            opts, args = getopt.getopt(args, "c:", ["concurrency="])
+        except getopt.GetoptError as err:
+            self.logger.error(str(err))
+            return
+        for o, a in opts:
+            if o in ("-c", "--concurrency"):
+                concurrency = int(a)
+            else:
+                assert False, "unhandled option"
+
         if len(args) >= 1:
             namepattern = args[0]
         else:
@@ -2469,14 +6555,212 @@ class Interpreter(object):
 
         recipes = self.session.getMyRecipes(namepattern)
 
+        if self.session.readonly:
+            for recipe in recipes:
+                print("%8s %s" % (recipe.get("id"), recipe.get("name")))
+            print("%d recipes would be deleted" % (len(recipes)))
+            return 0
+
+        def delete(recipe):
+            try:
+                response = recipe.delete()
+            except Exception as error:
+                return (recipe, "failed", str(error))
+            if response is None:
+                return (recipe, "failed", "no response")
+            if response.status_code == 200:
+                return (recipe, "deleted", None)
+            if response.status_code == 404:
+                return (recipe, "gone", None)
+            return (recipe, "failed", "HTTP %d" % (response.status_code))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            results = list(pool.map(delete, recipes))
+
+        counts = collections.Counter(status for (recipe, status, error) in results)
+        for (recipe, status, error) in results:
+            if status == "failed":
+                print("%8s failed (%s) %s" % (recipe.get("id"), error, recipe.get("name")))
+        print("%d deleted, %d already gone, %d failed" % (counts["deleted"], counts["gone"], counts["failed"]))
+
+        return counts["failed"]
+
+
+
+    def set(self, args):
+
+        """Sets top level attributes of all recipes matching a name
+        pattern, e.g. set "#01*" is_public true. Only recipes that
+        actually change are loaded and saved. Calculated attributes
+        that depend on the changed ones are recalculated, those that
+        are set explicitly are kept as given."""
+
+        if not self.session:
+            self.logger.error("No Grainfather session, use -u and -p/-P options")
+            return
+
+        if (len(args) < 3) or (len(args) % 2 != 1):
+            self.logger.error("Usage: set \"namepattern\" attribute value [attribute value ...]")
+            return
+
+        namepattern = args[0]
+        values = {}
+        for attr, value in zip(args[1::2], args[2::2]):
+            try:
+                values[attr] = json.loads(value)
+            except ValueError:
+                values[attr] = value
+
+        recipes = self.session.getMyRecipes(namepattern)
+
+        changed = 0
         for recipe in recipes:
-            
-            recipe.delete()
-            
+
+            # the listing may already tell that there is nothing to do
+            if all((attr in recipe.data) and (recipe.get(attr) == value) for (attr, value) in values.items()):
+                self.logger.info("%s needs no update" % recipe)
+                continue
+
+            recipe.reload()
+            for attr, value in values.items():
+                recipe.set(attr, value)
+            recalculated = recipe.recalculateStale()
+            if recalculated:
+                self.logger.debug("Recalculated %s of %s" % (", ".join(sorted(recalculated)), recipe))
+
+            if recipe.isDirty():
+                self.logger.info("Updating %s: %s" % (recipe, ", ".join(sorted(recipe.getDirty()))))
+                recipe.save()
+                changed += 1
+            else:
+                self.logger.info("%s needs no update" % recipe)
+
+        self.logger.info("Changed %d of %d recipes" % (changed, len(recipes)))
+
+        return 0
+
+
+
+    def solve(self, args):
+
+        """Adjusts the grain and hop amounts of a recipe to hit target
+        values, e.g. solve -k "#014*" og=1.052 ibu=35 srm=8 volume=25,
+        and prints the changes. With -w a Grainfather recipe is saved
+        with the new amounts, with -j the new recipe is dumped."""
+
+        do_k = False
+        do_g = False
+        flagJson = False
+        flagWrite = False
+
+        try:
+            opts, args = getopt.getopt(args, "kgjw", ["kbh", "grainfather", "json", "write"])
+        except getopt.GetoptError as err:
+            self.logger.error(str(err))
+            return
+        for o, a in opts:
+            if o in ("-k", "--kbh"):
+                do_k = True
+            elif o in ("-g", "--grainfather"):
+                do_g = True
+            elif o in ("-j", "--json"):
+                flagJson = True
+            elif o in ("-w", "--write"):
+                flagWrite = True
+            else:
+                assert False, "unhandled option"
+
+        if not do_k:
+            do_g = True
+
+        if len(args) < 2:
+            self.logger.error("Usage: solve [-k|-g] [-j] [-w] \"namepattern\" og=value ibu=value srm=value volume=value efficiency=value")
+            return
+
+        namepattern = args[0]
+        targets = {}
+        for arg in args[1:]:
+            key, sep, value = arg.partition("=")
+            if (not sep) or (key not in ("og", "ibu", "srm", "volume", "efficiency")):
+                self.logger.error("Unknown target %s" % (arg))
+                return
+            try:
+                targets[key] = float(value)
+            except ValueError:
+                self.logger.error("Invalid value of target %s: %s" % (key, value))
+                return
+            if not math.isfinite(targets[key]):
+                self.logger.error("Invalid value of target %s: %s" % (key, value))
+                return
+            if (key in ("volume", "efficiency")) and (targets[key] <= 0):
+                self.logger.error("Target %s must be positive" % (key))
+                return
+
+        if do_k:
+            if not self.kbh:
+                self.logger.error("No KBH database, use -k option")
+                return
+            if flagWrite:
+                self.logger.error("KBH recipes cannot be written, use -j to dump the result")
+                return
+            recipe = self.kbh.getRecipe(namepattern=namepattern)
+        else:
+            if not self.session:
+                self.logger.error("No Grainfather session, use -u and -p/-P options")
+                return
+            recipe = self.session.getMyRecipe(namepattern=namepattern)
+
+        if not recipe:
+            self.logger.error("No recipe matching \"%s\"" % (namepattern))
+            return
+
+        # amounts are scaled from the current batch volume
+        if not ((recipe.get("batch_size") or 0) > 0):
+            self.logger.error("%s has no batch volume to scale from" % (recipe))
+            return
+
+        t = time.time()
+        try:
+            solved = Solver(recipe).solve(**targets)
+        except RuntimeError as err:
+            self.logger.error(str(err))
+            return
+        self.logger.info("Solved %s in %.0fms" % (recipe, (time.time() - t) * 1000))
+
+        if flagJson:
+            solved.print()
+        else:
+            unit = { "fermentables": "kg", "hops": "g" } if recipe.get("unit_type_id") == UnitType.METRIC.value else { "fermentables": "lb", "hops": "oz" }
+            for key in ("fermentables", "hops"):
+                for old, new in zip(recipe.get(key) or [], solved.get(key) or []):
+                    print("%-40s %9.3f%-2s -> %9.3f%-2s" % (old.get("name"), old.get("amount"), unit[key], new.get("amount"), unit[key]))
+            for key in ("batch_size", "efficiency", "og", "ibu", "srm", "abv", "bggu"):
+                print("%-40s %9.3f   -> %9.3f" % (key, recipe.get(key) or 0, solved.get(key) or 0))
+
+        if flagWrite:
+            for key in ("batch_size", "boil_size", "efficiency", "fermentables", "hops", "adjuncts"):
+                if solved.get(key) is not None:
+                    recipe.set(key, solved.toDict()[key])
+            recipe.recalculate(force=True)
+            recipe.save()
+
+        return 0
+
 
 
     def diff(self, args):
 
+        """Compares the KBH and GF versions of all recipes matching a
+        name pattern, see JsonDiff. The GF recipes are loaded by up to
+        -c concurrent requests. Prints the differences of each recipe,
+        or with -s a summary line per recipe. -t sets the tolerance of
+        numbers, -a includes fields that only GF knows."""
+
+        flagSummary = False
+        flagAll = False
+        tolerance = 0.001
+        concurrency = self.config.get("concurrency", 4) if self.config else 4
+
         if not self.kbh:
             self.logger.error("No KBH database, use -k option")
             return
@@ -2485,38 +6769,84 @@ class Interpreter(object):
             self.logger.error("No Grainfather session, use -u and -p/-P options")
             return
 
+        try:
+            opts, args = getopt.getopt(args, "sat:c:", ["summary", "all", "tolerance=", "concurrency="])
+        except getopt.GetoptError as err:
+            self.logger.error(str(err))
+            return
+        for o, a in opts:
+            if o in ("-s", "--summary"):
+                flagSummary = True
+            elif o in ("-a", "--all"):
+                flagAll = True
+            elif o in ("-t", "--tolerance"):
+                tolerance = float(a)
+            elif o in ("-c", "--concurrency"):
+                concurrency = int(a)
+            else:
+                assert False, "unhandled option"
+
         if len(args) >= 1:
             namepattern = args[0]
         else:
-            self.logger.error("No name supplied")
-            return
+            namepattern = "*"
 
-        kbh_recipe = self.kbh.getRecipe(namepattern=namepattern)
-        gf_recipe = self.session.getMyRecipe(namepattern=namepattern)
+        kbh_index = RecipeIndex(self.kbh.getRecipes(namepattern))
+        MEMORY.mark("kbh loaded")
+        gf_index = RecipeIndex(self.getGfRecipes(namepattern))
+        MEMORY.mark("gf listing")
+        rows = list(RecipeIndex.join(kbh_index, gf_index))
 
-        if kbh_recipe and gf_recipe:
-        
-            kbh_file = tempfile.NamedTemporaryFile(delete=False)
-            kbh_file.write(str.encode(json.dumps(kbh_recipe.data, sort_keys=True, indent=4)))
-            kbh_file.flush()
-            kbh_file.seek(0)
+        # load the full GF documents of all recipes found on both sides
+        def load(recipe):
+            if not recipe.isFull():
+                recipe.reload()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            list(pool.map(load, [ gf_recipe for (name, kbh_recipe, gf_recipe) in rows if kbh_recipe and gf_recipe ]))
+        MEMORY.mark("gf reloaded")
+
+        jsonDiff = JsonDiff(tolerance=tolerance, all=flagAll)
+        counts = collections.Counter()
+
+        if flagSummary:
+            print("%8s %-8s %7s %s" % ("ID", "status", "fields", "name"))
+
+        for name, kbh_recipe, gf_recipe in rows:
 
-            gf_file = tempfile.NamedTemporaryFile(delete=False)
-            gf_file.write(str.encode(json.dumps(gf_recipe.data, sort_keys=True, indent=4)))
-            gf_file.flush()
-            gf_file.seek(0)
+            if not gf_recipe:
+                status, differences = "kbh-only", []
+            elif not kbh_recipe:
+                status, differences = "gf-only", []
+            else:
+                differences = jsonDiff.compare(kbh_recipe.toDict(), gf_recipe.toDict())
+                status = "drift" if differences else "same"
+            counts[status] += 1
+
+            if flagSummary:
+                print("%8s %-8s %7s %s" % (gf_recipe.get("id") if gf_recipe else "-", status,
+                                           len(differences) if kbh_recipe and gf_recipe else "-", name))
+            elif status != "same":
+                print("--- %s (KBH)" % (name if kbh_recipe else "/dev/null"))
+                print("+++ %s (GF %s)" % ((name, gf_recipe.get("id")) if gf_recipe else ("/dev/null", "-")))
+                for line in JsonDiff.format(differences):
+                    print(line)
 
-            subprocess.call(['diff', '-u', kbh_file.name, gf_file.name])
+        if flagSummary:
+            print()
+            print(", ".join("%d %s" % (counts[s], s) for s in ("same", "drift", "kbh-only", "gf-only")))
 
-            kbh_file.close()
-            gf_file.close()
-            os.unlink(kbh_file.name)
-            os.unlink(gf_file.name)
+        return counts["drift"]
 
 
 
     def daemon(self, args):
 
+        """Pushes all changes of the KBH database to the GF site. The GF
+        recipes are kept in a resident index between the syncs, so that
+        a change costs only the requests for the changed recipes. The
+        full listing is repeated in the background every
+        "indexRefresh" seconds (default an hour)."""
+
         if not self.kbh:
             self.logger.error("No KBH database, use -k option")
             return
@@ -2525,7 +6855,15 @@ class Interpreter(object):
             self.logger.error("No Grainfather session, use -u and -p/-P options")
             return
 
-        self.push(args)
+        refreshInterval = self.config.get("indexRefresh", 3600) if self.config else 3600
+        self.gfIndex = ResidentIndex()
+        refresher = None
+
+        metricsServer = None
+        if self.config and self.config.get("metricsAddress"):
+            metricsServer = MetricsServer(self.config["metricsAddress"], maxAge=self.config.get("healthMaxAge"))
+
+        self.sync(args)
 
         self.logger.info("Now watching %s for changes..." % (self.config["kbhFile"]))
         mtime = None
@@ -2535,22 +6873,87 @@ class Interpreter(object):
                 time.sleep(1)
                 self.logger.info("Detected KBH change, syncing...")
                 self.kbh.reopen()
-                self.push(args)
+                self.sync(args, stat.st_mtime)
             mtime = stat.st_mtime
+            if (self.gfIndex.age() > refreshInterval) and not (refresher and refresher.is_alive()):
+                refresher = threading.Thread(target=self.gfIndex.refresh, args=(self.session,), name="refresh", daemon=True)
+                refresher.start()
             time.sleep(1)
 
 
 
+    def sync(self, args, mtime=None):
+
+        """Runs one push of the daemon and records its metrics. For a
+        sync triggered by a change, the lag is measured from the
+        modification time mtime of the KBH database."""
+
+        t = time.perf_counter()
+        try:
+            failed = self.push(args)
+        except Exception as error:
+            self.logger.error("Sync failed: %s" % (error))
+            failed = None
+        METRICS.observe("grainfather_sync_seconds", time.perf_counter() - t)
+
+        if failed == 0:
+            now = time.time()
+            METRICS.inc("grainfather_syncs_total", result="ok")
+            METRICS.set("grainfather_last_sync_timestamp_seconds", now)
+            if mtime:
+                METRICS.set("grainfather_sync_lag_seconds", max(0.0, now - mtime))
+            METRICS.set("grainfather_last_sync_failed", 0)
+        else:
+            METRICS.inc("grainfather_syncs_total", result="failed")
+            METRICS.set("grainfather_last_sync_failed", 1)
+
+        return failed
+
+
+
+    def serve(self, args):
+
+        """Answers list, dump, diff and push commands of thin clients
+        (see --client) on a Unix socket, by default "serveSocket" of
+        the configuration, keeping the session, the KBH connection and
+        an index of the GF recipes warm between the commands."""
+
+        if not self.session:
+            self.logger.error("No Grainfather session, use -u and -p/-P options")
+            return
+
+        if len(args) >= 1:
+            path = args[0]
+        else:
+            path = self.config.get("serveSocket", "~/.grainfather.sock") if self.config else "~/.grainfather.sock"
+
+        self.gfIndex = ResidentIndex()
+        self.gfIndex.refresh(self.session)
+        self.refresh()
+
+        try:
+            QueryServer(self, os.path.expanduser(path)).serveForever()
+        except KeyboardInterrupt:
+            pass
+
+        return 0
+
+
+
     def login(self, args):
 
         self.session.login()
 
+        return 0
+
 
 
     def logout(self, args):
 
         self.session.logout()
 
+        return 0
+
 
 
     def test(self, args):
@@ -2582,7 +6985,7 @@ class Interpreter(object):
                     id = gf_recipe.get("id")
                     break
                 
-            print(json.dumps(bs_recipe.data, sort_keys=True, indent=4))
+            print(json.dumps(bs_recipe.toDict(), sort_keys=True, indent=4))
 
             if id:
                 if ((gf_recipe.get("updated_at")[:10] + "T00:00:00.000000Z") > bs_recipe.get("updated_at")) and (not self.session.force):
@@ -2602,6 +7005,8 @@ class Interpreter(object):
 #        r.recalculate(force=True)
 #        print(json.dumps(r.data, sort_keys=True, indent=4))
 
+        return 0
+
 
 
 def usage():
@@ -2619,13 +7024,29 @@ def usage():
   -l           --logout              logout (instead of keeping session persistent)
   -k file      --kbhfile file        Kleiner Brauhelfer database file
   -b file      --bsdir dir           BeerSmith3 database directory
+               --baseurl url         Grainfather brew site URL (e.g. a local stand-in server)
+               --oauthurl url        Grainfather login site URL
+               --metrics address     serve daemon metrics on [host:]port or a Unix socket path
+               --socket file         Unix socket of serve (default ~/.grainfather.sock)
+               --client              send the command to a running serve
+               --profile             print the time spent per phase at exit
+               --profile-output file also write a cProfile .pstats or collapsed stack file
+               --memory              print memory use and growth per phase at exit
 Commands:
-  list ["namepattern"]               list user's recipes
-  dump ["namepattern"]               dump user's recipes 
-  push ["namepattern"]               push recipes from KBH to GF
-  delete "namepattern"               delete user's recipes
-  diff "namepattern"                 show json diff between kbh and gf version of a recipe
+  list [-f format] ["namepattern"]   list user's recipes (format table, json or ndjson)
+  dump [-f format] ["namepattern"]   dump user's recipes (format json, ndjson or table)
+  push [-b] [-j] [-l] [-r] [-c n] [-o order] ["namepattern"]
+                                     push recipes (and brews) from KBH to GF, -n shows the plan
+  pull [-b] [-c n] ["namepattern"]   pull GF edits of recipes (and brews) back into KBH
+  delete [-c n] "namepattern"        delete user's recipes, -n lists them
+  set "namepattern" attr value ...   set attributes of user's recipes
+  convert [-k] [-g] [-s] [-b] [-o dir] ["namepattern"]
+                                     export recipes (and brews) to Brewfather as NDJSON or files
+  solve "namepattern" og=... ...     fit grain and hop amounts to og, ibu, srm, volume, efficiency
+  diff [-s] [-a] [-t tol] ["namepattern"]
+                                     show differences between kbh and gf versions of recipes
   daemon                             run as daemon keeping GF synced with KBH
+  serve ["socket"]                   answer list, dump, diff and push of --client calls
   logout                             logout and invalidate persistent session""" % sys.argv[0])
 
 
@@ -2646,12 +7067,13 @@ def mergeConfig(config, filename, notify=True):
 def main():
 
     level = None
-    session = None
-    kbh = None
-    bs = None
     dryrun = False
     force = False
     logout = False
+    client = False
+    profile = False
+    profileOutput = None
+    memory = False
 
     logging.basicConfig()
     level = logging.WARNING
@@ -2669,7 +7091,18 @@ def main():
         password = None,
         kbhFile = "~/.kleiner-brauhelfer/kb_daten.sqlite",
         bsDir = "~/Documents/BeerSmith3",
-        bsPattern = "Sync"
+        bsPattern = "Sync",
+        baseUrl = DEFAULT_BASEURL,
+        oauthUrl = DEFAULT_OAUTHURL,
+        requestRate = None,
+        concurrency = 4,
+        brewCacheFile = "~/.grainfather.brews",
+        brewCacheAge = 86400,
+        indexRefresh = 3600,
+        metricsAddress = None,
+        healthMaxAge = None,
+        serveSocket = "~/.grainfather.sock",
+        journalFile = "~/.grainfather.journal"
         )
     
     config = mergeConfig(config, config["globalConfigFile"], notify=False)
@@ -2678,7 +7111,7 @@ def main():
     try:
         opts, args = getopt.getopt(sys.argv[1:],
                                    "vdqsnfhc:u:p:P:lk:b:",
-                                   ["verbose", "debug", "quiet", "syslog", "dryrun", "force", "help", "config=", "user=", "password=", "pwfile=", "logout", "kbhfile=", "bsdir="])
+                                   ["verbose", "debug", "quiet", "syslog", "dryrun", "force", "help", "config=", "user=", "password=", "pwfile=", "logout", "kbhfile=", "bsdir=", "baseurl=", "oauthurl=", "metrics=", "client", "socket=", "profile", "profile-output=", "memory"])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -2745,9 +7178,48 @@ def main():
         elif o in ("-b", "--bsdir"):
             config["bsDir"] = a
 
+        elif o == "--baseurl":
+            config["baseUrl"] = a
+
+        elif o == "--oauthurl":
+            config["oauthUrl"] = a
+
+        elif o == "--metrics":
+            config["metricsAddress"] = a
+
+        elif o == "--client":
+            client = True
+
+        elif o == "--socket":
+            config["serveSocket"] = a
+
+        elif o == "--profile":
+            profile = True
+
+        elif o == "--profile-output":
+            profile = True
+            profileOutput = a
+
+        elif o == "--memory":
+            memory = True
+
         else:
             assert False, "unhandled option"
 
+    # a thin client lets a running "serve" do the work
+    if client:
+        if (len(args) < 1) or (args[0] not in QueryServer.COMMANDS):
+            logger.error("Only %s can be sent to a server" % (", ".join(QueryServer.COMMANDS)))
+            return 2
+        try:
+            response = QueryServer.query(os.path.expanduser(config["serveSocket"]), args[0], args[1:], dryrun=dryrun, level=level)
+        except OSError as error:
+            logger.error("Could not connect to %s: %s" % (config["serveSocket"], error))
+            return 2
+        sys.stdout.write(response["output"])
+        sys.stderr.write(response["log"])
+        return response["status"]
+
     if "passwordFile" in config:
         try:
             with open(os.path.expanduser(config["passwordFile"])) as f:
@@ -2756,25 +7228,44 @@ def main():
         except Exception as error:
             logger.error("Could not read password from file: %s" % (error))
 
-    session = Session(username=config["username"], password=config["password"],
-                      readonly=dryrun, force=force, stateFile=config["stateFile"])
+    # the session, the KBH database and the BeerSmith directory are
+    # only opened if the command uses them
+    factories = {}
+
+    factories["session"] = lambda: Session(username=config["username"], password=config["password"],
+                                           readonly=dryrun, force=force, stateFile=config["stateFile"],
+                                           baseUrl=config["baseUrl"], oauthUrl=config["oauthUrl"], rate=config["requestRate"])
 
     if (config["kbhFile"]):
-        kbh = KleinerBrauhelfer(os.path.expanduser(config["kbhFile"]))
+        factories["kbh"] = lambda: KleinerBrauhelfer(os.path.expanduser(config["kbhFile"]))
 
     if (config["bsDir"]):
-        bs = BeerSmith3(dir=os.path.expanduser(config["bsDir"]), pattern=config["bsPattern"])
+        factories["bs"] = lambda: BeerSmith3(dir=os.path.expanduser(config["bsDir"]), pattern=config["bsPattern"])
 
-    interpreter = Interpreter(kbh=kbh, bs=bs, session=session, config=config)
+    interpreter = Interpreter(config=config, factories=factories)
+
+    if profile:
+        PROFILER.start(profileOutput)
+    if memory:
+        MEMORY.start()
+
+    # nothing to do but e.g. to log out is fine
+    result = 0
+    try:
+        op = None
+        arg = None
+        if len(args) >= 1:
+            op = args[0]
+            with PROFILER.span(op):
+                result = getattr(interpreter, op)(args[1:])
 
-    op = None
-    arg = None
-    if len(args) >= 1:
-        op = args[0]
-        result = getattr(interpreter, op)(args[1:])
+        if logout:
+            interpreter.session.logout()
+    finally:
+        PROFILER.stop()
+        MEMORY.stop()
 
-    if logout:
-        session.logout()
+    return Interpreter.exitStatus(result)
 
 
 
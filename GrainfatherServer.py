@@ -0,0 +1,833 @@
+#!/usr/bin/env python3
+"""
+GrainfatherServer - Local stand-in for the Grainfather brew community backend
+
+Copyright (C) 2018-2019 Frank Steinberg <frank@familie-steinberg.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""
+
+
+
+import io
+import re
+import sys
+import json
+import time
+import getopt
+import random
+import logging
+import secrets
+import datetime
+import threading
+import http.client
+import http.server
+import http.cookies
+import urllib.parse
+try:
+    import urllib3
+    import requests.adapters
+except ImportError:
+    requests = None
+
+
+
+SESSION_COOKIE		= "laravel_session"
+FIRST_RECIPE_ID		= 100000
+FIRST_BREW_ID		= 500000
+
+# attributes of a recipe that are part of the "my-recipes" listing, all
+# others are only delivered by the full "recipes/data/{id}" document
+LISTING_FIELDS = [ "id", "user_id", "name", "description", "created_at", "updated_at",
+                   "batch_size", "unit_type_id", "recipe_type_id", "is_public", "is_active",
+                   "og", "fg", "ibu", "srm", "abv", "bjcp_style_id", "source", "parent_recipe_id" ]
+
+# attributes of a brew session that are part of the "brew-sessions/data" listing
+BREW_LISTING_FIELDS = [ "id", "recipe_id", "name", "created_at", "updated_at", "status",
+                        "unit_type_id", "is_public", "is_active", "ferment_volume_est" ]
+
+STYLES = [
+    ("Pale Ale", "18B"), ("India Pale Ale", "21A"), ("Weizenbier", "10A"), ("Irish Stout", "15B"),
+    ("Altbier", "7B"), ("Pils", "5D"), ("Munich Dunkel", "8A"), ("Saison", "25B") ]
+
+FERMENTABLES = [
+    # name, ppg, lovibond
+    ("Pilsner Malz", 37.0, 1.6), ("Pale Ale Malz", 37.0, 3.0), ("Münchner Malz Typ I", 37.0, 5.6),
+    ("Wiener Malz", 36.0, 3.5), ("Weizenmalz hell", 37.0, 1.9), ("Caramünch Typ II", 34.0, 46.0),
+    ("Carafa Spezial Typ II", 32.0, 415.0), ("Haferflocken", 33.0, 1.2) ]
+
+HOPS = [
+    # name, alpha
+    ("Magnum", 12.5), ("Herkules", 15.0), ("Hallertauer Tradition", 6.0), ("Citra", 13.0),
+    ("Cascade", 6.5), ("Saazer", 3.5), ("Mosaic", 12.0), ("Simcoe", 13.0) ]
+
+YEASTS = [
+    # name, attenuation
+    ("Fermentis Safale US-05", 0.81), ("Fermentis Saflager W-34/70", 0.83),
+    ("Lallemand Nottingham", 0.80), ("Fermentis Safbrew WB-06", 0.86) ]
+
+EQUIPMENT = [
+    { "id": 1, "name": "Grainfather", "batch_size": 23.0, "boil_time": 60 },
+    { "id": 2, "name": "Grainfather G30", "batch_size": 25.0, "boil_time": 60 } ]
+
+
+
+def now():
+
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000000Z")
+
+
+
+class Backend(object):
+
+    """In-memory state of the stand-in server and the dispatching of
+    requests to it. The transport is kept separate, so that the same
+    backend can be served over HTTP or called in-process."""
+
+    routes = [
+        ("GET",    r'^/login/?$',                                                  "getLogin",       False),
+        ("GET",    r'^/customer/account/login/?$',                                 "getLoginForm",   False),
+        ("POST",   r'^/customer/account/loginPost/?$',                             "postLogin",      False),
+        ("GET",    r'^/?$',                                                        "getIndex",       False),
+        ("GET",    r'^/logout/?$',                                                 "getLogout",      False),
+        ("GET",    r'^/my-recipes/data/?$',                                        "getMyRecipes",   True),
+        ("GET",    r'^/recipes/data/(?P<id>[0-9]+)$',                              "getRecipe",      True),
+        ("POST",   r'^/recipes/?$',                                                "postRecipe",     True),
+        ("PUT",    r'^/recipes/(?P<id>[0-9]+)$',                                   "putRecipe",      True),
+        ("DELETE", r'^/recipes/(?P<id>[0-9]+)$',                                   "deleteRecipe",   True),
+        ("GET",    r'^/recipes/(?P<recipe_id>[0-9]+)/brew-sessions/data/?$',       "getBrews",       True),
+        ("GET",    r'^/recipes/(?P<recipe_id>[0-9]+)/brew-sessions/data/(?P<id>[0-9]+)$', "getBrew", True),
+        ("POST",   r'^/recipes/(?P<recipe_id>[0-9]+)/brew-sessions/?$',            "postBrew",       True),
+        ("PUT",    r'^/recipes/(?P<recipe_id>[0-9]+)/brew-sessions/(?P<id>[0-9]+)$', "putBrew",      True),
+        ("DELETE", r'^/recipes/(?P<recipe_id>[0-9]+)/brew-sessions/(?P<id>[0-9]+)$', "deleteBrew",   True),
+        ("GET",    r'^/my-equipment/brewing/data/?$',                              "getEquipment",   True),
+        ]
+
+
+
+    def __init__(self, recipes=100, brews=3, seed=0, pageSize=10, latency=0, jitter=0,
+                 errorRate=0.0, throttleRate=0.0, username=None, password=None):
+
+        """Creates a backend holding the given number of synthetic
+        recipes, each with up to the given number of brew sessions.
+        Latencies are given in milliseconds, error and throttle rates
+        as fractions of all requests."""
+
+        self.logger = logging.getLogger('server')
+        self.lock = threading.Lock()
+
+        self.seed = seed
+        self.maxBrews = brews
+        self.pageSize = pageSize
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.throttleRate = throttleRate
+        self.username = username
+        self.password = password
+
+        self.random = random.Random(seed)
+        self.recipes = {}
+        self.brews = {}
+        self.sessions = {}
+        self.loginTokens = {}
+        self.counts = {}
+        self.nextRecipeId = FIRST_RECIPE_ID
+        self.nextBrewId = FIRST_BREW_ID
+        self.apiToken = secrets.token_hex(30)
+
+        self.compiled = [ (m, re.compile(p), h, a) for (m, p, h, a) in self.routes ]
+
+        for i in range(recipes):
+            recipe = self.syntheticRecipe(self.nextRecipeId, i)
+            self.recipes[recipe["id"]] = recipe
+            self.nextRecipeId += 1
+
+
+
+    def syntheticRecipe(self, id, i):
+
+        """Builds a plausible full recipe document. The same seed always
+        results in the same recipes."""
+
+        r = random.Random("%s:recipe:%d" % (self.seed, id))
+
+        style, bjcp = r.choice(STYLES)
+        batch_size = float("%.1f" % r.uniform(10.0, 30.0))
+        efficiency = float("%.2f" % r.uniform(0.6, 0.8))
+        boil_time = r.choice([60, 70, 80, 90])
+        created = datetime.datetime(2016, 1, 1) + datetime.timedelta(minutes=r.randrange(3 * 365 * 24 * 60))
+        updated = created + datetime.timedelta(minutes=r.randrange(365 * 24 * 60))
+
+        fermentables = []
+        for f in r.sample(FERMENTABLES, r.randint(2, 6)):
+            fermentables.append({
+                    "name": f[0],
+                    "ppg": f[1],
+                    "lovibond": f[2],
+                    "fermentable_usage_type_id": 10,
+                    "fermentable_id": None,
+                    "amount": float("%.3f" % r.uniform(0.1, 5.0)) })
+
+        hops = []
+        for h in r.sample(HOPS, r.randint(2, 6)):
+            usage = r.choice([15, 20, 20, 20, 30, 40])
+            hops.append({
+                    "name": h[0],
+                    "aa": h[1],
+                    "hop_type_id": r.choice([10, 20]),
+                    "hop_usage_type_id": usage,
+                    "time": r.choice([3, 5, 7]) if usage == 40 else (boil_time if usage == 15 else r.choice([0, 5, 10, 30, 60])),
+                    "amount": float("%.1f" % r.uniform(5.0, 80.0)) })
+
+        yeast = r.choice(YEASTS)
+
+        recipe = {
+            "id": id,
+            "user_id": 1,
+            "name": "#%05d Synthetic %s" % (i, style),
+            "description": "A synthetic %s for load testing." % (style),
+            "notes": "Generated by GrainfatherServer.py.",
+            "author": "GrainfatherServer",
+            "created_at": created.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+            "updated_at": updated.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+            "batch_size": batch_size,
+            "boil_size": float("%.1f" % (batch_size * 1.2)),
+            "boil_time": boil_time,
+            "efficiency": efficiency,
+            "losses": 2.0,
+            "og": float("%.3f" % r.uniform(1.040, 1.090)),
+            "fg": float("%.3f" % r.uniform(1.008, 1.020)),
+            "ibu": float("%.1f" % r.uniform(10.0, 80.0)),
+            "srm": float("%.1f" % r.uniform(2.0, 40.0)),
+            "abv": float("%.1f" % r.uniform(3.5, 9.0)),
+            "bggu": float("%.2f" % r.uniform(0.2, 1.2)),
+            "calories": r.randint(120, 300),
+            "bjcp_style_id": bjcp,
+            "is_public": r.random() < 0.5,
+            "is_active": True,
+            "unit_type_id": 10,
+            "recipe_type_id": 10,
+            "source": "GrainfatherServer",
+            "parent_recipe_id": None,
+            "fermentables": fermentables,
+            "hops": hops,
+            "yeasts": [ { "name": yeast[0], "amount": 1, "unit": "packets", "attenuation": yeast[1] } ],
+            "adjuncts": [],
+            "mash_steps": [
+                { "order": 0, "name": "Einmaischen", "temperature": 57, "time": 10 },
+                { "order": 1, "name": "Maltoserast", "temperature": 63, "time": 40 },
+                { "order": 2, "name": "Verzuckerung", "temperature": 72, "time": 30 },
+                { "order": 3, "name": "Abmaischen", "temperature": 78, "time": 10 } ],
+            "fermentation_steps": [
+                { "order": 0, "name": "Hauptgärung", "temperature": r.choice([10, 12, 18, 20]), "time": r.randint(7, 14) } ]
+            }
+
+        self.assignItemIds(recipe)
+
+        return recipe
+
+
+
+    def syntheticBrews(self, recipe):
+
+        """Builds the brew sessions of a recipe. These are generated
+        lazily on first access, so that large accounts are cheap."""
+
+        r = random.Random("%s:brews:%d" % (self.seed, recipe["id"]))
+
+        brews = {}
+        created = datetime.datetime.strptime(recipe["created_at"][:19], "%Y-%m-%dT%H:%M:%S")
+        for i in range(r.randint(0, self.maxBrews)):
+            created = created + datetime.timedelta(days=r.randint(14, 120))
+            status = r.choice([10, 20, 30, 40, 40])
+            brew = {
+                "id": self.nextBrewId,
+                "recipe_id": recipe["id"],
+                "name": recipe["name"],
+                "created_at": created.strftime("%Y-%m-%dT00:00:00.000000Z"),
+                "updated_at": (created + datetime.timedelta(days=r.randint(0, 30))).strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+                "status": status,
+                "unit_type_id": 10,
+                "is_public": recipe["is_public"],
+                "is_active": True,
+                "boil_time": recipe["boil_time"],
+                "original_gravity": float("%.3f" % (recipe["og"] + r.uniform(-0.004, 0.004))),
+                "final_gravity": float("%.3f" % (recipe["fg"] + r.uniform(-0.003, 0.003))),
+                "ferment_volume_est": recipe["batch_size"],
+                "ferment_volume_actual": float("%.1f" % (recipe["batch_size"] + r.uniform(-1.5, 1.0))),
+                "equipment_profiles_id": r.choice(EQUIPMENT)["id"],
+                "notes": "Synthetic brew session.",
+                "rating": r.choice([None, 3, 4, 5]) if status == 40 else None
+                }
+            self.nextBrewId += 1
+            brews[brew["id"]] = brew
+
+        return brews
+
+
+
+    def assignItemIds(self, data):
+
+        """Like the real backend, we assign ids to the ingredient and
+        step items of a document."""
+
+        n = 1
+        for key in [ "fermentables", "hops", "yeasts", "adjuncts", "mash_steps", "fermentation_steps" ]:
+            for item in data.get(key) or []:
+                if isinstance(item, dict):
+                    item["id"] = data["id"] * 100 + n
+                    n += 1
+
+
+
+    def recipeBrews(self, recipe_id):
+
+        if recipe_id not in self.brews:
+            self.brews[recipe_id] = self.syntheticBrews(self.recipes[recipe_id])
+
+        return self.brews[recipe_id]
+
+
+
+    def handle(self, method, target, headers, body=b"", base="http://127.0.0.1"):
+
+        """Processes a single request and returns a tuple of status
+        code, list of header tuples and body bytes."""
+
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+
+        cookies = {}
+        if headers.get("Cookie"):
+            c = http.cookies.SimpleCookie()
+            c.load(headers.get("Cookie"))
+            cookies = { k: v.value for (k, v) in c.items() }
+
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+        for (m, pattern, handler, auth) in self.compiled:
+            match = pattern.match(url.path)
+            if match and (m == method):
+                break
+        else:
+            return self.reply(404, { "message": "Not Found" })
+
+        with self.lock:
+            self.counts[handler] = self.counts.get(handler, 0) + 1
+            roll = self.random.random()
+
+        if roll < self.throttleRate:
+            return self.reply(429, { "message": "Too Many Attempts." }, headers=[ ("Retry-After", "1") ])
+        if roll < self.throttleRate + self.errorRate:
+            return self.reply(500, { "message": "Server Error" })
+
+        session = self.sessions.get(cookies.get(SESSION_COOKIE))
+        if auth:
+            if not session:
+                return self.reply(401, { "message": "Unauthenticated." })
+            if (method != "GET") and (headers.get("X-CSRF-TOKEN") != session["csrfToken"]):
+                return self.reply(419, { "message": "CSRF token mismatch." })
+
+        args = { k: int(v) for (k, v) in match.groupdict().items() }
+
+        with self.lock:
+            return getattr(self, handler)(session=session, query=query, body=body, base=base, **args)
+
+
+
+    def reply(self, status, data=None, headers=None, text=None):
+
+        headers = list(headers or [])
+        if text is not None:
+            body = text.encode("utf-8")
+            headers.append(("Content-Type", "text/html; charset=UTF-8"))
+        elif data is not None:
+            body = json.dumps(data).encode("utf-8")
+            headers.append(("Content-Type", "application/json"))
+        else:
+            body = b""
+
+        return (status, headers, body)
+
+
+
+    def redirect(self, location, headers=None):
+
+        return (302, [ ("Location", location) ] + list(headers or []), b"")
+
+
+
+    def sessionCookies(self, sid, session):
+
+        return [ ("Set-Cookie", "%s=%s; path=/; httponly" % (SESSION_COOKIE, sid)),
+                 ("Set-Cookie", "XSRF-TOKEN=%s; path=/" % (session["xsrfToken"])) ]
+
+
+
+    def page(self, items, page, url):
+
+        """Paginates a list of items in the way the Laravel backend does."""
+
+        last = max(1, (len(items) + self.pageSize - 1) // self.pageSize)
+        start = (page - 1) * self.pageSize
+
+        return {
+            "current_page": page,
+            "data": items[start:start + self.pageSize],
+            "first_page_url": "%s?page=1" % (url),
+            "from": start + 1 if items else None,
+            "last_page": last,
+            "last_page_url": "%s?page=%d" % (url, last),
+            "next_page_url": "%s?page=%d" % (url, page + 1) if page < last else None,
+            "path": url,
+            "per_page": self.pageSize,
+            "prev_page_url": "%s?page=%d" % (url, page - 1) if page > 1 else None,
+            "to": min(start + self.pageSize, len(items)) if items else None,
+            "total": len(items)
+            }
+
+
+
+    def getLogin(self, session, query, body, base):
+
+        if session:
+            return self.redirect("%s/" % (base))
+
+        token = secrets.token_hex(16)
+        self.loginTokens[token] = secrets.token_hex(8)
+
+        return self.redirect("%s/customer/account/login/?oauth_token=%s" % (base, token))
+
+
+
+    def getLoginForm(self, session, query, body, base):
+
+        token = query.get("oauth_token", [""])[0]
+        if token not in self.loginTokens:
+            return self.redirect("%s/login" % (base))
+
+        return self.reply(200, text="\n".join([
+            "<html>",
+            "<body>",
+            "<form action=\"%s/customer/account/loginPost/\" method=\"post\">" % (base),
+            "<input name=\"form_key\" type=\"hidden\" value=\"%s\" />" % (self.loginTokens[token]),
+            "<input name=\"oauth_token\" type=\"hidden\" value=\"%s\" />" % (token),
+            "<input name=\"login[username]\" type=\"email\" />",
+            "<input name=\"login[password]\" type=\"password\" />",
+            "</form>",
+            "</body>",
+            "</html>" ]))
+
+
+
+    def postLogin(self, session, query, body, base):
+
+        form = urllib.parse.parse_qs(body.decode("utf-8"))
+        token = form.get("oauth_token", [""])[0]
+        username = form.get("login[username]", [""])[0]
+        password = form.get("login[password]", [""])[0]
+
+        if (token not in self.loginTokens) or (self.loginTokens.pop(token) != form.get("form_key", [""])[0]):
+            return self.redirect("%s/login" % (base))
+        if (self.username and username != self.username) or (self.password and password != self.password) or (not username):
+            self.logger.info("rejected login of user %s" % (username))
+            return self.redirect("%s/login" % (base))
+
+        sid = secrets.token_hex(20)
+        session = self.sessions[sid] = {
+            "username": username,
+            "csrfToken": secrets.token_hex(20),
+            "xsrfToken": secrets.token_hex(20) }
+        self.logger.info("user %s logged in" % (username))
+
+        return self.redirect("%s/" % (base), headers=self.sessionCookies(sid, session))
+
+
+
+    def getIndex(self, session, query, body, base):
+
+        if not session:
+            return self.redirect("%s/login" % (base))
+
+        sid = next(k for (k, v) in self.sessions.items() if v is session)
+        metadata = {
+            "csrfToken": session["csrfToken"],
+            "user": { "id": 1, "name": session["username"], "api_token": self.apiToken } }
+
+        return self.reply(200, headers=self.sessionCookies(sid, session), text="\n".join([
+            "<html>",
+            "<head>",
+            "<script>",
+            "window.Grainfather = %s" % (json.dumps(metadata)),
+            "</script>",
+            "</head>",
+            "<body></body>",
+            "</html>" ]))
+
+
+
+    def getLogout(self, session, query, body, base):
+
+        for (k, v) in list(self.sessions.items()):
+            if v is session:
+                del self.sessions[k]
+
+        return self.redirect("%s/login" % (base))
+
+
+
+    def getMyRecipes(self, session, query, body, base):
+
+        page = int(query.get("page", ["1"])[0])
+        items = [ { k: r.get(k) for k in LISTING_FIELDS } for r in sorted(self.recipes.values(), key=lambda r: r["id"]) ]
+
+        return self.reply(200, self.page(items, page, "%s/my-recipes/data" % (base)))
+
+
+
+    def getRecipe(self, session, query, body, base, id):
+
+        if id not in self.recipes:
+            return self.reply(404, { "message": "Not Found" })
+
+        return self.reply(200, self.recipes[id])
+
+
+
+    def postRecipe(self, session, query, body, base):
+
+        data = json.loads(body.decode("utf-8"))
+        if not data.get("name"):
+            return self.reply(422, { "message": "The given data was invalid.", "errors": { "name": [ "required" ] } })
+
+        data["id"] = self.nextRecipeId
+        self.nextRecipeId += 1
+        data["user_id"] = 1
+        # the real backend overwrites the dates
+        data["created_at"] = data["updated_at"] = now()
+        self.assignItemIds(data)
+        self.recipes[data["id"]] = data
+        self.brews[data["id"]] = {}
+
+        return self.reply(200, data)
+
+
+
+    def putRecipe(self, session, query, body, base, id):
+
+        if id not in self.recipes:
+            return self.reply(404, { "message": "Not Found" })
+
+        data = json.loads(body.decode("utf-8"))
+        data["id"] = id
+        data["user_id"] = 1
+        data["created_at"] = self.recipes[id]["created_at"]
+        data["updated_at"] = now()
+        self.assignItemIds(data)
+        self.recipes[id] = data
+
+        return self.reply(200, data)
+
+
+
+    def deleteRecipe(self, session, query, body, base, id):
+
+        if id not in self.recipes:
+            return self.reply(404, { "message": "Not Found" })
+
+        del self.recipes[id]
+        self.brews.pop(id, None)
+
+        return self.reply(200, {})
+
+
+
+    def getBrews(self, session, query, body, base, recipe_id):
+
+        if recipe_id not in self.recipes:
+            return self.reply(404, { "message": "Not Found" })
+
+        page = int(query.get("page", ["1"])[0])
+        brews = sorted(self.recipeBrews(recipe_id).values(), key=lambda b: b["id"])
+        items = [ { k: b.get(k) for k in BREW_LISTING_FIELDS } for b in brews ]
+
+        return self.reply(200, self.page(items, page, "%s/recipes/%d/brew-sessions/data" % (base, recipe_id)))
+
+
+
+    def getBrew(self, session, query, body, base, recipe_id, id):
+
+        if (recipe_id not in self.recipes) or (id not in self.recipeBrews(recipe_id)):
+            return self.reply(404, { "message": "Not Found" })
+
+        return self.reply(200, self.recipeBrews(recipe_id)[id])
+
+
+
+    def postBrew(self, session, query, body, base, recipe_id):
+
+        if recipe_id not in self.recipes:
+            return self.reply(404, { "message": "Not Found" })
+
+        data = json.loads(body.decode("utf-8"))
+        data["id"] = self.nextBrewId
+        self.nextBrewId += 1
+        data["recipe_id"] = recipe_id
+        data["updated_at"] = now()
+        if not data.get("created_at"):
+            data["created_at"] = data["updated_at"]
+        self.recipeBrews(recipe_id)[data["id"]] = data
+
+        return self.reply(200, data)
+
+
+
+    def putBrew(self, session, query, body, base, recipe_id, id):
+
+        if (recipe_id not in self.recipes) or (id not in self.recipeBrews(recipe_id)):
+            return self.reply(404, { "message": "Not Found" })
+
+        data = json.loads(body.decode("utf-8"))
+        data["id"] = id
+        data["recipe_id"] = recipe_id
+        data["updated_at"] = now()
+        if not data.get("created_at"):
+            data["created_at"] = self.recipeBrews(recipe_id)[id]["created_at"]
+        self.recipeBrews(recipe_id)[id] = data
+
+        return self.reply(200, data)
+
+
+
+    def deleteBrew(self, session, query, body, base, recipe_id, id):
+
+        if (recipe_id not in self.recipes) or (id not in self.recipeBrews(recipe_id)):
+            return self.reply(404, { "message": "Not Found" })
+
+        del self.recipeBrews(recipe_id)[id]
+
+        return self.reply(200, {})
+
+
+
+    def getEquipment(self, session, query, body, base):
+
+        return self.reply(200, EQUIPMENT)
+
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    """HTTP transport of the Backend."""
+
+    backend = None
+    protocol_version = "HTTP/1.1"
+
+
+
+    def dispatch(self):
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length > 0 else b""
+
+        status, headers, data = self.backend.handle(self.command, self.path, self.headers, body,
+                                                    base="http://%s" % (self.headers.get("Host")))
+
+        self.send_response(status)
+        for (k, v) in headers:
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = dispatch
+    do_POST = dispatch
+    do_PUT = dispatch
+    do_DELETE = dispatch
+
+
+
+    def log_message(self, format, *args):
+
+        self.backend.logger.info("%s %s" % (self.address_string(), format % args))
+
+
+
+if requests:
+
+    class Adapter(requests.adapters.BaseAdapter):
+
+        """In-process transport of the Backend for the requests library.
+        Mounted to the base URLs of a client session, requests are
+        handled without any sockets or threads, e.g. for benchmarks:
+
+            backend = Backend(recipes=1000)
+            session = Grainfather.Session(..., baseUrl="http://fake", oauthUrl="http://fake",
+                                          adapter=Adapter(backend))"""
+
+        def __init__(self, backend):
+
+            super(Adapter, self).__init__()
+            self.backend = backend
+            self.http = requests.adapters.HTTPAdapter()
+
+
+
+        def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+
+            url = urllib.parse.urlsplit(request.url)
+            target = url.path + ("?%s" % (url.query) if url.query else "")
+            body = request.body or b""
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+
+            status, headers, data = self.backend.handle(request.method, target, request.headers, body,
+                                                        base="%s://%s" % (url.scheme, url.netloc))
+
+            # requests picks cookies from the headers of the underlying http.client response
+            message = http.client.HTTPMessage()
+            for (k, v) in headers:
+                message[k] = v
+            original = Message(message)
+
+            raw = urllib3.HTTPResponse(body=io.BytesIO(data), headers=urllib3.HTTPHeaderDict(headers),
+                                       status=status, reason=http.client.responses.get(status, ""),
+                                       preload_content=False, original_response=original)
+
+            response = self.http.build_response(request, raw)
+            response.connection = self
+
+            return response
+
+
+
+        def close(self):
+
+            pass
+
+
+
+    class Message(object):
+
+        """Stands in for the http.client response an Adapter response is
+        based on."""
+
+        def __init__(self, msg):
+
+            self.msg = msg
+
+
+
+        def isclosed(self):
+
+            return True
+
+
+
+        def close(self):
+
+            pass
+
+
+
+def usage():
+    print("""Usage: %s [options]
+  -v           --verbose             increase the logging level
+  -h           --help                this help message
+  -H host      --host host           address to listen on (default 127.0.0.1)
+  -p port      --port port           port to listen on (default 8080)
+  -u username  --user username       only accept this username (default any)
+  -P password  --password password   only accept this password (default any)
+  -r n         --recipes n           number of synthetic recipes (default 100)
+  -b n         --brews n             maximum number of brew sessions per recipe (default 3)
+  -g n         --pagesize n          number of items per listing page (default 10)
+  -s n         --seed n              seed of the synthetic data (default 0)
+  -l ms        --latency ms          added latency of each request (default 0)
+  -j ms        --jitter ms           added random latency of up to ms (default 0)
+  -e rate      --errors rate         fraction of requests failing with status 500 (default 0)
+  -t rate      --throttle rate       fraction of requests failing with status 429 (default 0)
+Point Grainfather.py to the server by "--baseurl http://HOST:PORT --oauthurl http://HOST:PORT".""" % sys.argv[0])
+
+
+
+def main():
+
+    host = "127.0.0.1"
+    port = 8080
+    options = {}
+
+    logging.basicConfig()
+    logger = logging.getLogger()
+    logger.setLevel(logging.WARNING)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],
+                                   "vhH:p:u:P:r:b:g:s:l:j:e:t:",
+                                   ["verbose", "help", "host=", "port=", "user=", "password=", "recipes=", "brews=", "pagesize=",
+                                    "seed=", "latency=", "jitter=", "errors=", "throttle="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-v", "--verbose"):
+            logger.setLevel(logging.INFO if logger.level == logging.WARNING else logging.DEBUG)
+        elif o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-H", "--host"):
+            host = a
+        elif o in ("-p", "--port"):
+            port = int(a)
+        elif o in ("-u", "--user"):
+            options["username"] = a
+        elif o in ("-P", "--password"):
+            options["password"] = a
+        elif o in ("-r", "--recipes"):
+            options["recipes"] = int(a)
+        elif o in ("-b", "--brews"):
+            options["brews"] = int(a)
+        elif o in ("-g", "--pagesize"):
+            options["pageSize"] = int(a)
+        elif o in ("-s", "--seed"):
+            options["seed"] = int(a)
+        elif o in ("-l", "--latency"):
+            options["latency"] = float(a)
+        elif o in ("-j", "--jitter"):
+            options["jitter"] = float(a)
+        elif o in ("-e", "--errors"):
+            options["errorRate"] = float(a)
+        elif o in ("-t", "--throttle"):
+            options["throttleRate"] = float(a)
+        else:
+            assert False, "unhandled option"
+
+    Handler.backend = Backend(**options)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    logger.warning("Serving %d synthetic recipes on http://%s:%d" % (len(Handler.backend.recipes), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
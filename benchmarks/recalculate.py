@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+recalculate - Compare scalar and batched recalculation of recipes
+
+Copyright (C) 2018-2019 Frank Steinberg <frank@familie-steinberg.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""
+
+
+
+import os
+import sys
+import json
+import time
+import getopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Grainfather
+import GrainfatherServer
+
+
+
+def syntheticRecipes(n, seed=0):
+
+    """Returns the documents of n synthetic recipes. Some fermentables
+    are turned into steeped grains or late additions and some recipes
+    into US units, so that all branches of the calculation are used."""
+
+    backend = GrainfatherServer.Backend(recipes=n, brews=0, seed=seed)
+    recipes = []
+    for i, data in enumerate(backend.recipes.values()):
+        if i % 5 == 0:
+            data["fermentables"][0]["fermentable_usage_type_id"] = Grainfather.FermentableUsageType.STEEP.value
+        if i % 7 == 0:
+            data["fermentables"][-1]["fermentable_usage_type_id"] = Grainfather.FermentableUsageType.LATEADDITION.value
+        if i % 11 == 0:
+            data["unit_type_id"] = 20
+        recipes.append(data)
+
+    return recipes
+
+
+
+def run(n, repeat):
+
+    docs = syntheticRecipes(n)
+
+    scalar = [ Grainfather.Recipe(data=json.loads(json.dumps(d))) for d in docs ]
+    batched = [ Grainfather.Recipe(data=json.loads(json.dumps(d))) for d in docs ]
+
+    t_scalar = None
+    t_batched = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        for recipe in scalar:
+            recipe.recalculate(force=True)
+        t = time.perf_counter() - t
+        t_scalar = t if t_scalar is None else min(t_scalar, t)
+
+        t = time.perf_counter()
+        Grainfather.Calculator.recalculateAll(batched, force=True)
+        t = time.perf_counter() - t
+        t_batched = t if t_batched is None else min(t_batched, t)
+
+    mismatches = sum(1 for a, b in zip(scalar, batched) if a.toDict() != b.toDict())
+
+    print("%6d recipes: scalar %8.1fms, batched %8.1fms, speedup %5.2fx, %d mismatches" %
+          (n, t_scalar * 1000, t_batched * 1000, t_scalar / t_batched, mismatches))
+
+    return mismatches
+
+
+
+def usage():
+    print("""Usage: %s [options] [count ...]
+  -h  --help                    Print this help
+  -r  --repeat=n                Take the best of n runs (default 3)
+Counts default to 1000 and 10000 recipes.""" % sys.argv[0])
+
+
+
+def main():
+
+    repeat = 3
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:", ["help", "repeat="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if not Grainfather.numpy:
+        print("NumPy is not available, batched calculation falls back to the scalar code")
+
+    counts = [ int(a) for a in args ] or [ 1000, 10000 ]
+
+    mismatches = 0
+    for n in counts:
+        mismatches += run(n, repeat)
+
+    sys.exit(1 if mismatches else 0)
+
+
+
+if __name__ == '__main__':
+    main()
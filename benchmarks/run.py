@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+run - Time conversion, recalculation, listing and push at several scales
+
+Copyright (C) 2018-2019 Frank Steinberg <frank@familie-steinberg.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""
+
+
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import logging
+import platform
+import tempfile
+import datetime
+import tracemalloc
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Grainfather
+import GrainfatherServer
+
+import synthetic
+import recalculate
+
+
+
+FAKE_URL = "http://grainfather.invalid"
+
+
+
+def fakeSession(backend):
+
+    """Returns a session to the given backend through the in-process
+    adapter, so that no sockets are involved. It logs in on its first
+    request, which is part of the setup."""
+
+    return Grainfather.Session(username="bench", password="bench", baseUrl=FAKE_URL, oauthUrl=FAKE_URL,
+                               adapter=GrainfatherServer.Adapter(backend))
+
+
+
+# Each scenario prepares everything that should not be timed and
+# returns a function that performs the timed work.
+
+def kbhConvert(n, tmp):
+
+    path = os.path.join(tmp, "kbh-%d.sqlite" % (n))
+    if not os.path.exists(path):
+        synthetic.createKbhDatabase(path, suds=n)
+
+    def run():
+        Grainfather.KleinerBrauhelfer(path).getRecipes()
+
+    return run
+
+
+
+def beerSmithConvert(n, tmp):
+
+    dir = os.path.join(tmp, "bs-%d" % (n))
+    if not os.path.exists(dir):
+        synthetic.createBeerSmithDir(dir, recipes=n)
+
+    def run():
+        Grainfather.BeerSmith3(dir, "Sync").getRecipes()
+
+    return run
+
+
+
+def recalculateScalar(n, tmp):
+
+    recipes = [ Grainfather.Recipe(data=d) for d in recalculate.syntheticRecipes(n) ]
+
+    def run():
+        for recipe in recipes:
+            recipe.recalculate(force=True)
+
+    return run
+
+
+
+def recalculateBatched(n, tmp):
+
+    recipes = [ Grainfather.Recipe(data=d) for d in recalculate.syntheticRecipes(n) ]
+
+    def run():
+        Grainfather.Calculator.recalculateAll(recipes, force=True)
+
+    return run
+
+
+
+def listing(n, tmp):
+
+    session = fakeSession(GrainfatherServer.Backend(recipes=n, brews=0))
+
+    def run():
+        session.getMyRecipes()
+
+    return run
+
+
+
+def push(n, tmp):
+
+    path = os.path.join(tmp, "kbh-%d.sqlite" % (n))
+    if not os.path.exists(path):
+        synthetic.createKbhDatabase(path, suds=n)
+
+    session = fakeSession(GrainfatherServer.Backend(recipes=0, brews=0))
+    interpreter = Grainfather.Interpreter(kbh=Grainfather.KleinerBrauhelfer(path), session=session, config={})
+
+    def run():
+        interpreter.push([])
+
+    return run
+
+
+
+SCENARIOS = [
+    ("kbh_convert", kbhConvert),
+    ("beersmith_convert", beerSmithConvert),
+    ("recalculate_scalar", recalculateScalar),
+    ("recalculate_batched", recalculateBatched),
+    ("listing", listing),
+    ("push", push),
+    ]
+
+
+
+def measure(scenario, n, tmp, repeat):
+
+    """Returns the best wall time of repeat runs and the peak of traced
+    memory of a separate run, as tracing slows down the code."""
+
+    seconds = None
+    for i in range(repeat):
+        run = scenario(n, tmp)
+        t = time.perf_counter()
+        run()
+        t = time.perf_counter() - t
+        seconds = t if seconds is None else min(seconds, t)
+
+    run = scenario(n, tmp)
+    tracemalloc.start()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(seconds=seconds, throughput=n / seconds, peak_memory=peak)
+
+
+
+def gitCommit():
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except Exception:
+        return None
+
+
+
+def usage():
+    print("""Usage: %s [options] [count ...]
+  -h  --help                    Print this help
+  -r  --repeat=n                Take the best of n runs (default 3)
+  -s  --scenario=name           Run only the named scenario, may be repeated
+  -o  --output=file             Store the results as JSON
+  -c  --compare=file            Compare to the results of a previous run
+Counts default to 100 and 1000 items per scenario.
+Scenarios: %s""" % (sys.argv[0], ", ".join(name for name, f in SCENARIOS)))
+
+
+
+def main():
+
+    repeat = 3
+    names = []
+    output = None
+    compare = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:s:o:c:", ["help", "repeat=", "scenario=", "output=", "compare="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-s", "--scenario"):
+            names.append(a)
+        elif o in ("-o", "--output"):
+            output = a
+        elif o in ("-c", "--compare"):
+            compare = a
+        else:
+            assert False, "unhandled option"
+
+    # the code under test logs to the root logger, keep the output clean
+    logging.basicConfig(level=logging.ERROR)
+
+    counts = [ int(a) for a in args ] or [ 100, 1000 ]
+    scenarios = [ (name, f) for (name, f) in SCENARIOS if not names or name in names ]
+
+    previous = {}
+    if compare:
+        with open(compare) as f:
+            for r in json.load(f)["results"]:
+                previous[(r["scenario"], r["count"])] = r
+
+    results = []
+    tmp = tempfile.mkdtemp(prefix="grainfather-bench-")
+    try:
+        for name, scenario in scenarios:
+            for n in counts:
+                r = dict(scenario=name, count=n)
+                r.update(measure(scenario, n, tmp, repeat))
+                results.append(r)
+                line = "%-20s %7d: %9.1fms %10.0f/s %9.1fMB" % (name, n, r["seconds"] * 1000, r["throughput"], r["peak_memory"] / 1e6)
+                p = previous.get((name, n))
+                if p:
+                    line += "  %+6.1f%% time %+6.1f%% memory" % ((r["seconds"] / p["seconds"] - 1) * 100,
+                                                                 (r["peak_memory"] / p["peak_memory"] - 1) * 100)
+                print(line)
+    finally:
+        shutil.rmtree(tmp)
+
+    if output:
+        doc = dict(date=datetime.datetime.now().isoformat(timespec="seconds"),
+                   commit=gitCommit(),
+                   python=platform.python_version(),
+                   numpy=Grainfather.numpy.__version__ if Grainfather.numpy else None,
+                   repeat=repeat,
+                   results=results)
+        with open(output, "w") as f:
+            json.dump(doc, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    main()
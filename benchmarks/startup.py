@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+startup - Time the import and the cold start of the command line tool
+
+Copyright (C) 2018-2019 Frank Steinberg <frank@familie-steinberg.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""
+
+
+
+import os
+import sys
+import json
+import time
+import getopt
+import tempfile
+import py_compile
+import subprocess
+
+
+
+DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SCRIPT = os.path.join(DIR, "Grainfather.py")
+
+# modules that only the commands needing them may import
+HEAVY = [ "requests", "lxml", "xmltodict", "dateutil", "sqlite3", "numpy", "orjson" ]
+
+
+
+# Each scenario is a command line, run in a fresh interpreter.
+
+SCENARIOS = [
+    ("python", [ sys.executable, "-c", "pass" ]),
+    ("import", [ sys.executable, "-c", "import Grainfather" ]),
+    ("help", [ sys.executable, SCRIPT, "-h" ]),
+    ("client", [ sys.executable, SCRIPT, "--socket", "/nonexistent/grainfather.sock", "--client", "list" ]),
+    ]
+
+
+
+def measure(command, repeat, env):
+
+    """Returns the best wall time of repeat runs of a command."""
+
+    seconds = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        subprocess.run(command, cwd=DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        t = time.perf_counter() - t
+        seconds = t if seconds is None else min(seconds, t)
+
+    return seconds
+
+
+
+def heavyImports(env):
+
+    """Returns the heavy modules that are loaded by importing the tool."""
+
+    code = "import sys, Grainfather; print(' '.join(m for m in %r if m in sys.modules))" % (HEAVY)
+    output = subprocess.check_output([ sys.executable, "-c", code ], cwd=DIR, env=env)
+
+    return output.decode("ascii").split()
+
+
+
+def usage():
+    print("""Usage: %s [options]
+  -h  --help                    Print this help
+  -r  --repeat=n                Take the best of n runs (default 10)
+  -o  --output=file             Store the results as JSON
+  -c  --compare=file            Compare to the results of a previous run
+Fails if importing the tool loads any of: %s""" % (sys.argv[0], ", ".join(HEAVY)))
+
+
+
+def main():
+
+    repeat = 10
+    output = None
+    compare = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:o:c:", ["help", "repeat=", "output=", "compare="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-o", "--output"):
+            output = a
+        elif o in ("-c", "--compare"):
+            compare = a
+        else:
+            assert False, "unhandled option"
+
+    previous = {}
+    if compare:
+        with open(compare) as f:
+            for r in json.load(f)["results"]:
+                previous[r["scenario"]] = r
+
+    # the imported module is compiled once, as after an installation,
+    # a script is always compiled from its source
+    env = dict(os.environ, HOME=tempfile.gettempdir())
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    py_compile.compile(SCRIPT)
+
+    results = []
+    for name, command in SCENARIOS:
+        r = dict(scenario=name, seconds=measure(command, repeat, env))
+        results.append(r)
+        line = "%-10s %9.1fms" % (name, r["seconds"] * 1000)
+        p = previous.get(name)
+        if p:
+            line += "  %+6.1f%% time" % ((r["seconds"] / p["seconds"] - 1) * 100)
+        print(line)
+
+    heavy = heavyImports(env)
+    print("heavy imports: %s" % (", ".join(heavy) if heavy else "none"))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(dict(repeat=repeat, results=results, heavy_imports=heavy), f, indent=4)
+
+    sys.exit(1 if heavy else 0)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+synthetic - Generate synthetic KBH databases and BeerSmith3 recipe files
+
+Copyright (C) 2018-2019 Frank Steinberg <frank@familie-steinberg.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""
+
+
+
+import os
+import sys
+import getopt
+import random
+import sqlite3
+import datetime
+import xml.sax.saxutils
+
+
+
+# name, color (EBC), yield (%)
+MALZE = [
+    ("Pilsner Malz", 3.5, 81), ("Pale Ale Malz", 6.5, 80), ("Wiener Malz", 8.0, 80),
+    ("Münchner Malz Typ I", 15.0, 79), ("Münchner Malz Typ II", 25.0, 78), ("Weizenmalz hell", 4.0, 83),
+    ("Carahell", 25.0, 75), ("Caramünch Typ II", 120.0, 74), ("Carafa Spezial Typ II", 1100.0, 65),
+    ("Melanoidinmalz", 70.0, 78), ("Sauermalz", 5.0, 75), ("Roggenmalz", 8.0, 79) ]
+
+# name, alpha acid (%), pellets
+HOPFEN = [
+    ("Hallertauer Mittelfrüh", 4.0, 1), ("Hallertauer Tradition", 6.0, 1), ("Tettnanger", 4.5, 1),
+    ("Saazer", 3.5, 0), ("Perle", 7.5, 1), ("Magnum", 13.0, 1), ("Herkules", 15.0, 1),
+    ("Cascade", 6.5, 1), ("Citra", 12.5, 1), ("Mosaic", 11.5, 1), ("Simcoe", 13.0, 1), ("Amarillo", 9.0, 0) ]
+
+# name, attenuation (EVG), dry (1) or liquid (2), package
+HEFEN = [
+    ("Fermentis Safale US-05", "81%", 1, "11,5 g"), ("Fermentis Saflager W-34/70", "83%", 1, "11,5 g"),
+    ("Fermentis Safbrew WB-06", "86%", 1, "11,5 g"), ("Wyeast 1056 American Ale", "75%", 2, "125 ml"),
+    ("Mangrove Jack's M44", "80%", 1, "10 g") ]
+
+# name, type, yield (%), color (EBC)
+ZUTATEN = [
+    ("Kandiszucker hell", 0, 100, 1.0), ("Honig", 0, 80, 5.0), ("Milchzucker", 0, 0, 0.0),
+    ("Irish Moss", 1, 0, 0.0), ("Koriander", 2, 0, 0.0), ("Orangenschale", 2, 0, 0.0) ]
+
+STYLES = [ ("Pils", "5D"), ("Helles", "4A"), ("Weizen", "10A"), ("Märzen", "6A"), ("Pale Ale", "18B"),
+           ("IPA", "21A"), ("Stout", "16A"), ("Porter", "20A"), ("Dunkles", "8A"), ("Kölsch", "5B") ]
+
+
+
+def kbhSchema():
+
+    """Returns the SQL statements creating those tables (and columns) of
+    a KBH database that are read by Grainfather.py."""
+
+    return [
+        """CREATE TABLE Sud (ID INTEGER PRIMARY KEY, Sudname TEXT, Menge REAL, SW REAL, SWAnstellen REAL,
+               KochdauerNachBitterhopfung INTEGER, WuerzemengeAnstellen REAL, WuerzemengeKochende REAL,
+               WuerzemengeVorHopfenseihen REAL, highGravityFaktor REAL, erg_Alkohol REAL,
+               erg_Sudhausausbeute REAL, erg_Farbe REAL, erg_WHauptguss REAL, erg_WNachguss REAL, IBU REAL,
+               EinmaischenTemp INTEGER, BierWurdeGebraut INTEGER, BierWurdeAbgefuellt INTEGER,
+               BierWurdeVerbraucht INTEGER, Braudatum TEXT, Anstelldatum TEXT, Abfuelldatum TEXT,
+               Erstellt TEXT, Gespeichert TEXT, Kommentar TEXT, AuswahlHefe TEXT, HefeAnzahlEinheiten INTEGER,
+               AuswahlBrauanlageName TEXT, TemperaturJungbier REAL, CO2 REAL, JungbiermengeAbfuellen REAL,
+               Reifezeit INTEGER)""",
+        """CREATE TABLE Ausruestung (AnlagenID INTEGER PRIMARY KEY, Name TEXT, Sudhausausbeute REAL,
+               Verdampfungsziffer REAL)""",
+        """CREATE TABLE Geraete (ID INTEGER PRIMARY KEY, AusruestungAnlagenID INTEGER, Bezeichnung TEXT)""",
+        """CREATE TABLE Malz (ID INTEGER PRIMARY KEY, Beschreibung TEXT, Farbe REAL, Bemerkung TEXT)""",
+        """CREATE TABLE Hopfen (ID INTEGER PRIMARY KEY, Beschreibung TEXT, Alpha REAL, Pellets INTEGER)""",
+        """CREATE TABLE Hefe (ID INTEGER PRIMARY KEY, Beschreibung TEXT, EVG TEXT, TypTrFl INTEGER,
+               Verpackungsmenge TEXT)""",
+        """CREATE TABLE Malzschuettung (ID INTEGER PRIMARY KEY, SudID INTEGER, Name TEXT, Prozent REAL,
+               Farbe REAL, erg_Menge REAL)""",
+        """CREATE TABLE HopfenGaben (ID INTEGER PRIMARY KEY, SudID INTEGER, Name TEXT, Alpha REAL,
+               Pellets INTEGER, Vorderwuerze INTEGER, Zeit INTEGER, erg_Menge REAL)""",
+        """CREATE TABLE WeitereZutatenGaben (ID INTEGER PRIMARY KEY, SudID INTEGER, Name TEXT, Typ INTEGER,
+               Ausbeute REAL, Farbe REAL, Zeitpunkt INTEGER, Zugabedauer INTEGER, erg_Menge REAL)""",
+        """CREATE TABLE Rasten (ID INTEGER PRIMARY KEY, SudID INTEGER, RastName TEXT, RastTemp INTEGER,
+               RastDauer INTEGER)""",
+        """CREATE TABLE Hauptgaerverlauf (ID INTEGER PRIMARY KEY, SudID INTEGER, Zeitstempel TEXT, SW REAL,
+               Temp REAL)""",
+        """CREATE TABLE Nachgaerverlauf (ID INTEGER PRIMARY KEY, SudID INTEGER, Zeitstempel TEXT, Druck REAL,
+               Temp REAL)""",
+        "CREATE INDEX MalzschuettungSudID ON Malzschuettung (SudID)",
+        "CREATE INDEX HopfenGabenSudID ON HopfenGaben (SudID)",
+        "CREATE INDEX WeitereZutatenGabenSudID ON WeitereZutatenGaben (SudID)",
+        "CREATE INDEX RastenSudID ON Rasten (SudID)",
+        "CREATE INDEX HauptgaerverlaufSudID ON Hauptgaerverlauf (SudID)",
+        "CREATE INDEX NachgaerverlaufSudID ON Nachgaerverlauf (SudID)" ]
+
+
+
+def createKbhDatabase(path, suds=100, seed=0):
+
+    """Creates a KBH SQLite database at path holding the given number of
+    suds with grain bills, hop additions, other ingredients, mash rests
+    and fermentation measurements. The same seed always results in the
+    same database."""
+
+    r = random.Random("%s:kbh" % (seed))
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    for statement in kbhSchema():
+        c.execute(statement)
+
+    c.execute("INSERT INTO Ausruestung VALUES (1, 'Grainfather', 70, 10)")
+    c.executemany("INSERT INTO Geraete (AusruestungAnlagenID, Bezeichnung) VALUES (1, ?)", [
+            ("[[Grainfather Trub and Chiller Loss: 2,0]]",), ("[[Grainfather Wort Shrinkage: 4]]",),
+            ("[[Grainfather Mash Tun Loss: 0]]",), ("[[Grainfather Boil Loss: 3,0]]",),
+            ("[[Grainfather Grain Absorption: 0,8]]",), ("[[Maische-pH: 5,4]]",) ])
+    c.executemany("INSERT INTO Malz (Beschreibung, Farbe, Bemerkung) VALUES (?, ?, ?)",
+                  [ (m[0], m[1], "[[Ausbeute: %d]]" % (m[2])) for m in MALZE ])
+    c.executemany("INSERT INTO Hopfen (Beschreibung, Alpha, Pellets) VALUES (?, ?, ?)", HOPFEN)
+    c.executemany("INSERT INTO Hefe (Beschreibung, EVG, TypTrFl, Verpackungsmenge) VALUES (?, ?, ?, ?)", HEFEN)
+
+    sude = []
+    malzschuettung = []
+    hopfengaben = []
+    zutaten = []
+    rasten = []
+    hauptgaerverlauf = []
+    nachgaerverlauf = []
+
+    for i in range(1, suds + 1):
+
+        style, bjcp = r.choice(STYLES)
+        menge = float("%.1f" % r.uniform(10.0, 25.0))
+        sw = float("%.1f" % r.uniform(10.0, 18.0))
+        kochdauer = r.choice([60, 70, 80, 90])
+        erstellt = datetime.datetime(2015, 1, 1) + datetime.timedelta(minutes=r.randrange(4 * 365 * 24 * 60))
+        braudatum = erstellt + datetime.timedelta(days=r.randrange(60), hours=r.randrange(8, 12))
+        anstelldatum = braudatum.date()
+        abfuelldatum = anstelldatum + datetime.timedelta(days=r.randint(7, 21))
+        gespeichert = abfuelldatum + datetime.timedelta(days=r.randrange(30), minutes=r.randrange(24 * 60))
+        status = r.random()
+        hefe = r.choice(HEFEN)
+        kommentar = "\n".join([
+                "Ein synthetisches %s zum Testen." % (style),
+                "",
+                "Gebraut mit dem Grainfather.",
+                "[[BJCP-Style: %s]]" % (bjcp),
+                "[[Brauer: Synthetic]]",
+                "[[Public: %s]]" % (r.choice(["ja", "nein"])),
+                "[[Gebinde: %s]]" % (r.choice(["Flaschen", "Keg 19l"])) ])
+
+        sude.append((i, "#%05d Synthetisches %s" % (i, style), menge, sw, float("%.1f" % (sw - r.uniform(0, 1))),
+                     kochdauer, menge, menge * 1.04, menge + 2.0, 1.0, float("%.1f" % r.uniform(4.0, 7.0)),
+                     float("%.1f" % r.uniform(60, 75)), float("%.1f" % r.uniform(6, 80)),
+                     float("%.1f" % (menge * 0.8)), float("%.1f" % (menge * 0.6)), r.randint(15, 60),
+                     r.choice([55, 57, 63]), int(status > 0.1), int(status > 0.3), int(status > 0.8),
+                     braudatum.strftime("%Y-%m-%dT%H:%M:%S"), anstelldatum.strftime("%Y-%m-%d"),
+                     abfuelldatum.strftime("%Y-%m-%d"), erstellt.strftime("%Y-%m-%dT%H:%M:%S"),
+                     gespeichert.strftime("%Y-%m-%dT%H:%M:%S"), kommentar, hefe[0], r.randint(1, 2),
+                     "Grainfather", r.choice([18.0, 20.0, 22.0]), float("%.1f" % r.uniform(4.5, 6.5)),
+                     menge, r.randint(2, 8)))
+
+        total = 0
+        malze = r.sample(MALZE, r.randint(2, 6))
+        anteile = [ r.uniform(1, 10) for m in malze ]
+        anteile[0] *= 4
+        for m, anteil in zip(malze, anteile):
+            prozent = 100.0 * anteil / sum(anteile)
+            malzschuettung.append((i, m[0], float("%.1f" % prozent), m[1], float("%.3f" % (prozent * menge * sw * 0.00016))))
+
+        for j, h in enumerate(r.sample(HOPFEN, r.randint(2, 6))):
+            vorderwuerze = int(j == 0 and r.random() < 0.2)
+            zeit = kochdauer if j == 0 else r.choice([60, 30, 15, 10, 5, 0, -20])
+            hopfengaben.append((i, h[0], h[1], h[2], vorderwuerze, zeit, float("%.1f" % r.uniform(5.0, 60.0))))
+
+        if r.random() < 0.4:
+            h = r.choice(HOPFEN)
+            zutaten.append((i, h[0], 100, 0, 0, 0, r.choice([3, 5, 7]) * 1440, float("%.1f" % r.uniform(20.0, 100.0))))
+        for z in r.sample(ZUTATEN, r.randint(0, 2)):
+            zutaten.append((i, z[0], z[1], z[2], z[3], r.choice([0, 1, 2]), r.choice([0, 15]), float("%.1f" % r.uniform(5.0, 500.0))))
+
+        for name, temp, dauer in r.choice([
+                [ ("Einmaischen", 57, 10), ("Maltoserast", 63, 40), ("Verzuckerung", 72, 30), ("Abmaischen", 78, 10) ],
+                [ ("Einmaischen", 63, 10), ("Kombirast", 67, 60), ("Abmaischen", 78, 10) ],
+                [ ("Einmaischen", 55, 10), ("Eiweißrast", 55, 15), ("Maltoserast", 62, 30), ("Verzuckerung", 72, 30), ("Abmaischen", 78, 10) ] ]):
+            rasten.append((i, name, temp, dauer))
+
+        if status > 0.1:
+            extrakt = sw
+            for day in range(r.randint(5, 12)):
+                extrakt = max(sw * 0.2, extrakt * r.uniform(0.6, 0.95))
+                zeit = datetime.datetime.combine(anstelldatum, datetime.time(20)) + datetime.timedelta(days=day)
+                hauptgaerverlauf.append((i, zeit.strftime("%Y-%m-%dT%H:%M:%S"), float("%.1f" % extrakt), r.choice([10.0, 12.0, 18.0, 20.0])))
+        if status > 0.3:
+            for day in range(r.randint(2, 6)):
+                zeit = datetime.datetime.combine(abfuelldatum, datetime.time(20)) + datetime.timedelta(days=7 * day)
+                nachgaerverlauf.append((i, zeit.strftime("%Y-%m-%dT%H:%M:%S"), float("%.1f" % r.uniform(0.5, 2.5)), r.choice([18.0, 20.0, 22.0])))
+
+    c.executemany("INSERT INTO Sud VALUES (%s)" % (", ".join([ "?" ] * 33)), sude)
+    c.executemany("INSERT INTO Malzschuettung (SudID, Name, Prozent, Farbe, erg_Menge) VALUES (?, ?, ?, ?, ?)", malzschuettung)
+    c.executemany("INSERT INTO HopfenGaben (SudID, Name, Alpha, Pellets, Vorderwuerze, Zeit, erg_Menge) VALUES (?, ?, ?, ?, ?, ?, ?)", hopfengaben)
+    c.executemany("INSERT INTO WeitereZutatenGaben (SudID, Name, Typ, Ausbeute, Farbe, Zeitpunkt, Zugabedauer, erg_Menge) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", zutaten)
+    c.executemany("INSERT INTO Rasten (SudID, RastName, RastTemp, RastDauer) VALUES (?, ?, ?, ?)", rasten)
+    c.executemany("INSERT INTO Hauptgaerverlauf (SudID, Zeitstempel, SW, Temp) VALUES (?, ?, ?, ?)", hauptgaerverlauf)
+    c.executemany("INSERT INTO Nachgaerverlauf (SudID, Zeitstempel, Druck, Temp) VALUES (?, ?, ?, ?)", nachgaerverlauf)
+
+    conn.commit()
+    conn.close()
+
+
+
+def xmlElement(tag, value):
+
+    if isinstance(value, dict):
+        return "<%s>%s</%s>" % (tag, "".join(xmlElement(k, v) for (k, v) in value.items()), tag)
+    if isinstance(value, list):
+        return "".join(xmlElement(tag, v) for v in value)
+
+    return "<%s>%s</%s>" % (tag, xml.sax.saxutils.escape(str(value)), tag)
+
+
+
+def beerSmithRecipe(r, i):
+
+    """Returns the BeerSmith3 XML of one synthetic recipe, with the
+    units BeerSmith uses internally (fl oz, oz, °F)."""
+
+    style, bjcp = r.choice(STYLES)
+    mod = (datetime.date(2015, 1, 1) + datetime.timedelta(days=r.randrange(4 * 365))).strftime("%Y-%m-%d")
+    liters = r.uniform(10.0, 25.0)
+
+    grains = []
+    malze = r.sample(MALZE, r.randint(2, 6))
+    anteile = [ r.uniform(1, 10) for m in malze ]
+    anteile[0] *= 4
+    for m, anteil in zip(malze, anteile):
+        kg = liters * r.uniform(0.18, 0.28) * anteil / sum(anteile)
+        grains.append({
+                "F_G_NAME": m[0], "F_G_USE": r.choice([0, 0, 0, 0, 1, 3]), "F_G_YIELD": "%.4f" % (m[2]),
+                "F_G_COLOR": "%.4f" % ((m[1] / 1.97 + 0.76) / 1.3546), "F_G_AMOUNT": "%.4f" % (kg / 0.0283495) })
+    hops = []
+    for h in r.sample(HOPFEN, r.randint(2, 6)):
+        hops.append({
+                "F_H_NAME": h[0], "F_H_FORM": r.choice([0, 0, 2]), "F_H_USE": r.choice([0, 0, 0, 1, 2, 3, 4]),
+                "F_H_ALPHA": "%.4f" % (h[1]), "F_H_BOIL_TIME": r.choice([60, 30, 15, 5, 0]),
+                "F_H_DRY_HOP_TIME": r.choice([3, 5, 7]), "F_H_AMOUNT": "%.4f" % (r.uniform(5.0, 60.0) / 28.3495) })
+    hefe = r.choice(HEFEN)
+    yeasts = [ { "F_Y_NAME": hefe[0], "F_Y_LAB": "", "F_Y_PRODUCT_ID": "", "F_Y_MAX_ATTENUATION": hefe[1].rstrip("%"), "F_Y_AMOUNT": "1.0000" } ]
+    miscs = []
+    for z in r.sample(ZUTATEN, r.randint(0, 2)):
+        miscs.append({ "F_M_NAME": z[0], "F_M_UNITS": r.choice([1, 6, 13]), "F_M_USE": r.choice([0, 1, 2, 3, 4, 5]),
+                       "F_M_TIME": r.choice([0, 10, 15]), "F_M_AMOUNT": "%.4f" % (r.uniform(1, 50)) })
+    steps = [ { "F_MS_NAME": name, "F_MS_STEP_TEMP": "%.4f" % (temp * 9 / 5 + 32), "F_MS_STEP_TIME": dauer }
+              for (name, temp, dauer) in [ ("Mash In", 63, 10), ("Saccharification", 67, 60), ("Mash Out", 78, 10) ] ]
+
+    recipe = {
+        "_MOD_": mod,
+        "F_R_NAME": "#%05d Synthetic %s" % (i, style),
+        "F_R_DESIRED_OG": "%.4f" % r.uniform(1.040, 1.080),
+        "F_R_DESIRED_IBU": "%.4f" % r.uniform(15, 70),
+        "F_R_DESIRED_COLOR": "%.4f" % r.uniform(2, 40),
+        "F_R_NOTES": "Synthetic & generated.",
+        "F_R_DESCRIPTION": "A synthetic %s." % (style),
+        "AGEDATA": { "_MOD_": mod },
+        "F_R_STYLE": { "F_S_GUIDE": "BJCP 2015", "F_S_NUMBER": bjcp[:-1], "F_S_LETTER": ord(bjcp[-1]) - 64 },
+        "F_R_EQUIPMENT": { "F_E_EFFICIENCY": "72.0000", "F_E_BATCH_VOL": "%.4f" % (liters / 0.0295735),
+                           "F_E_BOIL_VOL": "%.4f" % (liters * 1.3 / 0.0295735), "F_E_BOIL_TIME": r.choice([60, 90]),
+                           "F_E_TRUB_LOSS": "%.4f" % (2.0 / 0.0295735) },
+        "INGREDIENTS": { "DATA": { "GRAIN": grains, "HOPS": hops, "YEAST": yeasts, "MISC": miscs } },
+        "F_R_MASH": { "STEPS": { "DATA": { "MASHSTEP": steps } } },
+        "F_R_AGE": { "F_A_NAME": "Ale", "F_A_TYPE": r.randint(0, 2), "F_A_PRIM_TEMP": "66.0000", "F_A_PRIM_DAYS": 10,
+                     "F_A_SEC_TEMP": "64.0000", "F_A_SEC_DAYS": 7, "F_A_TERT_TEMP": "40.0000", "F_A_TERT_DAYS": 7,
+                     "F_A_AGE": r.choice([0, 14]), "F_A_AGE_TEMP": "50.0000", "F_A_END_AGE_TEMP": "50.0000" } }
+    if not miscs:
+        del recipe["INGREDIENTS"]["DATA"]["MISC"]
+
+    return xmlElement("Recipe", recipe)
+
+
+
+def createBeerSmithDir(dir, recipes=100, seed=0, folders=4, pattern="Sync"):
+
+    """Creates a BeerSmith3 data directory holding a Recipe.bsmx file
+    with the given number of recipes spread over some folders, whose
+    names contain the pattern Grainfather.py looks for."""
+
+    r = random.Random("%s:beersmith" % (seed))
+
+    os.makedirs(dir, exist_ok=True)
+
+    # without any charset declaration, the HTML parser reads the file as latin-1
+    with open(os.path.join(dir, "Recipe.bsmx"), "w", encoding="latin-1") as f:
+        f.write("<Recipe><_MOD_>2019-01-01</_MOD_><Data>")
+        for k in range(folders):
+            f.write("<Table><_MOD_>2019-01-01</_MOD_><Name>%s Folder %d</Name><Data>" % (pattern, k))
+            for i in range(k + 1, recipes + 1, folders):
+                f.write(beerSmithRecipe(r, i))
+            f.write("</Data></Table>")
+        f.write("</Data></Recipe>\n")
+
+
+
+def usage():
+    print("""Usage: %s [options] kbh|beersmith path
+  -h  --help                    Print this help
+  -n  --count=n                 Number of suds or recipes (default 100)
+  -s  --seed=n                  Seed of the synthetic data (default 0)
+Creates a KBH database file or a BeerSmith3 directory at path.""" % sys.argv[0])
+
+
+
+def main():
+
+    count = 100
+    seed = 0
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:s:", ["help", "count=", "seed="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-n", "--count"):
+            count = int(a)
+        elif o in ("-s", "--seed"):
+            seed = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if (len(args) != 2) or (args[0] not in ("kbh", "beersmith")):
+        usage()
+        sys.exit(2)
+
+    if args[0] == "kbh":
+        createKbhDatabase(args[1], suds=count, seed=seed)
+    else:
+        createBeerSmithDir(args[1], recipes=count, seed=seed)
+
+
+
+if __name__ == '__main__':
+    main()